@@ -0,0 +1,10 @@
+"""Performance benchmarks for GladTeX.
+
+The benchmarks run the individual stages of a GladTeX run against generated
+documents with a configurable number of formulas. LaTeX and dvipng are replaced
+by a fake tool chain which simulates the rendering latency, so that the
+benchmarks neither need a TeX distribution nor measure it. Run
+
+    python -m benchmarks.run --help
+
+from the source root for the available options."""
@@ -0,0 +1,54 @@
+"""Generation of synthetic .htex documents and formula lists for the
+benchmarks. All generators are deterministic for a given seed."""
+
+import random
+
+FORMULA_TEMPLATES = [
+    '\\sum_{i=0}^{%d} x_i^2',
+    '\\frac{a_{%d}}{b + c}',
+    '\\int_0^{%d} e^{-x^2}\\, dx',
+    '\\left( \\begin{array}{cc} %d & 1 \\\\ 0 & 1 \\end{array} \\right)',
+    'f(x) = \\sqrt{x^{%d} + 1}',
+    '\\lim_{n \\to \\infty} \\left( 1 + \\frac{1}{n} \\right)^{%d}',
+    'a &lt; b_{%d} &amp;&amp; c &gt; d',
+]
+
+UNICODE_TEMPLATES = [
+    'α + β_{%d} = γ',
+    '\\text{für alle } x_{%d} ∈ ℝ',
+    '∑_{i=0}^{%d} ö_i ≤ ∞',
+]
+
+PROSE = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do '
+        'eiusmod tempor incididunt ut labore et dolore magna aliqua. ')
+
+HTML_HEAD = ('<!DOCTYPE html>\n<html>\n<head>\n<meta http-equiv="content-type" '
+        'content="text/html; charset=utf-8"/>\n<title>Benchmark</title>\n'
+        '</head>\n<body>\n')
+
+def generate_formulas(count, unique_ratio=0.1, seed=42, templates=None):
+    """Return a list of `count` formulas, of which roughly `unique_ratio` are
+    distinct. Recurring formulas are what the cache is made for."""
+    rand = random.Random(seed)
+    templates = (templates if templates else FORMULA_TEMPLATES)
+    distinct = max(1, int(count * unique_ratio))
+    return [templates[n % len(templates)] % (n // len(templates))
+            for n in (rand.randrange(distinct) for _ in range(count))]
+
+def generate_document(count, unique_ratio=0.1, seed=42, display_ratio=0.2):
+    """Return a .htex document as a string with `count` formulas. A part of the
+    formulas is set as display maths and comments are sprinkled in between."""
+    rand = random.Random(seed)
+    chunks = [HTML_HEAD]
+    for index, formula in enumerate(generate_formulas(count, unique_ratio,
+            seed)):
+        if index % 50 == 0:
+            chunks.append('<!-- section %d, <eq>ignored</eq> -->\n' % index)
+        chunks.append('<p>' + PROSE)
+        if rand.random() < display_ratio:
+            chunks.append('<eq env="displaymath">%s</eq>' % formula)
+        else:
+            chunks.append('<eq>%s</eq>' % formula)
+        chunks.append('</p>\n')
+    chunks.append('</body>\n</html>\n')
+    return ''.join(chunks)
@@ -0,0 +1,54 @@
+"""A fake TeX tool chain for benchmarking. It replaces
+gleetex.image.Tex2img.call and simulates `latex` and `dvipng`: the expected
+output files are written and the configured latency is waited for, but no
+process is started.
+
+    with FakeToolchain(latex_latency=0.05, dvipng_latency=0.01):
+        ... # run GladTeX
+"""
+
+import os
+import time
+
+from gleetex import image
+
+# a valid 1x1 pixel PNG file
+PNG_DATA = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00'
+        b'\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8'
+        b'\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82')
+
+class FakeToolchain:
+    """Callable which can be installed as gleetex.image.Tex2img.call. It
+    counts the simulated runs per program in the attribute `calls`."""
+    def __init__(self, latex_latency=0.0, dvipng_latency=0.0):
+        self.latex_latency = latex_latency
+        self.dvipng_latency = dvipng_latency
+        self.calls = {'latex': 0, 'dvipng': 0}
+        self.__original = None
+
+    def __call__(self, cmd, cwd=None, timeout=None):
+        program = cmd[0]
+        if program == 'latex':
+            tex_fn = os.path.join(cwd if cwd else '.', cmd[-1])
+            with open(os.path.splitext(tex_fn)[0] + '.dvi', 'wb') as f:
+                f.write(b'dvi')
+            latency = self.latex_latency
+        elif program == 'dvipng':
+            with open(cmd[cmd.index('-o') + 1], 'wb') as f:
+                f.write(PNG_DATA)
+            latency = self.dvipng_latency
+        else:
+            raise ValueError("unknown program: " + program)
+        self.calls[program] += 1
+        if latency:
+            time.sleep(latency)
+        return ('This is dvipng 1.15 Copyright 2002-2015 Jan-Ake Larsson\n'
+                ' depth=3 height=9 width=22' if program == 'dvipng' else '')
+
+    def __enter__(self):
+        self.__original = image.Tex2img.call
+        image.Tex2img.call = self
+        return self
+
+    def __exit__(self, *_args):
+        image.Tex2img.call = self.__original
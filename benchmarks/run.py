@@ -0,0 +1,229 @@
+"""Run the GladTeX benchmarks and optionally compare them against a baseline.
+
+    python -m benchmarks.run --sizes 1000,10000 -o results.json
+    python -m benchmarks.run --baseline results.json
+
+Each stage is run against generated corpora of the given sizes (number of
+formulas). The best time of all repetitions is reported, together with the
+time per formula. The results are written as JSON; if a baseline is given,
+stages which got slower than the threshold allows are reported and the exit
+status is 1."""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import gleetex
+from gleetex import caching, convenience, document, htmlhandling
+from . import corpus
+from .faketex import FakeToolchain
+
+@contextlib.contextmanager
+def working_directory():
+    """Create a temporary directory, change into it and remove it again."""
+    original = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix='gladtex-bench-')
+    os.chdir(tmpdir)
+    try:
+        yield tmpdir
+    finally:
+        os.chdir(original)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def parsed_formulas(doc):
+    """Return the formula chunks of a document as parsed by the EqnParser."""
+    parser = htmlhandling.EqnParser()
+    parser.feed(doc)
+    return [c for c in parser.get_data() if isinstance(c, (tuple, list))]
+
+# Each stage gets the size and the command line options and returns a
+# function, which performs the measured operation; the set up is not measured.
+
+def stage_parse(size, _options):
+    doc = corpus.generate_document(size)
+    def run():
+        htmlhandling.EqnParser().feed(doc)
+    return run
+
+def stage_plan(size, _options):
+    formulas = parsed_formulas(corpus.generate_document(size))
+    conv = convenience.CachedConverter('')
+    def plan():
+        planned = conv._get_formulas_to_convert('', formulas)
+        # planning claims the image file names, release them for the next run
+        convenience.release_file_names(f[2] for f in planned)
+    return plan
+
+def _filled_cache(size):
+    with open('eqn000.png', 'wb') as f:
+        f.write(b'png')
+    cache = caching.ImageCache('gladtex.cache')
+    pos = {'height': 9, 'depth': 3, 'width': 22}
+    formulas = corpus.generate_formulas(size, unique_ratio=1)
+    for index, formula in enumerate(formulas):
+        cache.add_formula(formula, pos, 'eqn000.png', displaymath=bool(index % 2))
+    return cache, formulas
+
+def stage_cache_write(size, _options):
+    cache, _formulas = _filled_cache(size)
+    return cache.write
+
+def stage_cache_load(size, _options):
+    cache, _formulas = _filled_cache(size)
+    cache.write()
+    return lambda: caching.ImageCache('gladtex.cache')
+
+def stage_cache_lookup(size, _options):
+    cache, formulas = _filled_cache(size)
+    def run():
+        for index, formula in enumerate(formulas):
+            cache.get_data_for(formula, bool(index % 2))
+    return run
+
+def stage_escape_unicode(size, _options):
+    formulas = corpus.generate_formulas(size,
+            templates=corpus.UNICODE_TEMPLATES)
+    def run():
+        for formula in formulas:
+            document.escape_unicode_in_formulas(formula)
+    return run
+
+def stage_format(size, _options):
+    formulas = parsed_formulas(corpus.generate_document(size))
+    pos = {'height': 9, 'depth': 3, 'width': 22}
+    def run():
+        with htmlhandling.HtmlImageFormatter() as fmt:
+            fmt.set_exclude_long_formulas(True)
+            for count, (_pos, displaymath, formula) in enumerate(formulas):
+                fmt.format(pos, formula, 'eqn%03d.png' % count, displaymath)
+    return run
+
+def _main_run(size, options, warm):
+    # gladtex.py lives in the source root and is not part of the package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+    import gladtex
+    with open('doc.htex', 'w', encoding='utf-8') as f:
+        f.write(corpus.generate_document(size))
+    toolchain = FakeToolchain(options.latex_latency, options.dvipng_latency)
+    runs = [0]
+    def run():
+        # without a warm cache, every run gets a fresh image directory
+        directory = ('img' if warm else 'img%d' % runs[0])
+        runs[0] += 1
+        with toolchain:
+            gladtex.Main().run(['gladtex', '-d', directory, '-o', 'doc.html',
+                'doc.htex'])
+    if warm:
+        run() # fill the cache
+    return run
+
+def stage_run(size, options):
+    return _main_run(size, options, warm=False)
+
+def stage_run_cached(size, options):
+    return _main_run(size, options, warm=True)
+
+STAGES = [('parse', stage_parse), ('plan', stage_plan),
+        ('cache_write', stage_cache_write), ('cache_load', stage_cache_load),
+        ('cache_lookup', stage_cache_lookup),
+        ('escape_unicode', stage_escape_unicode), ('format', stage_format),
+        ('run', stage_run), ('run_cached', stage_run_cached)]
+
+def measure(function, repeat):
+    """Call function `repeat` times and return a list of the durations."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def run_benchmarks(options):
+    """Run all selected stages for all sizes and return the results as a
+    dictionary, keyed by `stage[size]`."""
+    results = {}
+    stages = [s for s in STAGES if not options.stages or s[0] in options.stages]
+    for size in options.sizes:
+        for name, stage in stages:
+            key = '%s[%d]' % (name, size)
+            with working_directory():
+                durations = measure(stage(size, options), options.repeat)
+            best = min(durations)
+            results[key] = {'stage': name, 'size': size, 'best': best,
+                    'mean': sum(durations) / len(durations),
+                    'per_formula_us': best / size * 1e6}
+            sys.stderr.write('%-24s %10.4f s %10.2f us/formula\n' % (key, best,
+                results[key]['per_formula_us']))
+    return results
+
+def compare(results, baseline, threshold):
+    """Compare the results against the baseline results. Returned is a list of
+    (key, baseline time, current time) for all stages which got slower by more
+    than the given threshold (a fraction, 0.1 = 10 %)."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['best'], result['best']
+        ratio = (new / old if old else float('inf'))
+        sys.stderr.write('%-24s %10.4f s -> %10.4f s (%+.1f %%)\n' % (key, old,
+            new, (ratio - 1) * 100))
+        if ratio > 1 + threshold:
+            regressions.append((key, old, new))
+    return regressions
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000',
+            type=lambda x: [int(s) for s in x.split(',')],
+            help="comma-separated list of document sizes (number of formulas), "
+                "default 1000,10000")
+    parser.add_argument('--stages', default=None,
+            type=lambda x: x.split(','),
+            help="comma-separated list of stages to run, one of " +
+                ', '.join(s[0] for s in STAGES) + " (default all)")
+    parser.add_argument('--repeat', type=int, default=3,
+            help="number of repetitions per stage (default 3)")
+    parser.add_argument('--latex-latency', type=float, default=0.0,
+            help="simulated run time of latex in seconds (default 0)")
+    parser.add_argument('--dvipng-latency', type=float, default=0.0,
+            help="simulated run time of dvipng in seconds (default 0)")
+    parser.add_argument('-o', dest='output', default=None,
+            help="write JSON results to this file instead of stdout")
+    parser.add_argument('--baseline', default=None,
+            help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+            help="allowed slow down compared to the baseline, as a fraction "
+                "(default 0.1)")
+    return parser.parse_args(args)
+
+def main(args):
+    options = parse_args(args)
+    results = run_benchmarks(options)
+    report = {'gladtex': gleetex.VERSION, 'python': platform.python_version(),
+            'platform': platform.platform(), 'results': results}
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if options.baseline:
+        with open(options.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            sys.stderr.write('%d stage(s) got slower than allowed:\n' %
+                    len(regressions))
+            for key, old, new in regressions:
+                sys.stderr.write('    %s: %.4f s -> %.4f s\n' % (key, old, new))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
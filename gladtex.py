@@ -1,12 +1,28 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import contextlib
+import io
+import json
+import mmap
 import multiprocessing
 import os
 import posixpath
 import re
+import signal
 import sys
+import threading
+import traceback
+import types
 import gleetex
 
+# command line options which configure the converter; converters kept by the
+# server are only reused for runs with the same options
+CONVERTER_OPTIONS = ('notkeepoldcache', 'preamble', 'latex_maths_env',
+        'keep_latex_source', 'dpi', 'foreground_color', 'background_color',
+        'replace_nonascii', 'latex_timeout', 'dvipng_timeout', 'remote_cache',
+        'no_validation')
+
 
 class HelpfulCmdParser(argparse.ArgumentParser):
     """This variant of arg parser always prints the full help whenever an error
@@ -22,11 +38,42 @@ def format_ordinal(number):
     endings = ['th', 'st', 'nd', 'rd'] + ['th'] * 6
     return '%d%s' % (number, endings[number%10])
 
+class ConverterPool:
+    """Keep the converters of a server between runs, so that the cache and the
+    compiled LaTeX template stay in memory. Only the most recently used
+    converters are kept."""
+    def __init__(self, size=16):
+        self.__converters = collections.OrderedDict()
+        self.__size = size
+
+    def get(self, key):
+        """Return the converter for the given key or None."""
+        conv = self.__converters.get(key)
+        if conv:
+            self.__converters.move_to_end(key)
+        return conv
+
+    def add(self, key, conv):
+        self.__converters[key] = conv
+        while len(self.__converters) > self.__size:
+            self.__converters.popitem(last=False)[1].remove_scratch_directories()
+
+    def clear(self):
+        for conv in self.__converters.values():
+            conv.remove_scratch_directories()
+        self.__converters.clear()
+
 class Main:
     """This class parses command line arguments and deals with the
-    conversion. Only the run method needs to be called."""
-    def __init__(self):
+    conversion. Only the run method needs to be called.
+    When run by the server (see serve), converters are taken from the given
+    ConverterPool and the document to read from stdin is passed as `stdin`."""
+    def __init__(self, pool=None, stdin=None):
         self.__encoding = "utf-8"
+        self.__converter = None
+        self.__report_path = None
+        self.__pool = pool
+        self.__stdin = stdin
 
     def _parse_args(self, args):
         """Parse command line arguments and return option instance."""
@@ -82,12 +129,66 @@ class Main:
                     "through their LaTeX commands")
         parser.add_argument("-u", metavar="URL", dest='url',
                 help="URL to image files (relative links are default)")
-        parser.add_argument('input', help="Input .htex file with LaTeX " +
+        parser.add_argument('--latex-timeout', metavar='SECONDS',
+                dest='latex_timeout', default=None,
+                help=("Time out for a single LaTeX run (default 20); 'auto' "
+                    "derives the time out from the observed run times, "
+                    "'auto:SECONDS' does the same with a custom initial value"))
+        parser.add_argument('--report', metavar='FILENAME', dest='report',
+                default=None, help=("Write a JSON report with cache and "
+                    "conversion statistics to the given file at exit ('-' "
+                    "for stderr)"))
+        parser.add_argument('--profile', dest='profile', action='store_true',
+                default=False, help=("Print a summary of the time spent in "
+                    "each stage and the slowest formulas to stderr; with -m, "
+                    "it is printed as JSON"))
+        parser.add_argument('--dvipng-timeout', metavar='SECONDS',
+                dest='dvipng_timeout', default=None,
+                help="Time out for a single dvipng run, same format as for --latex-timeout")
+        parser.add_argument('--no-validation', dest='no_validation',
+                action='store_true', default=False,
+                help=("Don't check formulas for structural errors (like "
+                    "unbalanced braces) before running LaTeX, e.g. if macros "
+                    "from the preamble produce false errors"))
+        parser.add_argument('--gc', dest='gc', action='store_true',
+                default=False, help=("Remove unused images and cache entries "
+                    "from the image directory (see -d) and exit; no input is "
+                    "converted"))
+        parser.add_argument('--cache-max-size', metavar='SIZE',
+                dest='cache_max_size', default=None,
+                help=("With --gc, remove the least recently used formulas "
+                    "until the images take at most SIZE bytes; the suffixes "
+                    "k, M and G are recognized"))
+        parser.add_argument('--cache-max-entries', metavar='COUNT', type=int,
+                dest='cache_max_entries', default=None,
+                help=("With --gc, remove the least recently used formulas "
+                    "until at most COUNT formulas are cached"))
+        parser.add_argument('--remote-cache', metavar='LOCATION',
+                dest='remote_cache', default=None,
+                help=("Fetch formulas missing in the cache from a shared cache "
+                    "and upload newly converted ones; LOCATION is a HTTP(S) "
+                    "URL or a directory"))
+        parser.add_argument('--shard-descriptions', metavar='MODE',
+                dest='shard_descriptions', default=None,
+                help=("Split the file with excluded formula descriptions: "
+                    "'document' writes one file per input document, a number "
+                    "N distributes the formulas over N files"))
+        parser.add_argument('--serve', metavar='ADDRESS', dest='serve',
+                default=None, help=("Run as a server, converting documents "
+                    "for clients (see --server); ADDRESS is a port number, "
+                    "HOST:PORT or the path of a Unix domain socket"))
+        parser.add_argument('--server', metavar='ADDRESS', dest='server',
+                default=None, help=("Let the server at ADDRESS convert the "
+                    "document, if it is running (default: environment "
+                    "variable GLADTEX_SERVER)"))
+        parser.add_argument('input', nargs='?', default='-',
+                help="Input .htex file with LaTeX " +
                 "formulas (if omitted or -, stdin will be read)")
         return parser.parse_args(args)
 
     def exit(self, text, status):
         """Exit function. Could be used to register any clean up action."""
+        self.write_report(status)
         sys.stderr.write(text)
         if not text.endswith('\n'):
             sys.stderr.write('\n')
@@ -108,6 +209,26 @@ class Main:
                         "num,num,num where num is a broken decimal between 0 " +
                         "and 1.")
             sys.exit(13)
+        for option_str in ['latex_timeout', 'dvipng_timeout']:
+            value = getattr(opts, option_str)
+            seconds = (value[len('auto:'):] if value and
+                    value.startswith('auto:') else value)
+            if value and value != 'auto' and not (re.match(
+                    r'^\d+(?:\.\d+)?$', seconds) and float(seconds) > 0):
+                print(("Option --%s requires a positive number of seconds, "
+                        "'auto' or 'auto:SECONDS'.") % option_str.replace('_',
+                            '-'))
+                sys.exit(14)
+        if opts.cache_max_size and not re.match(r'^\d+[kMG]?$',
+                opts.cache_max_size):
+            print("Option --cache-max-size requires a number of bytes, "
+                    "optionally followed by k, M or G.")
+            sys.exit(15)
+        if opts.shard_descriptions and not re.match(r'^(?:document|[1-9]\d*)$',
+                opts.shard_descriptions):
+            print("Option --shard-descriptions requires 'document' or a "
+                    "positive number of files.")
+            sys.exit(16)
 
     def get_input_output(self, options):
         """Determine whether GladTeX is reading from stdin/file, writing to
@@ -120,7 +241,8 @@ class Main:
         base_path = options.directory
         output = '-'
         if options.input == '-':
-            data = sys.stdin.read()
+            data = (self.__stdin if self.__stdin is not None
+                    else sys.stdin.read())
         else:
             try:
                 if options.encoding:
@@ -128,7 +250,7 @@ class Main:
                         data = f.read()
                 else: # read as binary and guess from HTML meta charset
                     with open(options.input, 'rb') as file:
-                        data = file.read()
+                        data = self.map_file(file)
             except UnicodeDecodeError as e:
                 self.exit(('Error while reading from %s: %s\nProbably this file'
                     ' has a different encoding, try specifying -E.') % \
@@ -157,12 +279,45 @@ class Main:
         return (data, base_path, output)
 
 
+    def map_file(self, file):
+        """Map the given binary file into memory, so that the parser can scan
+        it without reading it as a whole; the mapping is closed after parsing.
+        If the file cannot be mapped (e.g. empty files or pipes), it is read."""
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return file.read()
+
     def run(self, args):
         options = self._parse_args(args[1:])
         self.validate_options(options)
         self.__encoding = options.encoding
+        self.__report_path = options.report
+        self.check_forwarded(options)
+        if options.serve:
+            self.serve(options.serve)
+            return
+        server = (options.server if options.server
+                else os.environ.get('GLADTEX_SERVER'))
+        # the server only writes the default output file, see check_forwarded
+        if server and self.__pool is None and not options.gc and \
+                self.has_default_output(options):
+            if self.forward(server, args, options):
+                return
+        if options.gc:
+            self.collect_garbage(options)
+            return
+        profiler = None
+        if options.profile:
+            profiler = gleetex.profiling.Profiler()
+            gleetex.profiling.install(profiler)
         doc, base_path, output = self.get_input_output(options)
-        docparser = gleetex.htmlhandling.EqnParser()
+        # text between formulas is copied from the memory-mapped input to the
+        # output file, unless the output replaces the input
+        source = (doc if isinstance(doc, mmap.mmap) and output != '-' and not
+                (os.path.exists(output) and os.path.samefile(options.input,
+                    output)) else None)
+        docparser = gleetex.htmlhandling.EqnParser(text_spans=source is not None)
         try:
             docparser.feed(doc)
             self.__encoding = docparser.get_encoding()
@@ -171,6 +326,9 @@ class Main:
             input_fn = ('stdin' if options.input == '-' else options.input)
             self.exit('Error while parsing {}: {}'.format(input_fn,
                 str(e)), 5)
+        finally:
+            if isinstance(doc, mmap.mmap) and source is None:
+                doc.close()
         doc = docparser.get_data()
         processed = self.convert_images(doc, base_path, options)
         with gleetex.htmlhandling.HtmlImageFormatter(base_path=base_path,
@@ -184,60 +342,322 @@ class Main:
                 img_fmt.set_inline_math_css_class(options.inlinemath)
             if options.displaymath:
                 img_fmt.set_display_math_css_class(options.displaymath)
+            if options.shard_descriptions == 'document':
+                document = (options.input if options.input != '-'
+                        else options.output)
+                img_fmt.set_shard_by_document(document if document != '-'
+                        else None)
+            elif options.shard_descriptions:
+                img_fmt.set_shard_count(int(options.shard_descriptions))
 
             if output == '-':
                 self.write_html(sys.stdout, processed, img_fmt)
+            elif source is not None:
+                try:
+                    with open(output, 'wb') as file:
+                        self.write_html(file, processed, img_fmt, source)
+                finally:
+                    source.close()
             else:
                 with open(output, 'w', encoding=self.__encoding) as file:
                     self.write_html(file, processed, img_fmt)
+        if profiler:
+            gleetex.profiling.uninstall()
+            self.emit_profile(profiler, options.machinereadable)
+        self.write_report(0)
 
-    def write_html(self, file, processed, formatter):
-        """Write back altered HTML file with given formatter."""
-        # write data back
-        for chunk in processed:
-            if isinstance(chunk, dict):
-                is_displaymath = chunk['displaymath']
-                file.write(formatter.format(chunk['pos'], chunk['formula'],
-                    chunk['path'], is_displaymath))
-            else:
-                file.write(chunk)
+    def forward(self, address, args, options):
+        """Let the server at the given address convert the document. Its
+        output is printed and the program exits with its status, if not 0.
+        False is returned if the server isn't available, the document should
+        be converted locally then."""
+        forwarded = []
+        arguments = iter(args[1:])
+        for arg in arguments: # the server must not forward it again
+            if arg == '--server':
+                next(arguments, None)
+            elif not arg.startswith('--server='):
+                forwarded.append(arg)
+        data = {'cwd': os.getcwd(), 'args': forwarded, 'input': None}
+        if options.input == '-':
+            # keep it, stdin can't be read a second time
+            self.__stdin = data['input'] = sys.stdin.read()
+        try:
+            response = gleetex.server.request(address, 'document', data)
+        except gleetex.server.ServerUnavailable:
+            return False
+        except OSError as e:
+            sys.stderr.write("Warning: server at %s failed, converting "
+                    "locally: %s\n" % (address, e))
+            return False
+        sys.stdout.write(response['stdout'])
+        sys.stderr.write(response['stderr'])
+        if response['status']:
+            sys.exit(response['status'])
+        return True
+
+    def check_forwarded(self, options):
+        """Exit if options which only make sense for a local run were
+        forwarded to the server, see serve. The output file can only be
+        stdout or the one derived from the input file name, so that a client
+        cannot let the server write to arbitrary files."""
+        if self.__pool is None:
+            return
+        if options.serve or options.server or options.gc:
+            self.exit("Error: --serve, --server and --gc cannot be used for "
+                    "a conversion by the server.", 23)
+        if not self.has_default_output(options):
+            self.exit("Error: the server only writes to stdout or the "
+                    "default output file, -o cannot be used.", 23)
+
+    def has_default_output(self, options):
+        """Check whether the output is written to stdout or to the file name
+        derived from the input file name, see get_input_output."""
+        return (not options.output or options.output == '-' or
+                (options.input != '-' and options.output ==
+                    os.path.splitext(options.input)[0] + '.html'))
+
+    def serve(self, address):
+        """Run a server at the given address (see gleetex.server), converting
+        documents and formulas for clients. The converters are kept between
+        the requests. Documents are converted one after another (each with its
+        formulas converted concurrently), since the working directory of the
+        client has to be used."""
+        pool = ConverterPool()
+        try:
+            server = self.create_server(address, pool)
+        except OSError as e:
+            self.exit("Error: cannot listen at %s: %s" % (address, e), 22)
+        sys.stderr.write("Serving on %s\n" % server.get_address())
+        # shut down cleanly when terminated
+        signal.signal(signal.SIGTERM, lambda *_args: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            pool.clear()
+
+    def create_server(self, address, pool):
+        """Return a gleetex.server.RenderServer listening at the given address,
+        with the handlers for documents and formulas, see serve. The
+        converters are kept in the given ConverterPool."""
+        lock = threading.Lock()
+        directory = os.getcwd()
+        def run_captured(data, function):
+            """Run function in the working directory of the client and return
+            its exit status and output."""
+            stdout, stderr = io.StringIO(), io.StringIO()
+            response = {'status': 0}
+            with lock:
+                # the client must be able to write there itself
+                if not (os.path.isdir(data['cwd']) and
+                        os.access(data['cwd'], os.W_OK)):
+                    return {'status': 23, 'stdout': '', 'stderr': ("Error: "
+                        "working directory %s is not writable.\n" %
+                        data['cwd'])}
+                try:
+                    os.chdir(data['cwd'])
+                    with contextlib.redirect_stdout(stdout), \
+                            contextlib.redirect_stderr(stderr):
+                        result = function(Main(pool, stdin=data.get('input')),
+                                ['gladtex'] + list(data.get('args', [])))
+                    if result is not None:
+                        response['entries'] = result
+                except SystemExit as e:
+                    response['status'] = (e.code if isinstance(e.code, int)
+                            else int(e.code is not None))
+                except Exception: #pylint: disable=broad-except
+                    traceback.print_exc(file=stderr)
+                    response['status'] = 1
+                finally:
+                    os.chdir(directory)
+            response['stdout'] = stdout.getvalue()
+            response['stderr'] = stderr.getvalue()
+            return response
+        handlers = {
+            'document': lambda data: run_captured(data,
+                lambda main, args: main.run(args)),
+            'formulas': lambda data: run_captured(data,
+                lambda main, args: main.convert_formulas(args,
+                    data['formulas']))}
+        return gleetex.server.RenderServer(address, handlers)
+
+    def convert_formulas(self, args, formulas):
+        """Convert a list of formulas, each given as (formula, displaymath),
+        using the options from the command line arguments (as for run) and
+        return a list of their cache entries with 'pos' and 'path'."""
+        options = self._parse_args(args[1:])
+        self.validate_options(options)
+        self.check_forwarded(options)
+        base_path = (options.directory if options.directory else '')
+        processed = self.convert_images([((0, 0), bool(displaymath), formula)
+            for formula, displaymath in formulas], base_path, options)
+        return [{'pos': dict(entry.pos), 'path': entry.path}
+                for entry in processed]
+
+    def collect_garbage(self, options):
+        """Remove unused images and cache entries from the image directory,
+        limited to the budget given on the command line."""
+        base_path = (options.directory if options.directory else '')
+        cache_path = os.path.join(base_path,
+                gleetex.convenience.CachedConverter.GLADTEX_CACHE_FILE_NAME)
+        if not os.path.exists(cache_path):
+            self.exit("Error: no cache found at %s." % cache_path, 21)
+        try:
+            cache = gleetex.caching.ImageCache(cache_path,
+                    not options.notkeepoldcache)
+        except gleetex.caching.JsonParserException as e:
+            self.exit(e.args[0], 78)
+        max_bytes = None
+        if options.cache_max_size:
+            units = {'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+            size = options.cache_max_size
+            max_bytes = (int(size[:-1]) * units[size[-1]] if size[-1] in units
+                    else int(size))
+        removed = cache.collect_garbage(max_bytes=max_bytes,
+                max_entries=options.cache_max_entries)
+        cache.write()
+        if options.machinereadable:
+            print('Entries: {entries}\nFiles: {files}\nBytes: {bytes}'.format(
+                **removed))
+        else:
+            print('Removed {entries} cache entries and {files} files ({bytes} '
+                    'bytes).'.format(**removed))
+
+    def write_report(self, status):
+        """Write the JSON build report, if requested on the command line. It
+        contains the exit status and the statistics of the converter, see
+        gleetex.convenience.CachedConverter.get_statistics."""
+        if not self.__report_path:
+            return
+        report = {'gladtex': gleetex.VERSION, 'status': status}
+        if self.__converter:
+            report['statistics'] = self.__converter.get_statistics()
+            report['timeouts'] = self.__converter.get_timeout_statistics()
+        data = json.dumps(report, indent=2, sort_keys=True) + '\n'
+        if self.__report_path == '-':
+            sys.stderr.write(data)
+        else:
+            with open(self.__report_path, 'w', encoding='utf-8') as file:
+                file.write(data)
+        self.__report_path = None # write only once
+
+    def emit_profile(self, profiler, machine_readable):
+        """Print the report of the given profiler to stderr, either as JSON or
+        as a human-readable summary. The time out statistics of the converter
+        are included."""
+        timeouts = (self.__converter.get_timeout_statistics()
+                if self.__converter else {})
+        if machine_readable:
+            report = profiler.get_report()
+            report['timeouts'] = timeouts
+            sys.stderr.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+        else:
+            sys.stderr.write(profiler.format_report() + '\n')
+            for stage, stats in sorted(timeouts.items()):
+                sys.stderr.write('%s: %d run(s), %d time out(s), time out %.1f s\n'
+                        % (stage, stats['runs'], stats['timeouts'],
+                            stats['timeout']))
+
+    def write_html(self, file, processed, formatter, source=None):
+        """Write back altered HTML file with given formatter. The document is
+        assembled in memory and written with a single call.
+        If the parser returned text spans (see EqnParser), source is the parsed
+        buffer and file has to be a binary file. The formatted formulas are
+        encoded and the text is copied from the source as it is, without
+        decoding or assembling the document."""
+        with gleetex.profiling.measure('write_html'):
+            if source is not None:
+                self.__write_spans(file, processed, formatter, source)
+                return
+            parts = [None] * len(processed)
+            for index, chunk in enumerate(processed):
+                if isinstance(chunk, gleetex.htmlhandling.RenderedFormula):
+                    parts[index] = formatter.format(chunk.pos, chunk.formula,
+                            chunk.path, chunk.displaymath)
+                else:
+                    parts[index] = chunk
+            file.write(''.join(parts))
+
+    def __write_spans(self, file, processed, formatter, source):
+        encoded = {} # formatted formula : encoded formula
+        def parts(view):
+            for chunk in processed:
+                if isinstance(chunk, gleetex.htmlhandling.TextSpan):
+                    yield view[chunk.start:chunk.end]
+                elif isinstance(chunk, gleetex.htmlhandling.RenderedFormula):
+                    html = formatter.format(chunk.pos, chunk.formula,
+                            chunk.path, chunk.displaymath)
+                    data = encoded.get(html)
+                    if data is None:
+                        data = encoded[html] = html.encode(self.__encoding)
+                    yield data
+                else:
+                    yield chunk.encode(self.__encoding)
+        with memoryview(source) as view:
+            file.writelines(parts(view))
 
     def convert_images(self, parsed_htex_document, base_path, options):
         """Convert all formulas to images and store file path and equation in a
         list to be processed later on."""
         base_path = ('' if not base_path or base_path == '.' else base_path)
         result = []
-        try:
-            conv = gleetex.convenience.CachedConverter(base_path,
-                    not options.notkeepoldcache, encoding=self.__encoding)
-        except gleetex.caching.JsonParserException as e:
-            self.exit(e.args[0], 78)
-
-        self.set_options(conv, options)
+        conv = key = None
+        if self.__pool is not None:
+            key = (os.getcwd(), base_path, self.__encoding) + tuple(
+                    getattr(options, option) for option in CONVERTER_OPTIONS)
+            conv = self.__pool.get(key)
+        if not conv:
+            try:
+                conv = gleetex.convenience.CachedConverter(base_path,
+                        not options.notkeepoldcache, encoding=self.__encoding)
+            except gleetex.caching.JsonParserException as e:
+                self.exit(e.args[0], 78)
+            self.set_options(conv, options)
+            if self.__pool is not None:
+                # images might be removed between the runs
+                conv.set_strict_cache(True)
+                self.__pool.add(key, conv)
+        self.__converter = conv
         formulas = [c for c in parsed_htex_document if isinstance(c, (tuple,
             list))]
         try:
             conv.convert_all(base_path, formulas)
+        except gleetex.convenience.FormulaValidationException as e:
+            self.emit_latex_error(e.errors, options.machinereadable,
+                    options.replace_nonascii)
         except gleetex.convenience.ConversionException as e:
             self.emit_latex_error(e, options.machinereadable,
                     options.replace_nonascii)
 
-        # iterate over chunks of eqnparser
+        # iterate over chunks of eqnparser; recurring formulas share one
+        # RenderedFormula
+        rendered = {}
         for chunk in parsed_htex_document:
             # chunk == an entity parsed by EqnParser; type 'str' will be taken
             # literally, 'list' will be treated as formula
             if isinstance(chunk, (tuple, list)):
                 _p, displaymath, formula = chunk
-                try:
-                    data = conv.get_data_for(formula, displaymath)
-                except KeyError as e:
-                    raise KeyError(("formula '%s' not found; that means it was "
-                        "not converted which should usually not happen.") % e.args[0])
-                data['formula'] = formula
-                data['displaymath'] = displaymath
+                data = rendered.get((formula, displaymath))
+                if data is None:
+                    try:
+                        entry = conv.get_data_for(formula, displaymath)
+                    except KeyError as e:
+                        raise KeyError(("formula '%s' not found; that means it "
+                            "was not converted which should usually not "
+                            "happen.") % e.args[0])
+                    # the positioning dictionary is owned by the cache, which
+                    # might update it later on
+                    data = gleetex.htmlhandling.RenderedFormula(
+                            types.MappingProxyType(dict(entry['pos'])),
+                            entry['path'], formula, displaymath)
+                    rendered[(formula, displaymath)] = data
                 result.append(data)
             else:
                 result.append(chunk)
+        conv.write_cache() # persist outdated usage information, if any
         return result
 
 
@@ -265,15 +685,46 @@ class Main:
                 conv.set_option(option_str, tuple(map(float, option.split(','))))
         if options.replace_nonascii:
             conv.set_replace_nonascii(True)
+        if options.no_validation:
+            conv.set_validate_formulas(False)
+        for option_str in ['latex_timeout', 'dvipng_timeout']:
+            option = getattr(options, option_str)
+            if option:
+                conv.set_option(option_str, self.parse_timeout(option))
+        if options.remote_cache:
+            conv.set_remote_cache(gleetex.remotecache.get_backend(
+                options.remote_cache))
+
+    def parse_timeout(self, value):
+        """Turn the value of a time out command line option into a time out
+        policy. The value is a number of seconds, 'auto' or 'auto:SECONDS' for
+        an adaptive time out."""
+        if value.startswith('auto'):
+            initial = value.split(':')[1] if ':' in value else None
+            return gleetex.image.TimeoutPolicy((float(initial) if initial
+                else 20), adaptive=True)
+        return gleetex.image.TimeoutPolicy(float(value))
 
     def emit_latex_error(self, err, machine_readable, escape):
-        """Format a LaTeX error in a meaningful way. The argument escape
-        speicifies, whether the -R switch had been passed."""
+        """Format a LaTeX error (or a list of them) in a meaningful way and
+        exit. The argument escape speicifies, whether the -R switch had been
+        passed."""
+        errors = (err if isinstance(err, list) else [err])
         if 'DEBUG' in os.environ and os.environ['DEBUG'] == '1':
-            raise err
+            raise errors[0]
+        # separate multiple errors by a blank line
+        self.exit('\n\n'.join(self.format_latex_error(e, machine_readable,
+            escape) for e in errors), 91)
+
+    def format_latex_error(self, err, machine_readable, escape):
+        """Format a single LaTeX error and return it as a string, see
+        emit_latex_error."""
         escaped = err.formula
         if escape:
-            escaped = gleetex.document.escape_unicode_in_formulas(err.formula)
+            try:
+                escaped = gleetex.document.escape_unicode_in_formulas(err.formula)
+            except ValueError: # malformed formula, e.g. unbalanced braces
+                pass
         msg = None
         additional = ''
         if 'Package inputenc' in err.args[0]:
@@ -294,13 +745,13 @@ class Main:
                     err.formula else '')
             msg = "Error while converting formula %d at line %d, %d:\n" %\
                            (err.formula_count, err.src_line_number, err.src_pos_on_line,)
-            msg += '%s%s\n%s' % (formula, ('' if escaped == err.formula
+            msg += '%s%s\n%s' % (formula, ('' if not escaped
                 else '\nFormula without unicode symbols:\n%s' % escaped),
                    err.cause)
             if additional:
                 import textwrap
                 msg += ' undefined.\n' + '\n'.join(textwrap.wrap(additional, 80))
-        self.exit(msg, 91)
+        return msg
 
 
 if __name__ == '__main__':
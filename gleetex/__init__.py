@@ -3,8 +3,11 @@ from . import convenience
 from . import document
 from . import htmlhandling
 from . import image
+from . import profiling
+from . import remotecache
+from . import server
 
 VERSION = '2.3.1'
 
 __all__ = ['caching', 'convenience', 'document', 'htmlhandling', 'image',
-        'unicode', 'VERSION']
+        'profiling', 'remotecache', 'server', 'unicode', 'VERSION']
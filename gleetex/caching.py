@@ -13,6 +13,8 @@ Cache format:
                         'pos': { # positioning within the HTML document
                             'height': ..., 'width':..., 'depth:....
                         }
+                        'used': ..., # time stamp of last use (optional)
+                        'uses': ..., # number of lookups (optional)
                     }
                     }
             }
@@ -20,12 +22,54 @@ Cache format:
 
 Formulas are `normalized`, so spacing is unified to detect possibly equal
 formulas more easyly.
+
+On disk, the cache is stored gzip-compressed in a columnar layout: each entry
+is spread over parallel arrays, so that the keys are not repeated for each
+formula and the dimensions are stored as integers:
+
+    {'version': '3.0',
+     'formulas': [...], 'displaymath': [0 or 1, ...], 'paths': [...],
+     'depth': [...], 'height': [...], 'width': [...],
+     'used': [...], 'uses': [...]}
+
+Uncompressed caches in the format above (version 2.0) are still read and are
+converted on the next write.
+
+Several GladTeX processes may share one image directory: the cache is merged
+with the version on disk before it is written (see ImageCache.write) and image
+file names are claimed atomically, see claim_file_name.
 """
 
+import contextlib
+import gzip
 import json
 import os
+import re
+import secrets
+import time
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, the cache isn't locked there
+    fcntl = None
+
+from . import profiling
 
-CACHE_VERSION = '2.0'
+CACHE_VERSION = '3.0'
+# version of the uncompressed JSON cache, which can still be read
+LEGACY_CACHE_VERSION = '2.0'
+# columns of the on-disk format, apart from formula and path
+DIMENSIONS = ('depth', 'height', 'width')
+# first bytes of a gzip-compressed file
+GZIP_MAGIC = b'\x1f\x8b'
+# file names of images created by GladTeX
+IMAGE_FILE_NAME = re.compile(r'^eqn\d+\.png$')
+# the usage information of an entry (see ImageCache.write) is only written if
+# it's older than this many seconds
+USAGE_WRITE_INTERVAL = 24 * 3600
+# images modified within this many seconds might belong to a running
+# conversion, which hasn't added them to the cache yet
+ORPHAN_MIN_AGE = 3600
 
 def normalize_formula(formula):
     """This function normalizes a formula. This e.g. means that multiple white
@@ -54,6 +98,43 @@ def recover_bools(object):
         for item in object:
             recover_bools(item)
 
+def claim_file_name(pattern, start=0):
+    """Find the first number, starting from `start`, for which the file name
+    `pattern % number` doesn't exist and create an empty file with this name.
+    The file is created atomically, so concurrent processes never claim the
+    same name. The number and the file name are returned; the empty file is
+    meant to be overwritten by the image later."""
+    number = start
+    while True:
+        path = pattern % number
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                0o666))
+        except FileExistsError:
+            number += 1
+        else:
+            return (number, path)
+
+def create_temporary_file(directory):
+    """Create a new file with a unique name in the given directory, to be
+    renamed to its final name once written. Unlike tempfile.mkstemp, the file
+    gets the mode of other new files (0666 minus the umask), since caches and
+    images may be shared between users. Returned are the file descriptor and
+    the path."""
+    while True:
+        path = os.path.join(directory, '.gladtex-%s.tmp' % secrets.token_hex(6))
+        try:
+            return (os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY |
+                getattr(os, 'O_BINARY', 0), 0o666), path)
+        except FileExistsError:
+            pass
+
+def merge_entry(entry, other):
+    """Merge the usage information of two entries for the same formula; the
+    entry is altered in-place."""
+    entry['used'] = max(entry.get('used', 0), other.get('used', 0))
+    entry['uses'] = max(entry.get('uses', 0), other.get('uses', 0))
+
 class JsonParserException(Exception):
     """Specialized exception class for handling errors while parsing the JSON
     cache."""
@@ -65,6 +146,21 @@ class ImageCache:
     to be converted again. This is both a disk usage and performance
     improvement. The cache can be written and read from disk.
 
+    When the cache is read, the existence of all images is checked with one
+    directory listing per image directory. Entries whose image is missing are
+    dropped; afterwards lookups don't touch the file system. If the argument
+    strict is True, the existence of the image is checked on every lookup
+    instead, which is safer if images might be removed while the cache is in
+    use.
+
+    Writing the cache is safe if several processes use the same cache: the
+    cache directory is locked, entries added by other processes in the
+    meantime are merged in and the file is replaced atomically. Entries
+    removed by this instance are not merged back. The cache is only written if
+    entries were added or removed or if the recorded last use of an entry is
+    older than USAGE_WRITE_INTERVAL; the usage information is used for the
+    garbage collection, which doesn't need it more precisely.
+
     If the argument keep_old_cache is True, the cache will raise a
     JsonParserException if
     that file could not be read (i.e. incompatible GladTeX version). If set to
@@ -78,13 +174,22 @@ class ImageCache:
     assert len(cache) == 1 # one entry
     c.write()
     assert os.path.exists('gladtex.cache')
+
+    The cache counts lookups, see get_statistics().
     """
     VERSION_STR = 'GladTeX__cache__version'
 
-    def __init__(self, path='gladtex.cache', keep_old_cache=True):
+    def __init__(self, path='gladtex.cache', keep_old_cache=True, strict=False):
         self.__cache = {}
+        self.__strict = strict
         self.__set_version(CACHE_VERSION)
+        self.__changed = False # whether the cache needs to be written
         self.__path = path
+        self.__removed = set() # (formula, displaymath) removed by this instance
+        self.__disk_state = None # stat of the cache file when last read/written
+        self.__statistics = {'hits': {'inline': 0, 'displaymath': 0},
+                'misses': {'inline': 0, 'displaymath': 0}, 'stale': 0,
+                'bytes_written': 0}
         if os.path.exists(path):
             try:
                 self._read()
@@ -93,23 +198,141 @@ class ImageCache:
                     raise
                 else:
                     self._remove_old_cache_and_files()
+            else:
+                self._validate_entries()
 
     def __len__(self):
         """Return number of formulas in the cache."""
         # ignore version
         return len(self.__cache) - 1
 
+    def set_strict(self, flag):
+        """If set, the existence of an image is checked on each lookup."""
+        self.__strict = flag
+
+    def _validate_entries(self):
+        """Remove all entries whose image doesn't exist (anymore). Each image
+        directory is listed only once."""
+        with profiling.measure('cache_validate'):
+            listings = {}
+            def listing(directory):
+                if directory not in listings:
+                    try:
+                        listings[directory] = set(os.listdir(
+                            directory if directory else '.'))
+                    except OSError:
+                        listings[directory] = set()
+                return listings[directory]
+            # could be that the current working directory is different, so
+            # images next to the cache are fine as well
+            cache_directory = os.path.split(self.__path)[0]
+            for formula in list(self.__cache):
+                if formula == ImageCache.VERSION_STR:
+                    continue
+                value = self.__cache[formula]
+                for displaymath in list(value):
+                    directory, file_name = os.path.split(
+                            value[displaymath]['path'])
+                    if file_name not in listing(directory) and \
+                            file_name not in listing(cache_directory):
+                        del value[displaymath]
+                        self.__statistics['stale'] += 1
+                        self.__changed = True
+                if not value:
+                    del self.__cache[formula]
+
+    def get_statistics(self):
+        """Return a dictionary with statistics about the usage of the cache:
+        hits and misses of lookups (each a dictionary with the keys 'inline'
+        and 'displaymath'), the number of stale entries removed because their
+        image disappeared and the number of bytes written to the cache file."""
+        return {'hits': dict(self.__statistics['hits']),
+                'misses': dict(self.__statistics['misses']),
+                'stale': self.__statistics['stale'],
+                'bytes_written': self.__statistics['bytes_written']}
+
     def __set_version(self, version):
         """Set version of cache (data structure format)."""
         self.__cache[ImageCache.VERSION_STR] = version
+        self.__changed = True
 
     def write(self):
         """Write cache to disk. The file name will be the one configured during
-        initialisation of the cache."""
-        if len(self.__cache) == 0:
+        initialisation of the cache.
+        If the file was changed by another process since it was read, its
+        entries are merged into this cache first. Nothing is written if the
+        cache didn't change, see the class documentation."""
+        if not self.__changed:
+            return
+        with profiling.measure('cache_write'), self._lock():
+            self._merge_from_disk()
+            data = json.dumps(self._to_columns(), separators=(',', ':'))
+            # mtime=0 keeps the file identical if the cache didn't change
+            data = gzip.compress(data.encode('UTF-8'), mtime=0)
+            directory = os.path.split(self.__path)[0]
+            # write to a temporary file and rename it, so that readers never
+            # see a partially written cache
+            handle, tmp_fn = create_temporary_file(directory if directory
+                else '.')
+            try:
+                with os.fdopen(handle, 'wb') as file:
+                    file.write(data)
+                os.replace(tmp_fn, self.__path)
+            except OSError:
+                if os.path.exists(tmp_fn):
+                    os.remove(tmp_fn)
+                raise
+            self.__disk_state = self.__get_disk_state()
+            self.__statistics['bytes_written'] += len(data)
+            self.__changed = False
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Hold an exclusive lock on the cache directory. The directory is
+        locked instead of the cache file, because the cache file is replaced on
+        each write."""
+        if not fcntl:
+            yield
+            return
+        directory = os.path.split(self.__path)[0]
+        handle = os.open(directory if directory else '.', os.O_RDONLY)
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(handle) # releases the lock
+
+    def __get_disk_state(self):
+        """Return information to detect whether the cache file changed."""
+        try:
+            stat = os.stat(self.__path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _merge_from_disk(self):
+        """Merge the entries of the cache file into this cache, if it was
+        changed by another process. Entries removed from this cache are not
+        merged back. An unreadable file is ignored, it's overwritten anyway."""
+        state = self.__get_disk_state()
+        if state is None or state == self.__disk_state:
+            return
+        #pylint: disable=broad-except
+        try:
+            other = self._load()
+        except Exception:
             return
-        with open(self.__path, 'w', encoding='UTF-8') as file:
-            file.write(json.dumps(self.__cache))
+        for formula, value in other.items():
+            if formula == ImageCache.VERSION_STR:
+                continue
+            for displaymath, entry in value.items():
+                if (formula, displaymath) in self.__removed:
+                    continue
+                own = self.__cache.setdefault(formula, {})
+                if displaymath in own:
+                    merge_entry(own[displaymath], entry)
+                else:
+                    own[displaymath] = entry
 
     def _read(self):
         """Read Json from disk into cache, if file exists.
@@ -120,8 +343,10 @@ class ImageCache:
         if os.path.exists(self.__path):
             #pylint: disable=broad-except
             try:
-                with open(self.__path, 'r', encoding='utf-8') as file:
-                    self.__cache = json.load(file)
+                with profiling.measure('cache_read'):
+                    state = self.__get_disk_state()
+                    self.__cache = self._load()
+                    self.__disk_state = state
             except Exception as e:
                 msg = "error while reading cache from %s: " % os.path.abspath(self.__path)
                 if isinstance(e, (ValueError, OSError)):
@@ -132,15 +357,78 @@ class ImageCache:
                 else:
                     msg += str(e.args[0])
                 raise_error(msg)
-        if not isinstance(self.__cache, dict):
-            raise_error("Decoded Json is not a dictionary.")
-        if not self.__cache.get(ImageCache.VERSION_STR):
-            self.__set_version(CACHE_VERSION)
-        cur_version = self.__cache.get(ImageCache.VERSION_STR)
-        if cur_version != CACHE_VERSION:
-            raise_error("Cache in %s has version %s, expected %s." % \
-                    (self.__path, cur_version, CACHE_VERSION))
-        recover_bools(self.__cache)
+
+    def _load(self):
+        """Read and parse the cache file and return the cache dictionary.
+        :raises ValueError if the file doesn't contain a valid cache"""
+        with open(self.__path, 'rb') as file:
+            data = file.read()
+        if data.startswith(GZIP_MAGIC):
+            data = json.loads(gzip.decompress(data).decode('utf-8'))
+            return self._from_columns(data)
+        return self._read_legacy(data)
+
+    def _read_legacy(self, data):
+        """Parse an uncompressed cache (version 2.0) from the given bytes and
+        return the cache dictionary.
+        :raises ValueError if the data is not a valid cache"""
+        cache = json.loads(data.decode('utf-8'))
+        if not isinstance(cache, dict):
+            raise ValueError("Decoded Json is not a dictionary.")
+        version = cache.get(ImageCache.VERSION_STR, LEGACY_CACHE_VERSION)
+        if version != LEGACY_CACHE_VERSION:
+            raise ValueError("cache has version %s, expected %s" % (version,
+                LEGACY_CACHE_VERSION))
+        recover_bools(cache)
+        cache[ImageCache.VERSION_STR] = CACHE_VERSION
+        return cache
+
+    def _from_columns(self, data):
+        """Convert the columnar on-disk representation into the cache
+        dictionary.
+        :raises ValueError if the data is not a valid cache"""
+        if not isinstance(data, dict):
+            raise ValueError("Decoded Json is not a dictionary.")
+        if data.get('version') != CACHE_VERSION:
+            raise ValueError("cache has version %s, expected %s" % (
+                data.get('version'), CACHE_VERSION))
+        names = ('formulas', 'displaymath', 'paths', 'used', 'uses') + \
+                DIMENSIONS
+        if any(not isinstance(data.get(name), list) for name in names):
+            raise ValueError("cache lacks one of the columns " +
+                    ', '.join(names))
+        columns = [data[name] for name in names]
+        if any(len(column) != len(columns[0]) for column in columns):
+            raise ValueError("columns of the cache differ in length")
+        cache = {ImageCache.VERSION_STR: CACHE_VERSION}
+        for formula, displaymath, path, used, uses, *dims in zip(*columns):
+            cache.setdefault(formula, {})[bool(displaymath)] = {
+                    'pos': dict(zip(DIMENSIONS, dims)), 'path': path,
+                    'used': used, 'uses': uses}
+        return cache
+
+    def _to_columns(self):
+        """Return the columnar on-disk representation of the cache. The cache
+        may be modified by another thread meanwhile (see
+        gleetex.convenience.AsyncCachedConverter), hence copies of the
+        dictionaries are iterated."""
+        data = {'version': self.__cache[ImageCache.VERSION_STR],
+                'formulas': [], 'displaymath': [],
+                'paths': [], 'used': [], 'uses': []}
+        for dimension in DIMENSIONS:
+            data[dimension] = []
+        for formula, value in list(self.__cache.items()):
+            if formula == ImageCache.VERSION_STR:
+                continue
+            for displaymath, entry in list(value.items()):
+                data['formulas'].append(formula)
+                data['displaymath'].append(int(displaymath))
+                data['paths'].append(entry['path'])
+                data['used'].append(entry.get('used', 0))
+                data['uses'].append(entry.get('uses', 0))
+                for dimension in DIMENSIONS:
+                    data[dimension].append(int(entry['pos'][dimension]))
+        return data
 
     def _remove_old_cache_and_files(self):
         os.remove(self.__path)
@@ -183,7 +471,9 @@ class ImageCache:
             self.__cache[formula] = {}
         val = self.__cache[formula]
         if not displaymath in val:
-            val[displaymath] = {'pos' : pos, 'path' : file_path}
+            val[displaymath] = {'pos' : pos, 'path' : file_path,
+                    'used': int(time.time()), 'uses': 0}
+            self.__changed = True
 
     def remove_formula(self, formula, displaymath):
         """This method removes the given formula from the cache. A KeyError is
@@ -196,6 +486,8 @@ class ImageCache:
             value = self.__cache[formula]
             if displaymath in value:
                 del self.__cache[formula]
+                self.__removed.add((formula, displaymath))
+                self.__changed = True
             else:
                 raise KeyError("key %s (%s) not in cache" % (formula, displaymath))
 
@@ -208,14 +500,33 @@ class ImageCache:
             return False
 
 
-    def get_data_for(self, formula, displaymath):
+    def get_data_for(self, formula, displaymath, count=True):
         """
         Retrieve meta data about a formula from the cache.
 
         The meta information is used to embed the formula in the HTML document.
         It is a dictionary with the keys 'pos' and 'path'. The positioning info
         is described in the documentation of this class.
+        If `count` is False, neither the statistics nor the usage information
+        of the entry are updated, e.g. when a formula is looked up a second
+        time to write the document.
         This method raises a KeyError if the formula wasn't found."""
+        with profiling.measure('cache_lookup'):
+            style = ('displaymath' if displaymath else 'inline')
+            try:
+                data = self.__lookup(formula, displaymath, count)
+            except KeyError:
+                if not count:
+                    raise
+                self.__statistics['misses'][style] += 1
+                profiling.count('cache_misses')
+                raise
+            if count:
+                self.__statistics['hits'][style] += 1
+                profiling.count('cache_hits')
+            return data
+
+    def __lookup(self, formula, displaymath, count):
         formula = normalize_formula(formula)
         if not formula in self.__cache:
             raise KeyError(formula, displaymath)
@@ -223,11 +534,100 @@ class ImageCache:
             # check whether file still exists
             value = self.__cache[formula]
             if displaymath in value.keys():
-                if not os.path.exists(value[displaymath]['path']):
+                if self.__strict and not os.path.exists(
+                        value[displaymath]['path']):
                     del self.__cache[formula]
+                    self.__removed.add((formula, displaymath))
+                    self.__statistics['stale'] += 1
+                    self.__changed = True
                     raise KeyError((formula, displaymath))
-                else:
-                    return value[displaymath]
+                entry = value[displaymath]
+                if count:
+                    now = int(time.time())
+                    if entry.get('used', 0) < now - USAGE_WRITE_INTERVAL:
+                        self.__changed = True
+                    entry['used'] = now
+                    entry['uses'] = entry.get('uses', 0) + 1
+                return entry
             else:
                 raise KeyError((formula, displaymath))
 
+    def collect_garbage(self, max_bytes=None, max_entries=None,
+            remove_orphans=True):
+        """Remove cache entries and images which are not needed anymore.
+
+        If a budget is given, the least recently used entries (with the fewest
+        uses, if equally old) are removed together with their images, until
+        the images take at most `max_bytes` and the cache contains at most
+        `max_entries` entries. If `remove_orphans` is set, all eqn*.png files
+        in the cache directory which are not referenced by any entry are
+        removed as well, apart from empty files (names claimed by a running
+        conversion, see claim_file_name) and files modified within the last
+        ORPHAN_MIN_AGE seconds. The cache directory is locked meanwhile and
+        entries written by other processes are merged first, so that their
+        images aren't taken for orphans. The cache is not written back, call
+        write().
+        Returned is a dictionary with the number of removed 'entries',
+        'files' and 'bytes'."""
+        with self._lock():
+            self._merge_from_disk()
+            return self.__collect_garbage(max_bytes, max_entries,
+                    remove_orphans)
+
+    def __collect_garbage(self, max_bytes, max_entries, remove_orphans):
+        removed = {'entries': 0, 'files': 0, 'bytes': 0}
+        def remove_file(path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            removed['files'] += 1
+            removed['bytes'] += size
+        entries = [] # (last use, uses, formula, displaymath, path, size)
+        for formula, value in self.__cache.items():
+            if formula == ImageCache.VERSION_STR:
+                continue
+            for displaymath, entry in value.items():
+                try:
+                    size = os.path.getsize(entry['path'])
+                except OSError:
+                    size = 0
+                entries.append((entry.get('used', 0), entry.get('uses', 0),
+                    formula, displaymath, entry['path'], size))
+        entries.sort(key=lambda e: (e[0], e[1]))
+        total = sum(e[5] for e in entries)
+        count = len(entries)
+        for _used, _uses, formula, displaymath, path, size in entries:
+            if (max_bytes is None or total <= max_bytes) and \
+                    (max_entries is None or count <= max_entries):
+                break
+            del self.__cache[formula][displaymath]
+            if not self.__cache[formula]:
+                del self.__cache[formula]
+            self.__removed.add((formula, displaymath))
+            self.__changed = True
+            removed['entries'] += 1
+            remove_file(path)
+            total -= size
+            count -= 1
+        if remove_orphans:
+            directory = os.path.split(self.__path)[0]
+            referenced = set(os.path.basename(entry['path'])
+                    for formula, value in self.__cache.items()
+                    if formula != ImageCache.VERSION_STR
+                    for entry in value.values())
+            recent = time.time() - ORPHAN_MIN_AGE
+            for file_name in os.listdir(directory if directory else '.'):
+                if not IMAGE_FILE_NAME.match(file_name) or \
+                        file_name in referenced:
+                    continue
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size and stat.st_mtime < recent:
+                    remove_file(path)
+        return removed
+
@@ -2,12 +2,17 @@
 converter sacrifices customizability for convenience and provides a class
 converting a formula directly to a png file."""
 
+import asyncio
 import concurrent.futures
 import multiprocessing
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import weakref
 
-from . import caching, document, image
+from . import caching, document, image, profiling, remotecache
 from .caching import normalize_formula
 
 class ConversionException(Exception):
@@ -33,6 +38,32 @@ class ConversionException(Exception):
         self.src_pos_on_line = src_pos_on_line
         self.formula_count = formula_count
 
+def remove_directories(directories):
+    """Remove all directories from the given list (recursively) and empty the
+    list."""
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
+    directories.clear()
+
+def release_file_names(paths):
+    """Remove the empty files created to claim file names for images which
+    haven't been created (e.g. because the conversion failed)."""
+    for path in paths:
+        try:
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+        except OSError:
+            pass
+
+class FormulaValidationException(Exception):
+    """This exception is raised if formulas contain structural errors (e.g.
+    unbalanced braces), detected before LaTeX is run. The attribute `errors`
+    is a list of ConversionException instances, one for each error found."""
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("%d malformed formula(s) found:\n%s" % (len(errors),
+            '\n'.join(str(e) for e in errors)))
+
 class CachedConverter:
     """Convert formulas to images.
 
@@ -53,6 +84,15 @@ class CachedConverter:
         the program will instead remove the cache and all eqn* files and
         recreate the cache.
     :param encoding The encoding for the LaTeX document, default None
+
+    LaTeX and dvipng are run in a scratch directory per worker thread, which
+    is placed on a RAM-backed file system if available (see
+    gleetex.image.get_scratch_base). Only the final image is moved into the
+    target directory. Use set_scratch_base to change or disable this.
+
+    If a remote cache is set (see set_remote_cache), formulas which are not in
+    the local cache are fetched from there with one batched lookup before
+    LaTeX is run; formulas rendered locally are uploaded to it.
     """
     GLADTEX_CACHE_FILE_NAME = 'gladtex.cache'
     _converter = image.Tex2img # can be statically altered for testing purposes
@@ -67,24 +107,166 @@ class CachedConverter:
         self.__options = {'dpi' : None, 'transparency' : None,
                 'background_color' : None, 'foreground_color' : None,
                 'preamble' : None, 'latex_maths_env' : None,
-                'keep_latex_source': False}
+                'keep_latex_source': False,
+                'latex_timeout': image.TimeoutPolicy(),
+                'dvipng_timeout': image.TimeoutPolicy()}
         self.__encoding = encoding
         self.__replace_nonascii = False
+        self.__template = None # compiled lazily from the options above
+        self.__validate_formulas = True
+        self.__statistics = {'planned': 0, 'duplicates': 0,
+                'to_convert': {'inline': 0, 'displaymath': 0}, 'converted': 0,
+                'image_bytes_written': 0, 'coalesced': 0,
+                'remote': {'hits': 0, 'misses': 0, 'uploads': 0, 'errors': 0}}
+        self.__remote = None
+        self.__in_flight = {} # (formula, displaymath): Future, see _convert_coalesced
+        self.__flight_lock = threading.Lock()
+        self.__statistics_lock = threading.Lock() # updated by the workers
+        self.__scratch_base = image.get_scratch_base()
+        self.__scratch = threading.local() # scratch directory of each worker
+        self.__scratch_directories = []
+        self.__scratch_lock = threading.Lock()
+        # don't leave scratch directories behind if convert() was used directly
+        weakref.finalize(self, remove_directories, self.__scratch_directories)
 
 
     def set_option(self, option, value):
         """Set one of the options accepted for gleetex.image.Tex2img. `option`
         must be one of dpi, transparency, background_color, foreground_color,
-        preamble, latex_maths_env, keep_latex_source."""
+        preamble, latex_maths_env, keep_latex_source, latex_timeout,
+        dvipng_timeout. The time outs are either a number of seconds or a
+        gleetex.image.TimeoutPolicy; the policy is shared by all conversions,
+        so that an adaptive policy can learn from all of them."""
         if not option in self.__options.keys():
             raise ValueError("Option must be one of " + \
                     ', '.join(self.__options.keys()))
+        if option.endswith('_timeout') and not isinstance(value,
+                image.TimeoutPolicy):
+            value = image.TimeoutPolicy(value)
         self.__options[option] = value
+        self.__template = None
 
     def set_replace_nonascii(self, flag):
         """If set, GladTeX will convert all non-ascii character to LaTeX
-        commands. This setting is passed through to document.LaTeXDocument."""
+        commands. This setting is passed through to document.LaTeXTemplate."""
         self.__replace_nonascii = flag
+        self.__template = None
+
+    def set_validate_formulas(self, flag):
+        """If set (default), formulas are checked for structural errors like
+        unbalanced braces before LaTeX is run, see validate_formulas."""
+        self.__validate_formulas = flag
+
+    def set_strict_cache(self, flag):
+        """If set, the image cache checks the existence of an image on each
+        lookup, instead of only once when reading the cache, see
+        gleetex.caching.ImageCache."""
+        self.__cache.set_strict(flag)
+
+    def set_remote_cache(self, backend):
+        """Set a remote cache backend, e.g. gleetex.remotecache.HttpBackend or
+        DirectoryBackend; None disables the remote cache. Errors of the remote
+        cache are counted in the statistics, the formulas are rendered locally
+        instead."""
+        self.__remote = backend
+
+    def set_scratch_base(self, path):
+        """Set the directory in which the per-worker scratch directories are
+        created. If set to None, LaTeX is run in the target directory of the
+        images, as done by gleetex.image.Tex2img by default."""
+        self.__scratch_base = path
+
+    def _get_scratch_directory(self):
+        """Return the scratch directory of the calling worker thread, create it
+        if necessary. None is returned if scratch directories are disabled."""
+        if not self.__scratch_base:
+            return None
+        path = getattr(self.__scratch, 'path', None)
+        if not path or not os.path.isdir(path):
+            path = self._create_scratch_directory()
+            self.__scratch.path = path
+        return path
+
+    def _create_scratch_directory(self):
+        """Create a new scratch directory, which is removed by
+        remove_scratch_directories. If the calling worker belongs to a run of
+        convert_all, it's also recorded for that run, see
+        _convert_concurrently. None is returned if scratch directories are
+        disabled."""
+        if not self.__scratch_base:
+            return None
+        path = tempfile.mkdtemp(prefix='gladtex-', dir=self.__scratch_base)
+        with self.__scratch_lock:
+            self.__scratch_directories.append(path)
+            run = getattr(self.__scratch, 'run', None)
+            if run is not None:
+                run.append(path)
+        return path
+
+    def _join_run(self, directories):
+        """Record the scratch directories of the calling worker thread in the
+        given list; used as initializer of the worker threads of a run."""
+        self.__scratch.run = directories
+
+    def remove_scratch_directories(self, directories=None):
+        """Remove the given scratch directories or, by default, all created by
+        the workers so far. The given list is emptied."""
+        with self.__scratch_lock:
+            if directories is None:
+                directories = self.__scratch_directories
+            else:
+                self.__scratch_directories[:] = [d for d in
+                        self.__scratch_directories if d not in directories]
+            remove_directories(directories)
+
+    def get_statistics(self):
+        """Return a dictionary with statistics about the conversion:
+        -   'cache': statistics of the image cache, see
+            gleetex.caching.ImageCache.get_statistics
+        -   'planned': number of formulas passed to convert_all
+        -   'duplicates': formulas which occurred more than once and were only
+            converted once
+        -   'to_convert': formulas which weren't cached (split into 'inline'
+            and 'displaymath')
+        -   'converted': number of successfully converted formulas
+        -   'image_bytes_written': size of all created images
+        -   'coalesced': conversions which waited for the same formula being
+            converted by another thread
+        -   'remote': 'hits' and 'misses' of the remote cache, formulas
+            uploaded to it ('uploads') and failed requests ('errors')"""
+        stats = dict(self.__statistics)
+        stats['to_convert'] = dict(stats['to_convert'])
+        with self.__statistics_lock:
+            stats['remote'] = dict(stats['remote'])
+        stats['cache'] = self.__cache.get_statistics()
+        return stats
+
+    def get_timeout_statistics(self):
+        """Return a dictionary mapping the conversion stages 'latex' and
+        'dvipng' to the statistics of their time out policy, see
+        gleetex.image.TimeoutPolicy.get_statistics."""
+        return {stage: self.__options[stage + '_timeout'].get_statistics()
+                for stage in ('latex', 'dvipng')}
+
+    def _get_template(self):
+        """Return the LaTeX document template for the current configuration.
+        It is compiled on first use and reused until an option changes. A
+        ValueError is raised if the template cannot be compiled."""
+        template = self.__template
+        if not template:
+            template = document.LaTeXTemplate(encoding=self.__encoding,
+                    preamble=self.__options['preamble'],
+                    maths_env=self.__options['latex_maths_env'],
+                    replace_nonascii=self.__replace_nonascii)
+            self.__template = template
+        return template
+
+    def _get_fingerprint(self, formula, displaymath):
+        """Return the key of a formula in the remote cache, computed from the
+        LaTeX document and the image options."""
+        return remotecache.fingerprint(self._get_template().format(formula,
+            displaymath), [self.__options[option] for option in ('dpi',
+                'transparency', 'background_color', 'foreground_color')])
 
 
     def convert_all(self, base_path, formulas):
@@ -92,16 +274,81 @@ class CachedConverter:
         Convert all formulas using self.convert concurrently. Each element of
         `formulas` must be a tuple containing (formula, displaymath,
         Formulas already contained in the cache are not converted.
+        Before any formula is converted, all formulas to convert are checked
+        for structural errors (if enabled) and a FormulaValidationException
+        with all errors found is raised.
         """
         formulas_to_convert = self._get_formulas_to_convert(base_path, formulas)
-        self._convert_concurrently(formulas_to_convert)
+        try:
+            if self.__validate_formulas:
+                self.validate_formulas(formulas_to_convert)
+            if self.__remote:
+                formulas_to_convert = self._fetch_remote(formulas_to_convert)
+            self._convert_concurrently(formulas_to_convert)
+        finally:
+            release_file_names(path for _f, _p, path, _d, _c in
+                    formulas_to_convert)
+
+    def validate_formulas(self, formulas_to_convert):
+        """Check all given formulas for structural errors without running LaTeX,
+        see gleetex.document.find_structural_errors. The formulas are expected
+        in the format returned by _get_formulas_to_convert. If errors are
+        found, a FormulaValidationException is raised, containing all of
+        them."""
+        errors = []
+        for formula, pos, _path, _dsp, count in formulas_to_convert:
+            for index, message in document.find_structural_errors(formula):
+                # lines and positions are expected to count from 1
+                errors.append(ConversionException("%s (character %d of the "
+                    "formula)" % (message, index + 1), formula, pos[0] + 1,
+                    pos[1] + 1, count))
+        if errors:
+            raise FormulaValidationException(errors)
+
+    def _fetch_remote(self, formulas_to_convert):
+        """Look up all given formulas in the remote cache with one batched
+        request, write the images found and add them to the cache. The
+        formulas which still need to be converted are returned. If the lookup
+        fails, the remote cache is disabled for this converter."""
+        keys = [self._get_fingerprint(formula, dsp)
+                for formula, _pos, _path, dsp, _count in formulas_to_convert]
+        try:
+            with profiling.measure('remote_fetch'):
+                records = self.__remote.get_many(set(keys))
+        except remotecache.RemoteCacheError:
+            # don't wait for an unreachable cache on each upload
+            self.__statistics['remote']['errors'] += 1
+            self.__remote = None
+            return formulas_to_convert
+        remaining = []
+        for key, entry in zip(keys, formulas_to_convert):
+            formula, _pos, path, dsp, _count = entry
+            try:
+                pos, data = remotecache.decode_record(records[key])
+                with open(path, 'wb') as file:
+                    file.write(data)
+            except KeyError:
+                self.__statistics['remote']['misses'] += 1
+                remaining.append(entry)
+            except (remotecache.RemoteCacheError, OSError):
+                self.__statistics['remote']['errors'] += 1
+                remaining.append(entry)
+            else:
+                self.__cache.add_formula(formula, pos, path, dsp)
+                self.__statistics['remote']['hits'] += 1
+        if len(remaining) < len(formulas_to_convert):
+            self.__cache.write()
+        return remaining
 
     def _get_formulas_to_convert(self, base_path, formulas):
         """Return a list of formulas to convert, along with their count in the
         global list of formulas of the document being converted and the file
-        name. Function was decomposed for better testability."""
+        name. Function was decomposed for better testability.
+        The file names are claimed by creating empty files, so that concurrent
+        GladTeX processes don't pick the same names, see
+        gleetex.caching.claim_file_name and release_file_names."""
         formulas_to_convert = [] # find as many file names as equations
-        eqn_path = lambda x: os.path.join(base_path, 'eqn%03d.png' % x)
+        eqn_path = os.path.join(base_path, 'eqn%03d.png')
 
         # is (formula, display_math) already in the list of formulas to convert;
         # displaymath is important since formulas look different in inline maths
@@ -109,16 +356,19 @@ class CachedConverter:
                 ((normalize_formula(u[0]), u[3]) for u in formulas_to_convert)
         # find enough free file names
         file_name_count = 0
-        used_file_names = [] # track which file names have been assigned
         for formula_count, (pos, dsp, formula) in enumerate(formulas):
-            if not self.__cache.contains(formula, dsp) and \
-                    not formula_was_converted(formula, dsp):
-                while os.path.exists(eqn_path(file_name_count)) or \
-                    eqn_path(file_name_count) in used_file_names:
-                    file_name_count += 1
-                used_file_names.append(eqn_path(file_name_count))
-                formulas_to_convert.append((formula, pos, eqn_path(file_name_count),
-                    dsp, formula_count + 1))
+            self.__statistics['planned'] += 1
+            if self.__cache.contains(formula, dsp):
+                continue
+            if formula_was_converted(formula, dsp):
+                self.__statistics['duplicates'] += 1
+            else:
+                self.__statistics['to_convert'][('displaymath' if dsp
+                    else 'inline')] += 1
+                file_name_count, path = caching.claim_file_name(eqn_path,
+                        file_name_count)
+                formulas_to_convert.append((formula, pos, path, dsp,
+                    formula_count + 1))
         return formulas_to_convert
 
 
@@ -130,39 +380,75 @@ class CachedConverter:
         # it (gladtex might be in turn run in parallel on a machine)
         thread_count = int(multiprocessing.cpu_count() * 2.5)
         # convert missing formulas
-        with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
-            # start conversion and mark each thread with its formula, position
-            # in the source file and formula_count (index into a global list of
-            # formulas)
-            jobs = {executor.submit(self.convert, eqn, path, dsp): (eqn, pos, count)
-                for (eqn, pos, path, dsp, count) in formulas_to_convert}
-            error_occurred = None
-            for future in concurrent.futures.as_completed(jobs):
-                if error_occurred and not future.done():
-                    future.cancel()
-                    continue
-                formula, pos_in_src, formula_count = jobs[future]
-                try:
-                    data = future.result()
-                except subprocess.SubprocessError as e:
-                    if 'inputenc Error' in e.args[0]:
-                        print("piep")
-                    # retrieve the position (line, pos on line) in the source
-                    # document from original formula list
-                    pos_in_src = list(p+1 for p in pos_in_src) # user expects lines/pos_in_src' to count from 1
-                    self.__cache.write() # write back cache with valid entries
-                    error_occurred = ConversionException(str(e.args[0]), formula,
-                            pos_in_src[0], pos_in_src[1], formula_count)
-                else:
-                    self.__cache.add_formula(formula, data['pos'], data['path'],
-                            data['displaymath'])
-                    self.__cache.write()
-            #pylint: disable=raising-bad-type
-            if error_occurred:
-                raise error_occurred
+        jobs = {}
+        # the scratch directories of this run only; the converter might be
+        # shared with other runs, e.g. by the server
+        scratch_directories = []
+        try:
+            with profiling.measure('conversion'), \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=thread_count,
+                        initializer=self._join_run,
+                        initargs=(scratch_directories,)) as executor:
+                # start conversion and mark each thread with its formula, position
+                # in the source file and formula_count (index into a global list of
+                # formulas)
+                jobs.update((executor.submit(self._convert_coalesced, eqn, path,
+                    dsp), (eqn, pos, count))
+                    for (eqn, pos, path, dsp, count) in formulas_to_convert)
+                error_occurred = None
+                pending = len(jobs)
+                for future in concurrent.futures.as_completed(jobs):
+                    pending -= 1
+                    profiling.gauge('conversion_queue', pending)
+                    if error_occurred and not future.done():
+                        future.cancel()
+                        continue
+                    formula, pos_in_src, formula_count = jobs[future]
+                    try:
+                        _flight, data = future.result()
+                    except subprocess.SubprocessError as e:
+                        if 'inputenc Error' in e.args[0]:
+                            print("piep")
+                        # retrieve the position (line, pos on line) in the source
+                        # document from original formula list
+                        pos_in_src = list(p+1 for p in pos_in_src) # user expects lines/pos_in_src' to count from 1
+                        self.__cache.write() # write back cache with valid entries
+                        error_occurred = ConversionException(str(e.args[0]), formula,
+                                pos_in_src[0], pos_in_src[1], formula_count)
+                    else:
+                        self._add_to_cache(formula, data)
+                #pylint: disable=raising-bad-type
+                if error_occurred:
+                    raise error_occurred
+        finally:
+            self.remove_scratch_directories(scratch_directories)
+            # conversions which weren't added to the cache (e.g. because of an
+            # unexpected error) mustn't stay in flight, see _convert_coalesced
+            for future, (formula, _pos, _count) in jobs.items():
+                if future.done() and not future.cancelled() and \
+                        not future.exception():
+                    flight, data = future.result()
+                    self.__land((normalize_formula(formula),
+                        data['displaymath']), flight)
 
 
 
+    def _add_to_cache(self, formula, data, write=True):
+        """Add a converted formula to the cache (data as returned by convert())
+        and write the cache, unless `write` is False."""
+        self.__cache.add_formula(formula, data['pos'], data['path'],
+                data['displaymath'])
+        if write:
+            self.__cache.write()
+        # cached now, see _convert_coalesced
+        self.__land((normalize_formula(formula), data['displaymath']))
+        self.__statistics['converted'] += 1
+        try:
+            self.__statistics['image_bytes_written'] += \
+                    os.path.getsize(data['path'])
+        except OSError:
+            pass
+
     def convert(self, formula, output_path, displaymath=False):
         """convert(formula, output_path, displaymath=False)
         Convert given formula with displaymath/inlinemath.
@@ -175,19 +461,67 @@ class CachedConverter:
         :return dictionary with position (pos), image path (path) and formula
             style (displaymath, boolean) as a dictionary with the keys in
             parenthesis
+
+        If the same formula is converted by several threads at once, only the
+        first one runs LaTeX, the others wait for it and get the same result
+        (so their output_path is unused).
         """
-        latex = document.LaTeXDocument(formula)
-        latex.set_displaymath(displaymath)
-        if self.__options['preamble']: # add preamble to LaTeX document
-            latex.set_preamble_string(self.__options['preamble'])
-        if self.__options['latex_maths_env']:
-            latex.set_latex_environment(self.__options['latex_maths_env'])
-        if self.__encoding:
-            latex.set_encoding(self.__encoding)
-        if self.__replace_nonascii:
-            latex.set_replace_nonascii(True)
+        flight, data = self._convert_coalesced(formula, output_path,
+                displaymath)
+        self.__land((normalize_formula(formula), displaymath), flight)
+        return data
+
+    def _convert_coalesced(self, formula, output_path, displaymath):
+        """Convert a formula like convert(), but keep a successful conversion
+        in flight, so that it isn't converted again until it's added to the
+        cache; _add_to_cache forgets it then. Returned is a tuple with the
+        future of the conversion and its result."""
+        key = (normalize_formula(formula), displaymath)
+        with self.__flight_lock:
+            flight = self.__in_flight.get(key)
+            leading = flight is None
+            if leading:
+                flight = concurrent.futures.Future()
+                self.__in_flight[key] = flight
+        if not leading:
+            with self.__statistics_lock:
+                self.__statistics['coalesced'] += 1
+            profiling.count('coalesced')
+            return (flight, flight.result())
         try:
-            latex_str = str(latex)
+            data = self._render(formula, output_path, displaymath)
+        except BaseException as e:
+            self.__land(key, flight)
+            flight.set_exception(e)
+            raise
+        flight.set_result(data)
+        return (flight, data)
+
+    def __land(self, key, flight=None):
+        """Forget the conversion of a formula, given as key for __in_flight; if
+        a flight is given, only if it's still the current one."""
+        with self.__flight_lock:
+            if flight is None or self.__in_flight.get(key) is flight:
+                self.__in_flight.pop(key, None)
+
+    def _render(self, formula, output_path, displaymath):
+        """Run LaTeX and dvipng for a formula, see convert()."""
+        conv = self._create_converter(formula, output_path, displaymath)
+        if hasattr(conv, 'set_scratch_directory'):
+            conv.set_scratch_directory(self._get_scratch_directory())
+        with profiling.measure('render', formula=formula):
+            conv.convert()
+        pos = conv.get_positioning_info()
+        if self.__remote:
+            self._store_remote(formula, displaymath, pos, output_path)
+        return {'pos' : pos, 'path' : output_path, 'displaymath' :
+            displaymath}
+
+    def _create_converter(self, formula, output_path, displaymath):
+        """Return a converter (see gleetex.image.Tex2img) for the given
+        formula, configured with the options of this instance."""
+        try:
+            latex_str = self._get_template().format(formula, displaymath)
         except ValueError as e: # propagate error
             raise ConversionException(e.args[0], formula, 0, 0, 0)
         conv = self._converter(latex_str, output_path)
@@ -195,12 +529,150 @@ class CachedConverter:
         for option, value in self.__options.items():
             if value and hasattr(conv, 'set_' + option):
                 getattr(conv, 'set_' + option)(value)
-        conv.convert()
-        pos = conv.get_positioning_info()
-        return {'pos' : pos, 'path' : output_path, 'displaymath' :
-            displaymath}
+        return conv
+
+    def _store_remote(self, formula, displaymath, pos, path):
+        """Upload a converted formula to the remote cache. This is called from
+        the worker threads; failures are only counted."""
+        try:
+            with open(path, 'rb') as file:
+                record = remotecache.encode_record(pos, file.read())
+            with profiling.measure('remote_store'):
+                self.__remote.put(self._get_fingerprint(formula, displaymath),
+                        record)
+        except OSError: # includes RemoteCacheError
+            outcome = 'errors'
+        else:
+            outcome = 'uploads'
+        with self.__statistics_lock:
+            self.__statistics['remote'][outcome] += 1
+
+    def write_cache(self):
+        """Write the cache back to disk, e.g. to persist the usage information
+        of the entries after all formulas have been looked up. Nothing is
+        written if the cache didn't change, see gleetex.caching.ImageCache."""
+        self.__cache.write()
+
+    def get_data_for(self, formula, display_math, count=False):
+        """Simple wrapper around ImageCache.get_data_for. The lookup is only
+        counted in the statistics if `count` is set, since formulas are
+        usually looked up when planning the conversion already (see
+        convert_all) and again when writing the document."""
+        return self.__cache.get_data_for(formula, display_math, count)
+
+
+class AsyncCachedConverter(CachedConverter):
+    """Asyncio variant of the CachedConverter, e.g. for services which convert
+    formulas on request. All options of the CachedConverter apply, apart from
+    the remote cache.
+
+    c = AsyncCachedConverter('img', concurrency=4)
+    data = await c.convert_formula('\\tau', displaymath=False, timeout=10)
+    data['path'], data['pos']
+    ...
+    c.close()
+
+    At most `concurrency` formulas (default: number of processors) are
+    converted at once, each in a scratch directory of its own. The
+    subprocesses are run by asyncio, see gleetex.image.Tex2img.convert_async.
+    Concurrent requests for the same formula are coalesced into one
+    conversion. If a request times out or is cancelled, the conversion is only
+    cancelled if no other request waits for it.
+    """
+    def __init__(self, base_path, keep_old_cache=True, encoding=None,
+            concurrency=None):
+        super().__init__(base_path, keep_old_cache=keep_old_cache,
+                encoding=encoding)
+        self.__base_path = base_path
+        self.__concurrency = (concurrency if concurrency else
+                multiprocessing.cpu_count())
+        self.__semaphore = None # created on first use, within the event loop
+        self.__write_lock = None # likewise, see __write_cache
+        self.__unwritten = 0 # formulas added to the cache since the last write
+        self.__in_flight = {} # (formula, displaymath): [task, waiting requests]
+        self.__file_name_count = 0
+        self.__free_scratch = [] # scratch directories not in use
+
+    async def convert_formula(self, formula, displaymath=False, timeout=None):
+        """Return the cache entry (a dictionary with 'pos' and 'path') for the
+        given formula, converting it if necessary. If a timeout (in seconds) is
+        given, asyncio.TimeoutError is raised when it expires. A failed
+        conversion raises a ConversionException."""
+        try:
+            return self.get_data_for(formula, displaymath, count=True)
+        except KeyError:
+            pass
+        key = (normalize_formula(formula), displaymath)
+        flight = self.__in_flight.get(key)
+        if not flight:
+            task = asyncio.ensure_future(self.__convert(formula, displaymath))
+            flight = [task, 0]
+            self.__in_flight[key] = flight
+            task.add_done_callback(lambda _task: self.__land(key, flight))
+        else:
+            profiling.count('coalesced')
+        flight[1] += 1
+        try:
+            # shield the conversion, other requests might wait for it as well
+            return await asyncio.wait_for(asyncio.shield(flight[0]), timeout)
+        finally:
+            flight[1] -= 1
+            if not flight[1] and not flight[0].done():
+                flight[0].cancel()
+
+    def __land(self, key, flight):
+        """Forget a finished conversion."""
+        if self.__in_flight.get(key) is flight:
+            del self.__in_flight[key]
+
+    async def convert_all_async(self, formulas, timeout=None):
+        """Convert all formulas concurrently and return their cache entries in
+        the same order. The formulas are expected in the format of
+        convert_all, (pos, displaymath, formula)."""
+        return await asyncio.gather(*(self.convert_formula(formula, dsp,
+            timeout) for _pos, dsp, formula in formulas))
+
+    async def __convert(self, formula, displaymath):
+        if not self.__semaphore:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        async with self.__semaphore:
+            self.__file_name_count, path = caching.claim_file_name(
+                    os.path.join(self.__base_path, 'eqn%03d.png'),
+                    self.__file_name_count)
+            scratch = (self.__free_scratch.pop() if self.__free_scratch
+                    else self._create_scratch_directory())
+            try:
+                conv = self._create_converter(formula, path, displaymath)
+                if hasattr(conv, 'set_scratch_directory'):
+                    conv.set_scratch_directory(scratch)
+                with profiling.measure('render', formula=formula):
+                    await conv.convert_async()
+            except subprocess.SubprocessError as e:
+                raise ConversionException(str(e.args[0]), formula, 0, 0, 0)
+            finally:
+                release_file_names([path])
+                if scratch:
+                    self.__free_scratch.append(scratch)
+            self._add_to_cache(formula, {'pos': conv.get_positioning_info(),
+                'path': path, 'displaymath': displaymath}, write=False)
+        await self.__write_cache()
+        return self.get_data_for(formula, displaymath)
 
-    def get_data_for(self, formula, display_math):
-        """Simple wrapper around ImageCache."""
-        return self.__cache.get_data_for(formula, display_math)
+    async def __write_cache(self):
+        """Write the cache in a thread, so that the event loop isn't blocked
+        by the file lock and the compression. Formulas converted while a write
+        is running are written together by the next one."""
+        if not self.__write_lock:
+            self.__write_lock = asyncio.Lock()
+        self.__unwritten += 1
+        async with self.__write_lock:
+            if self.__unwritten: # otherwise written while waiting for the lock
+                self.__unwritten = 0
+                await asyncio.get_running_loop().run_in_executor(None,
+                        self.write_cache)
 
+    def close(self):
+        """Remove the scratch directories; call it when the converter isn't
+        used anymore."""
+        self.__free_scratch.clear()
+        self.remove_scratch_directories()
@@ -5,6 +5,8 @@ non-ascii characters, so that formulas with unicode math or umlauts, etc. can be
 converted.
 """
 
+import re
+
 from . import unicode
 
 class DocumentSerializationException(Exception):
@@ -124,6 +126,104 @@ def get_matching_brace(string, pos_of_opening_brace):
     if counter != 0:
         raise ValueError("Unbalanced braces in formula " + repr(string))
 
+# escaped characters, which must not be treated as structure, and comments
+_ESCAPED_OR_COMMENT = re.compile(r'\\[\\{}%]|%[^\n]*')
+_STRUCTURE = re.compile(r'[{}]|\\(left|right|begin|end)(?![a-zA-Z])')
+_ENV_NAME = re.compile(r'\s*\{([^{}]*)\}')
+
+def find_structural_errors(formula):
+    """Check a formula for structural errors which would make LaTeX fail
+    without running it. These are unbalanced braces, \\left without \\right
+    (and vice versa) and unclosed or mismatched environments. Escaped
+    characters and comments are ignored.
+    Returned is a list of (index, message) tuples, index being the position of
+    the error within the formula; the list is empty for a correct formula."""
+    # mask escaped characters and comments, keeping all indices intact
+    masked = _ESCAPED_OR_COMMENT.sub(lambda m: ' ' * len(m.group(0)), formula)
+    errors = []
+    delimiters = [] # stack of \\left indices
+    environments = [] # stack of (index, name) of \\begin
+    group_end = -1 # index of the closing brace of the current top-level group
+    pos = 0
+    match = _STRUCTURE.search(masked, pos)
+    while match:
+        index = match.start()
+        token = match.group(0)
+        pos = match.end()
+        if token == '{':
+            # braces within a checked group are balanced, only check top-level
+            # groups
+            if index > group_end:
+                try:
+                    group_end = get_matching_brace(masked, index)
+                except ValueError:
+                    errors.append((index, "opening brace is never closed"))
+        elif token == '}':
+            if index > group_end:
+                errors.append((index, "closing brace without opening brace"))
+        elif token == '\\left':
+            delimiters.append(index)
+        elif token == '\\right':
+            if delimiters:
+                delimiters.pop()
+            else:
+                errors.append((index, "\\right without preceding \\left"))
+        else: # \\begin or \\end
+            name = _ENV_NAME.match(masked, pos)
+            name = (name.group(1).strip() if name else None)
+            if not name:
+                errors.append((index, "%s without environment name" % token))
+            elif token == '\\begin':
+                environments.append((index, name))
+            elif not environments:
+                errors.append((index, "\\end{%s} without \\begin{%s}" % (name,
+                    name)))
+            else:
+                begin, expected = environments.pop()
+                if expected != name:
+                    errors.append((index, "\\end{%s} closes \\begin{%s}" % (
+                        name, expected)))
+        match = _STRUCTURE.search(masked, pos)
+    errors.extend((index, "\\left without matching \\right")
+            for index in delimiters)
+    errors.extend((index, "\\begin{%s} is never closed" % name)
+            for index, name in environments)
+    return sorted(errors)
+
+
+def get_inputenc_name(encoding):
+    """Map an encoding name as found in an HTML document (e.g. `UTF-8` or
+    `iso-8859-1`) to the name used by the inputenc package. A ValueError is
+    raised for unsupported encodings."""
+    if encoding.lower().startswith('utf') and '8' in encoding:
+        return 'utf8'
+    elif (encoding.lower().startswith('iso') and '8859' in encoding) or \
+            encoding.lower() == 'latin1':
+        return 'latin1'
+    # if you plan to add an encoding, you have to adjust the str
+    # function, which also loads the  fontenc package
+    raise ValueError(("Encoding %s is not supported at the moment. If "
+        "you want to use LaTeX 2e, you should report a bug at the home "
+        "page of GladTeX.") % encoding)
+
+def get_fontenc_preamble():
+    """Return the preamble lines loading the fontenc package. The character set
+    is guessed from the language of the current locale; a ValueError is raised
+    if that language is not covered by T1."""
+    # try to guess language and hence character set (fontenc)
+    import locale
+    language = locale.getdefaultlocale()
+    if language and language[0]: # extract just the language code
+        language = language[0].split('_')[0]
+    if not language or not language[0]:
+        language = 'en'
+    # check whether language on computer is within T1 and hence whether
+    # it should be loaded; I know that this can be a misleading
+    # assumption, but there's no better way that I know of
+    if language in ['fr', 'es', 'it', 'de', 'nl', 'ro', 'en']:
+        return '\n\\usepackage[T1]{fontenc}'
+    raise ValueError(("Language not supported by T1 fontenc "
+        "encoding; please report this to the GladTeX project."))
 
 
 class LaTeXDocument:
@@ -160,17 +260,7 @@ class LaTeXDocument:
 
     def set_encoding(self, encoding):
         """Set the encoding as used by the inputenc package."""
-        if encoding.lower().startswith('utf') and '8' in encoding:
-            self.__encoding = 'utf8'
-        elif (encoding.lower().startswith('iso') and '8859' in encoding) or \
-                encoding.lower() == 'latin1':
-            self.__encoding = 'latin1'
-        else:
-            # if you plan to add an encoding, you have to adjust the str
-            # function, which also loads the  fontenc package
-            raise ValueError(("Encoding %s is not supported at the moment. If "
-                "you want to use LaTeX 2e, you should report a bug at the home "
-                "page of GladTeX.") % encoding)
+        self.__encoding = get_inputenc_name(encoding)
 
     def set_displaymath(self, flag):
         """Set whether the formula is set in displaymath."""
@@ -189,24 +279,7 @@ class LaTeXDocument:
             if not self.__encoding:
                 raise ValueError(("No encoding set, but non-ascii characters "
                         "present. Please specify an encoding."))
-        encoding_preamble = ''
-        if self.__encoding:
-            # try to guess language and hence character set (fontenc)
-            import locale
-            language = locale.getdefaultlocale()
-            if language and language[0]: # extract just the language code
-                language = language[0].split('_')[0]
-            if not language or not language[0]:
-                language = 'en'
-            # check whether language on computer is within T1 and hence whether
-            # it should be loaded; I know that this can be a misleading
-            # assumption, but there's no better way that I know of
-            if language in ['fr', 'es', 'it', 'de', 'nl', 'ro', 'en']:
-                encoding_preamble += '\n\\usepackage[T1]{fontenc}'
-            else:
-                raise ValueError(("Language not supported by T1 fontenc "
-                    "encoding; please report this to the GladTeX project."))
-        return encoding_preamble
+        return (get_fontenc_preamble() if self.__encoding else '')
 
     def __str__(self):
         preamble = self._get_encoding_preamble() + \
@@ -235,3 +308,49 @@ class LaTeXDocument:
             "\\end{document}\n") % (preamble, opening, formula, closing)
 
 
+class LaTeXTemplate:
+    """A LaTeX document skeleton which is compiled once and then filled with
+    formulas. The preamble, including the encoding and font encoding decision,
+    is frozen upon construction, so that formatting a formula is a single
+    string substitution. The output is the same as the one of a LaTeXDocument
+    configured with the same settings.
+
+    t = LaTeXTemplate(encoding='utf-8', preamble='\\usepackage{eurosym}')
+    tex = t.format('\\tau', displaymath=True)
+
+    A ValueError is raised if the encoding is not supported or if the font
+    encoding cannot be determined."""
+    def __init__(self, encoding=None, preamble=None, maths_env=None,
+            replace_nonascii=False):
+        self.__encoding = (get_inputenc_name(encoding) if encoding else None)
+        self.__replace_nonascii = replace_nonascii
+        # the fontenc decision only depends on the locale, hence it's frozen
+        # together with the rest of the preamble
+        full_preamble = (get_fontenc_preamble() if self.__encoding else '') + \
+                ('\n\\usepackage[utf8]{inputenc}\n\\usepackage{amsmath, amssymb}'
+                '\n') + (preamble if preamble else '')
+        head = ("\\documentclass[fontsize=12pt, fleqn]{scrartcl}\n\n%s\n"
+            "\\usepackage[active,textmath,displaymath,tightpage]{preview} "
+            "%% must be last one, see doc\n\n\\begin{document}\n"
+            "\\noindent%%\n") % full_preamble
+        # escape the head, the formula and its delimiters are substituted later
+        self.__template = head.replace('%', '%%') + '%s%s%s\n\\end{document}\n'
+        if maths_env:
+            env = ('\\begin{%s}' % maths_env, '\\end{%s}' % maths_env)
+            self.__delimiters = {True: env, False: env}
+        else:
+            self.__delimiters = {True: ('\\[', '\\]'), False: ('\\(', '\\)')}
+
+    def format(self, formula, displaymath=False):
+        """Return the full LaTeX document for the given formula. A ValueError
+        is raised if the formula contains non-ascii characters, but neither an
+        encoding nor the replacement of non-ascii characters was configured."""
+        if not self.__encoding and not self.__replace_nonascii and \
+                any(ord(ch) > 128 for ch in formula):
+            raise ValueError(("No encoding set, but non-ascii characters "
+                    "present. Please specify an encoding."))
+        formula = formula.lstrip().rstrip()
+        if self.__replace_nonascii:
+            formula = escape_unicode_in_formulas(formula, replace_alphabeticals=True)
+        opening, closing = self.__delimiters[displaymath]
+        return self.__template % (opening, formula, closing)
@@ -1,14 +1,19 @@
 """Everything regarding parsing, generating and writing HTML belongs in here."""
 
+import codecs
 import collections
 import enum
+import functools
+import hashlib
 import html.parser
+import json
 import os
 import posixpath
 import re
+import sys
 
 
-from . import document
+from . import document, profiling
 
 
 class ParseException(Exception):
@@ -41,128 +46,228 @@ def find_anycase(where, what):
     else:
         return upper
 
+class FormulaChunk(collections.namedtuple('FormulaChunk',
+        'pos displaymath formula')):
+    """A formula found by the EqnParser: the position as tuple (line, column),
+    both counted from 0, whether it is display maths and the formula. It is a
+    tuple without per-instance dictionary, so it can still be unpacked."""
+    __slots__ = ()
+
+class RenderedFormula(collections.namedtuple('RenderedFormula',
+        'pos path formula displaymath')):
+    """A converted formula, ready to be formatted: positioning information (a
+    read-only copy of the one returned by the cache, see caching.ImageCache,
+    e.g. a types.MappingProxyType), path of the image, the formula and whether
+    it is display maths. It is immutable, so that all occurrences of a formula
+    in a document can share one instance."""
+    __slots__ = ()
+
+def is_ascii_transparent(encoding):
+    """Return whether the given encoding represents ASCII characters by their
+    ASCII bytes and never uses these bytes as part of other characters. This
+    holds for UTF-8, the single-byte encodings and most multi-byte encodings
+    (whose continuation bytes are outside of the range used for markup), but
+    not for e.g. UTF-16 or the stateful ISO-2022 encodings. Documents in such
+    an encoding can be scanned for markup without decoding them first.
+    :raises LookupError if the encoding is unknown"""
+    name = codecs.lookup(encoding).name
+    if name.startswith(('iso2022', 'utf-7', 'hz')):
+        return False
+    markup = '<!-- -->< /eq>\n'
+    try:
+        return markup.encode(name) == markup.encode('ascii')
+    except UnicodeError:
+        return False
+
+class TextSpan:
+    """Text of a document, given by its start and end offset in the bytes fed
+    to the EqnParser. Used to copy text to the output without decoding it."""
+    __slots__ = ('start', 'end')
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return 'TextSpan(%d, %d)' % (self.start, self.end)
+
 class EqnParser:
     """This parser parses <eq>...</eq> our of a document. It's not an HTML
     parser, because the content within <eq>.*<eq> is parsed verbatim.
     It also parses comments, to not consider formulas within comments. All other
     cases are unhandled. Especially CData is problematic, although it seems like
-    a rare use case."""
+    a rare use case.
+
+    Documents can be fed as strings or as bytes-like objects, e.g. a
+    memory-mapped file. The latter are scanned for markup without decoding
+    them as a whole (if the encoding allows it, see is_ascii_transparent);
+    only the chunks returned by get_data are decoded. If text_spans is set,
+    not even those: text and comments are returned as TextSpan instances
+    instead of strings, so that they can be copied to the output as they are.
+    """
     class State(enum.Enum): # ([\s\S]*?) also matches newlines
         Comment = re.compile(r'<!--([\s\S]*?)-->', re.MULTILINE)
         Equation = re.compile(r'<\s*(?:eq|EQ)\s*(.*?)?>([\s\S.]+?)<\s*/\s*(?:eq|EQ)>',
                 re.MULTILINE)
 
     HTML_ENTITY = re.compile(r'(&(:?#\d+|[a-zA-Z]+);)')
-
-    def __init__(self):
+    EQUATION_START = re.compile(r'<\s*eq\s*(.*?)>', re.IGNORECASE)
+    # the patterns for scanning bytes
+    BYTES_PATTERNS = {state: re.compile(state.value.pattern.encode('ascii'),
+        state.value.flags & ~re.UNICODE) for state in State}
+    BYTES_EQUATION_START = re.compile(EQUATION_START.pattern.encode('ascii'),
+            re.IGNORECASE)
+
+    def __init__(self, text_spans=False):
         self.__document = None
         self.__data = []
         self.__encoding = None
+        self.__position = (0, 0, -1) # see __get_position
+        self.__text_spans = text_spans
+        self.__spans = False # whether text spans are used for this document
 
     def feed(self, document):
-        """Feed a string or a bytes instance. If a bytes instance is fed, an
-        encoding header has to be present, so that the encoding can be
-        extracted."""
-        if isinstance(document, bytes): # try to guess encoding
-            encoding = "UTF-8"
-            if b'charset=' in document:
-                start = document.find(b'charset=') + 8
-                end = document[start:].find(b'"')
-                if end > -1:
-                    encoding = document[start:start+end].decode("utf-8")
-            document = document.decode(encoding)
-            self.__encoding = encoding
-        self.__document = document[:]
-        self._parse()
+        """Feed a string or a bytes-like object. If bytes are fed, the encoding
+        is taken from the charset of the HTML meta data, UTF-8 by default."""
+        with profiling.measure('parse'):
+            if not isinstance(document, str): # try to guess encoding
+                encoding = "UTF-8"
+                start = document.find(b'charset=')
+                if start > -1:
+                    start += 8
+                    end = document.find(b'"', start)
+                    if end > -1:
+                        encoding = bytes(document[start:end]).decode("utf-8")
+                if not is_ascii_transparent(encoding):
+                    document = str(document, encoding)
+                self.__encoding = encoding
+            self.__document = document
+            self.__position = (0, 0, -1)
+            self.__spans = self.__text_spans and not isinstance(document, str)
+            self._parse()
 
     def find_with_offset(self, doc, start, what):
         """This find method searches in the document for a given string, staking
         the offset into account. REturned is the absolute position (so offset +
         relative match position) or -1 for no hit."""
-        if isinstance(what, str):
-            pos = doc[start:].find(what)
+        if isinstance(what, (str, bytes)):
+            return doc.find(what, start)
+        match = what.search(doc, start)
+        return (-1 if not match else match.start())
+
+    def __decode(self, start, end):
+        """Return the given part of the document as string."""
+        chunk = self.__document[start:end]
+        return (chunk if isinstance(chunk, str) else
+                chunk.decode(self.__encoding))
+
+    def __append_text(self, start, end):
+        """Append the given part of the document as text chunk; adjacent spans
+        are merged."""
+        if start == end:
+            return
+        if not self.__spans:
+            self.__data.append(self.__decode(start, end))
+        elif self.__data and isinstance(self.__data[-1], TextSpan) and \
+                self.__data[-1].end == start:
+            self.__data[-1].end = end
         else:
-            match = what.search(doc[start:])
-            pos = (-1 if not match else match.span()[0])
-        return (pos if pos == -1 else pos + start)
-
+            self.__data.append(TextSpan(start, end))
+
+    def __get_position(self, index):
+        """Return line and column of the given index, as get_position does.
+        The lines are counted incrementally, since the document is parsed from
+        the beginning to the end; the position is (index up to which lines
+        have been counted, line number, index of the last newline)."""
+        counted, line, newline = self.__position
+        if index < counted:
+            counted, line, newline = (0, 0, -1)
+        separator = ('\n' if isinstance(self.__document, str) else b'\n')
+        passed = self.__document[counted:index] # mmap has no count()
+        line += passed.count(separator)
+        if separator in passed:
+            newline = counted + passed.rfind(separator)
+        self.__position = (index, line, newline)
+        return (line, len(self.__decode(max(newline, 0), index)))
 
     def _parse(self):
         """This function parses the document, while maintaining state using the
         State enum."""
-        in_document = lambda x: (False if x == -1 else True)
-        # maintain a lower-case copy, which eases searching, but doesn't affect
-        # the handler methods
-        doc = self.__document[:].lower()
-
-        end = len(self.__document) - 1
-        eq_start = re.compile(r'<\s*eq\s*(.*?)>')
+        doc = self.__document
+        if isinstance(doc, str):
+            comment_start, eq_start = '<!--', EqnParser.EQUATION_START
+        else:
+            comment_start, eq_start = b'<!--', EqnParser.BYTES_EQUATION_START
+        end = len(doc)
+        # positions of the next comment and formula, searched again only once
+        # they have been passed
+        comment = formula = None
 
         start_pos = 0
         while start_pos < end:
-            comment = self.find_with_offset(doc, start_pos, '<!--')
-            formula = self.find_with_offset(doc, start_pos, eq_start)
-            if in_document(comment) and in_document(formula): # both present, take closest
-                if comment < formula:
-                    self.__data.append(self.__document[start_pos:comment])
-                    start_pos = self.handle_comment(comment)
-                else:
-                    self.__data.append(self.__document[start_pos:formula])
-                    start_pos = self.handle_equation(formula)
-            elif in_document(formula):
-                self.__data.append(self.__document[start_pos:formula])
+            if comment is None or -1 < comment < start_pos:
+                comment = self.find_with_offset(doc, start_pos, comment_start)
+            if formula is None or -1 < formula < start_pos:
+                formula = self.find_with_offset(doc, start_pos, eq_start)
+            if formula > -1 and (comment == -1 or formula < comment):
+                self.__append_text(start_pos, formula)
                 start_pos = self.handle_equation(formula)
-            elif in_document(comment):
-                self.__data.append(self.__document[start_pos:comment])
+            elif comment > -1:
+                self.__append_text(start_pos, comment)
                 start_pos = self.handle_comment(comment)
             else: # only data left
-                self.__data.append(self.__document[start_pos:])
+                self.__append_text(start_pos, end)
                 start_pos = end
 
+    def __get_pattern(self, state):
+        return (state.value if isinstance(self.__document, str)
+                else EqnParser.BYTES_PATTERNS[state])
 
     def handle_equation(self, start_pos):
         """Parse an equation. The given offset should mark the beginning of this
         equation."""
         # get line and column of `start_pos`
-        lnum, pos = get_position(self.__document, start_pos)
+        lnum, pos = self.__get_position(start_pos)
 
-        match = EqnParser.State.Equation.value.search(self.__document[start_pos:])
+        match = self.__get_pattern(EqnParser.State.Equation).search(
+                self.__document, start_pos)
         if not match:
-            next_eq = find_anycase(self.__document[start_pos+1:], '<eq')
-            closing = find_anycase(self.__document[start_pos:], '</eq>')
+            document = self.__decode(start_pos, len(self.__document))
+            next_eq = find_anycase(document[1:], '<eq')
+            closing = find_anycase(document, '</eq>')
             if next_eq > -1 and closing > -1 and next_eq < closing:
                 raise ParseException("Unclosed tag found", (lnum, pos))
             else:
                 raise ParseException("Malformed equation tag found", (lnum, pos))
-        end = start_pos + match.span()[1]
-        attrs, formula = match.groups()
+        end = match.end()
+        attrs = (self.__decode(*match.span(1)) if match.start(1) > -1 else '')
+        formula = self.__decode(*match.span(2))
         if '<eq>' in formula or '<EQ' in formula:
             raise ParseException("Invalid nesting of formulas detected.", (lnum,
                 pos))
 
-        # replace HTML entities
-        entity = EqnParser.HTML_ENTITY.search(formula)
-        while entity:
-            formula = re.sub(EqnParser.HTML_ENTITY,
-                    html.unescape(entity.groups()[0]), formula)
-            entity = EqnParser.HTML_ENTITY.search(formula)
+        # replace HTML entities, in a single pass
+        if '&' in formula:
+            formula = EqnParser.HTML_ENTITY.sub(
+                    lambda entity: html.unescape(entity.group(1)), formula)
         attrs = attrs.lower()
         displaymath = (True if attrs and 'env' in attrs and 'displaymath' in attrs
                 else False)
-        self.__data.append(((lnum, pos), # let line number count from 0 as well
-                displaymath, formula))
+        # recurring formulas share one string, which is also used as cache key
+        self.__data.append(FormulaChunk((lnum, pos), displaymath,
+                sys.intern(formula)))
         return end
 
 
     def handle_comment(self, start_pos):
-        match = EqnParser.State.Comment.value.search(self.__document[start_pos:])
+        match = self.__get_pattern(EqnParser.State.Comment).search(
+                self.__document, start_pos)
         if not match:
-            lnum, pos = get_position(self.__document, start_pos)
+            lnum, pos = self.__get_position(start_pos)
             # this could be a parser issue, too
             raise ParseException("Improperly formatted comment found", (lnum,
                 pos))
-        self.__data.append('<!--%s-->' % match.groups()[0])
-        return start_pos + match.span()[1] # return end of match
+        self.__append_text(*match.span())
+        return match.end() # return end of match
 
     def get_encoding(self):
         """Return the parsed encoding from the HTML meta data. If none was set,
@@ -170,17 +275,29 @@ class EqnParser:
         return self.__encoding
 
     def get_data(self):
-        """Return parsed chunks. These are either strings or tuples with formula
-        information, see class documentation."""
+        """Return parsed chunks. These are either strings (or TextSpan
+        instances, see class documentation) or FormulaChunk tuples with formula
+        information. Text is kept as plain strings, which is more compact than
+        any wrapper."""
         return list(x for x in self.__data if x) # filter empty bits
 
 
+# length of the hash suffix of an id, in hexadecimal digits
+ID_HASH_LENGTH = 12
+# maximum length of an id, including the hash suffix
+ID_MAX_LENGTH = 150
+
+@functools.lru_cache(maxsize=8192)
 def gen_id(formula):
     """Generate an id for identifying a formula as an anchor in a document.
     The generated ID is guaranteed to be valid in an XML attribute and it won't
-    exceed a certain length.
-    If you happen to have a lot of formulas > 150 characters with exactly
-    the same content in the document, that'll cause a clash of id's."""
+    exceed ID_MAX_LENGTH characters. It consists of a readable part, derived
+    from the formula, and a hash of the whole formula, so that formulas
+    sharing the readable part still get different ids. The ids are stable
+    across runs and are memoized."""
+    if not formula:
+        raise ValueError("For the formula '%s' no referencable id could be generated." \
+                    % formula)
     # for some characters we just use a simple replacement (otherwise the
     # would be lost)
     mapped = {'{':'_', '}':'_', '(':'-', ')':'-', '\\':'.', '^':',', '*':'_'}
@@ -196,12 +313,11 @@ def gen_id(formula):
         prevchar = c
     # id's must start with an alphabetical character, so prefix the formula with
     # "formula" to make it a valid html id
-    if len(id) and not id[0].isalpha():
+    if not id or not id[0].isalpha():
         id = ['f', 'o', 'r', 'm', '_'] + id
-    if not id: # is empty
-        raise ValueError("For the formula '%s' no referencable id could be generated." \
-                    % formula)
-    return ''.join(id[:150])
+    digest = hashlib.blake2b(formula.encode('utf-8'),
+            digest_size=ID_HASH_LENGTH // 2).hexdigest()
+    return '%s-%s' % (''.join(id[:ID_MAX_LENGTH - ID_HASH_LENGTH - 1]), digest)
 
 
 class OutsourcedFormulaParser(html.parser.HTMLParser):
@@ -225,7 +341,7 @@ class OutsourcedFormulaParser(html.parser.HTMLParser):
             attrs = dict(attrs)
             if attrs.get('id'):
                 self.__id = attrs['id'] # marks beginning of a formula paragraph
-                self.__equations[self.__id] = ''
+                self.__equations[self.__id] = [] # joined in get_formulas
                 return
         elif tag == 'body':
             self.__passed_head = True
@@ -251,19 +367,19 @@ class OutsourcedFormulaParser(html.parser.HTMLParser):
 
     def handle_data(self, data):
         if self.__id:
-            self.__equations[self.__id] += data
+            self.__equations[self.__id].append(data)
         elif not self.__passed_head:
             self.__head.append(data)
 
     def handle_entityref(self, name):
         if self.__id:
-            self.__equations[self.__id] += '&%s;' % name
+            self.__equations[self.__id].append('&%s;' % name)
         elif not self.__passed_head:
             self.__head.append('&%s;' % name)
 
     def handle_charref(self, name):
         if self.__id:
-            self.__equations[self.__id] += '&#%s;' % name
+            self.__equations[self.__id].append('&#%s;' % name)
         elif not self.__passed_head:
             self.__head.append('&#%s;' % name)
 
@@ -282,7 +398,8 @@ class OutsourcedFormulaParser(html.parser.HTMLParser):
 
     def get_formulas(self):
         """Return an ordered dictionary with id : formula paragraph."""
-        return self.__equations
+        return collections.OrderedDict((id, ''.join(parts))
+                for id, parts in self.__equations.items())
 
     def error(self, message):
         raise ParseException(message, ('unknown', 'unknown'))
@@ -294,6 +411,145 @@ def format_formula_paragraph(formula):
             (gen_id(formula), formula)
 
 
+class _ExclusionFile:
+    """A file with excluded formula descriptions, see HtmlImageFormatter.
+
+    The formulas are also kept in a sidecar file next to it, with one JSON
+    object per line: a header with the format version and the head of the
+    HTML file, one line with id and formula for each formula and a last line
+    with size and modification time of the HTML file, as written. The
+    sidecar is read with a single call and new formulas are appended to both
+    files. The HTML file is only parsed if the sidecar is missing or doesn't
+    match it (e.g. files written by older versions) and only rewritten if it
+    is missing or its layout is unknown. The ids of formulas already in the
+    file are kept, even if they were generated by an older version, so that
+    links from documents which aren't converted again still work."""
+    def __init__(self, path):
+        self.__path = path
+        directory, name = posixpath.split(path)
+        self.__sidecar_path = posixpath.join(directory, '.%s.jsonl' %
+                posixpath.splitext(name)[0])
+        self.__file_head = HtmlImageFormatter.HTML_TEMPLATE_HEAD
+        self.__formulas = collections.OrderedDict() # id : formula, all
+        self.__new_ids = [] # ids of formulas not yet written
+        self.__rewrite = False # whether the HTML file needs to be rewritten
+        self.__sidecar_outdated = False
+        exists = os.path.exists(path)
+        if exists and not os.access(path, os.W_OK):
+            raise OSError('The file %s is not writable!' % path)
+        sidecar = self.__read_sidecar()
+        if sidecar and (not exists or sidecar[2] == self.__get_stamp()):
+            self.__file_head, self.__formulas = sidecar[:2]
+            self.__rewrite = not exists and bool(self.__formulas)
+        elif exists:
+            self.__sidecar_outdated = True
+            self.__file_head, self.__formulas = self.__parse()
+        # formula : id, the ids in the file are kept
+        self.__ids = {formula: id for id, formula in self.__formulas.items()}
+
+    def add(self, formula):
+        """Add a formula, unless it is in the file already, and return the id
+        of its paragraph: the id in the file or the one generated by gen_id
+        for new formulas."""
+        identifier = self.__ids.get(formula)
+        if identifier is None:
+            identifier = self.__ids[formula] = gen_id(formula)
+            self.__formulas[identifier] = formula
+            self.__new_ids.append(identifier)
+        return identifier
+
+    def __get_stamp(self):
+        stat = os.stat(self.__path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def __parse(self):
+        """Parse the HTML file. Returned is its head and an ordered dictionary
+        with id : formula."""
+        with open(self.__path, 'r', encoding='UTF-8') as f:
+            document = f.read()
+        parser = OutsourcedFormulaParser()
+        parser.feed(document)
+        return (parser.get_head(), parser.get_formulas())
+
+    def __read_sidecar(self):
+        """Return head, formulas and the stamp of the HTML file from the
+        sidecar or None, if it is missing or unreadable."""
+        try:
+            with open(self.__sidecar_path, 'r', encoding='UTF-8') as f:
+                records = json.loads('[%s]' %
+                        f.read().rstrip('\n').replace('\n', ','))
+            header, stamp = records[0], records[-1]['html']
+            if header.get('version') != HtmlImageFormatter.EXCLUSION_INDEX_VERSION:
+                return None
+            return (header['head'], collections.OrderedDict((r['id'],
+                r['formula']) for r in records[1:-1]), stamp)
+        except (OSError, ValueError, LookupError, AttributeError, TypeError):
+            return None
+
+    def __write_sidecar(self, ids):
+        """Append the formulas with the given ids to the sidecar, replacing
+        its last line with the new stamp of the HTML file. If ids is None, the
+        sidecar is written from scratch."""
+        lines = [json.dumps({'id': id, 'formula': self.__formulas[id]})
+                for id in (self.__formulas if ids is None else ids)]
+        lines.append(json.dumps({'html': self.__get_stamp()}))
+        if ids is not None and os.path.exists(self.__sidecar_path):
+            with open(self.__sidecar_path, 'r+b') as f:
+                start = max(0, f.seek(0, os.SEEK_END) - 256)
+                f.seek(start)
+                end = f.read().rfind(b'\n{"html"')
+                if end >= 0:
+                    f.seek(start + end + 1)
+                    f.truncate()
+                    f.write(('\n'.join(lines) + '\n').encode('UTF-8'))
+                    return
+        lines.insert(0, json.dumps({'version':
+            HtmlImageFormatter.EXCLUSION_INDEX_VERSION,
+            'head': self.__file_head}))
+        tmp_path = self.__sidecar_path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.__sidecar_path)
+
+    def __append(self, paragraphs, has_formulas):
+        """Insert the given formula paragraphs before the closing body tag of
+        the HTML file, without rewriting the rest of it. Returns False if
+        there is no file or its end is not as written by this class."""
+        if not os.path.exists(self.__path):
+            return False
+        tail = HtmlImageFormatter.HTML_TEMPLATE_TAIL
+        with open(self.__path, 'r+b') as f:
+            start = max(0, f.seek(0, os.SEEK_END) - 1024)
+            f.seek(start)
+            end = f.read().rfind(tail.encode('UTF-8'))
+            if end < 0:
+                return False
+            f.seek(start + end)
+            f.truncate()
+            f.write((('\n<hr />\n' if has_formulas else '')
+                + paragraphs + tail).encode('UTF-8'))
+        return True
+
+    def close(self):
+        """Write new formulas to the HTML file and the sidecar, if any."""
+        def join(ids):
+            return '\n<hr />\n'.join('<p id="%s"><pre>%s</pre></p>' %
+                    (id, self.__formulas[id]) for id in ids)
+        if self.__new_ids or self.__rewrite:
+            if self.__rewrite or not self.__append(join(self.__new_ids),
+                    len(self.__formulas) > len(self.__new_ids)):
+                with open(self.__path, 'w', encoding='utf-8') as f:
+                    f.write(self.__file_head)
+                    f.write(join(self.__formulas))
+                    f.write(HtmlImageFormatter.HTML_TEMPLATE_TAIL)
+            self.__write_sidecar(None if self.__sidecar_outdated
+                    else self.__new_ids)
+        elif self.__sidecar_outdated:
+            self.__write_sidecar(None)
+        self.__new_ids = []
+        self.__rewrite = self.__sidecar_outdated = False
+
+
 class HtmlImageFormatter: # ToDo: localisation
     """HtmlImageFormatter(exclusion_filepath='outsourced_formulas.html',
             encoding="UTF-8")
@@ -311,80 +567,127 @@ class HtmlImageFormatter: # ToDo: localisation
     nothing will be excluded."""
 
     EXCLUSION_FILE_NAME = 'outsourced-descriptions.html'
+    # formulas of the exclusion file in machine-readable form, see
+    # _ExclusionFile
+    EXCLUSION_INDEX_FILE_NAME = '.outsourced-descriptions.jsonl'
+    EXCLUSION_INDEX_VERSION = '2'
     FORMATTING_COMMANDS = ['\\ ', '\\,', '\\;', '\\big', '\\Big', '\\left',
             '\\right', '\\limits']
+    # a formatting command, unless escaped (\\,) or part of a longer command
+    # (\\bigl); commands ending on a letter mustn't be followed by one
+    FORMATTING_COMMANDS_REGEX = re.compile(r'(?<!\\)(?:%s)' % '|'.join(
+        re.escape(command) + (r'(?![^\W\d_])' if command[-1].isalpha() else '')
+        for command in FORMATTING_COMMANDS))
     HTML_TEMPLATE_HEAD = ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"' +
         '\n  "http://www.w3.org/TR/html4/strict.dtd">\n<html>\n<head>\n' +
         '<meta http-equiv="content-type" content="text/html; charset=utf-8"/>' +
         '\n<title>Outsourced Formulas</title>\n</head>\n<!-- ' +
         'DO NOT MODIFY THIS FILE, IT IS AUTOMATICALLY GENERATED -->\n<body>\n')
+    HTML_TEMPLATE_TAIL = '\n</body>\n</html>\n'
     def __init__(self, base_path='', link_path=None):
         self.__exclude_descriptions = False
         self.__link_path = (link_path if link_path else '')
         self.__base_path = (base_path if base_path else '')
-        self.__exclusion_filepath = posixpath.join(self.__base_path, HtmlImageFormatter.EXCLUSION_FILE_NAME)
-        if os.path.exists(self.__exclusion_filepath):
-            if not os.access(self.__exclusion_filepath, os.W_OK):
-                raise OSError('The file %s is not writable!' %
-                        self.__exclusion_filepath)
         self.__inline_maxlength=100
-        self.__file_head = HtmlImageFormatter.HTML_TEMPLATE_HEAD
-        self.__cached_formula_pars = collections.OrderedDict()
+        self.__exclusion_files = {} # path : _ExclusionFile
+        self.__shard_document = None
+        self.__shard_count = 1
         self.__url = ''
         self.initialized = False
         self.initialize() # read already written file, if any
         self.__css = {'inline' : 'inlinemath', 'display' : 'displaymath'}
         self.__replace_nonascii = False
+        self.__formatted = {} # memoized results of format(), see there
+        self.__postprocessed = {} # memoized results of postprocess_formula
 
     def set_replace_nonascii(self, flag):
         """If True, non-ascii characters will be replaced through their LaTeX
         command. Note that alphabetical characters will not be replaced, to
         allow easier readibility."""
         self.__replace_nonascii = flag
+        self.__formatted.clear()
+        self.__postprocessed.clear()
 
     def set_max_formula_length(self, length):
         """Set maximum length of a formula before it gets outsourced into a
         separate file."""
         self.__inline_maxlength = length
+        self.__formatted.clear()
 
     def set_inline_math_css_class(self, css):
         """set css class for inline math."""
         self.__css['inline'] = css
+        self.__formatted.clear()
 
     def set_display_math_css_class(self, css):
         """set css class for display math."""
         self.__css['display'] = css
+        self.__formatted.clear()
 
     def set_exclude_long_formulas(self, flag):
         """When set, the LaTeX code of a formula longer than the configured
         maxlength will be excluded and written + linked into a separate file."""
         self.__exclude_descriptions = flag
+        self.__formatted.clear()
 
     def set_url(self, prefix):
         """Set URL prefix which is used as a prefix to the image file in the
         HTML link."""
         self.__url = prefix
+        self.__formatted.clear()
+
+    def set_shard_by_document(self, name):
+        """Exclude formulas into a file of their own for the given source
+        document, instead of one file for all documents. The name is reduced
+        to the base name of the document, without extension. None disables the
+        sharding by document."""
+        if name:
+            name = re.sub(r'[^\w.-]+', '_',
+                    posixpath.splitext(os.path.basename(name))[0])
+        self.__shard_document = (name if name else None)
+        self.__formatted.clear()
+
+    def set_shard_count(self, count):
+        """Distribute the excluded formulas over the given number of files,
+        by a hash of their id. This keeps the files small for sites with many
+        long formulas. Sharding by document takes precedence."""
+        if count < 1:
+            raise ValueError("the number of shards must be positive")
+        self.__shard_count = count
+        self.__formatted.clear()
 
     def initialize(self):
         """Initialize the image writer. If a file with already written image
-        descriptions exists, this one will be parsed first and new formulas
-        appended to it. Otherwise a new file will be written upon ending the
-        with-resources block."""
+        descriptions exists, the ids of its formulas are read from the index
+        file next to it, so that new formulas can be appended to it. Only if
+        the index is missing or outdated, the file is parsed. Otherwise a new
+        file will be written upon ending the with-resources block."""
         if self.initialized:
             return
         self.initialized = True
-        if not os.path.exists(self.__exclusion_filepath):
-            return self
-        document = None
-        with open(self.__exclusion_filepath, 'r', encoding='UTF-8') as f:
-            document = f.read()
-        # parse html document:
-        parser = OutsourcedFormulaParser()
-        parser.feed(document)
-        self.__file_head = parser.get_head()
-        self.__cached_formula_pars = parser.get_formulas()
+        self.__get_exclusion_file(posixpath.join(self.__base_path,
+            HtmlImageFormatter.EXCLUSION_FILE_NAME))
         return self
 
+    def __get_exclusion_file(self, path):
+        if path not in self.__exclusion_files:
+            self.__exclusion_files[path] = _ExclusionFile(path)
+        return self.__exclusion_files[path]
+
+    def get_exclusion_file_name(self, formula):
+        """Return the name of the file (without base path) to which the given
+        formula would be excluded; see set_shard_by_document and
+        set_shard_count."""
+        name, ext = posixpath.splitext(HtmlImageFormatter.EXCLUSION_FILE_NAME)
+        if self.__shard_document:
+            return '%s-%s%s' % (name, self.__shard_document, ext)
+        if self.__shard_count > 1:
+            bucket = int(gen_id(formula)[-ID_HASH_LENGTH:], 16) % \
+                    self.__shard_count
+            return '%s-%0*d%s' % (name, len(str(self.__shard_count - 1)),
+                    bucket, ext)
+        return HtmlImageFormatter.EXCLUSION_FILE_NAME
+
     def __enter__(self):
         return self
 
@@ -392,44 +695,32 @@ class HtmlImageFormatter: # ToDo: localisation
         self.close()
 
     def close(self):
-        """Write back file with excluded image descriptions, if any."""
-        def formula2paragraph(frml):
-            return '<p id="%s"><pre>%s</pre></p>' % (gen_id(frml), frml)
-        if not len(self.__cached_formula_pars):
-            return
-        with open(self.__exclusion_filepath, 'w', encoding='utf-8') as f:
-            f.write(self.__file_head)
-            f.write('\n<hr />\n'.join([formula2paragraph(formula) \
-                    for formula in self.__cached_formula_pars.values()]))
-            f.write('\n</body>\n</html>\n')
+        """Write back files with excluded image descriptions. New formulas are
+        appended to existing files; if nothing was added, nothing is
+        written."""
+        for exclusion_file in self.__exclusion_files.values():
+            exclusion_file.close()
 
     def postprocess_formula(self, formula):
         """Formulas should not contain unicode characters or formatting
         instructions, if they are part of the alt attribute. This distracts the
         reader and stretches the formula. This method replaces non-ascii
-        characters, if requested and strips a few formatting commands."""
+        characters, if requested and strips a few formatting commands.
+        Results are memoized per formula."""
+        processed = self.__postprocessed.get(formula)
+        if processed is not None:
+            return processed
+        processed = formula
         if self.__replace_nonascii:
-            formula = document.escape_unicode_in_formulas(formula,
+            processed = document.escape_unicode_in_formulas(processed,
                     replace_alphabeticals=False)
         # replace formatting-only symbols which distract the reader
-        formula_changed = True
-        while formula_changed:
-            formula_changed = False
-            for command in HtmlImageFormatter.FORMATTING_COMMANDS:
-                idx = formula.find(command)
-                # only replace if it's not after a \\ and not part of a longer command
-                if (idx > 0 and formula[idx-1] != '\\') or idx == 0:
-                    end = idx + len(command)
-                    # following conditions for replacement must be met:
-                    # command doesn't end on alphabet. char. and is followed by
-                    # same category; end of string reached or command does not
-                    # end on alphabet. char. at all
-                    if end >= len(formula) or not command[-1].isalpha() \
-                            or not formula[end].isalpha():
-                        formula = formula[:idx] + ' ' + formula[idx + len(command):]
-                        formula = formula.replace('  ', ' ')
-                        formula_changed = True
-        return formula
+        processed, count = HtmlImageFormatter.FORMATTING_COMMANDS_REGEX.subn(
+                ' ', processed)
+        if count:
+            processed = re.sub('  +', ' ', processed)
+        self.__postprocessed[formula] = processed
+        return processed
 
     def get_html_img(self, pos, formula, img_path, displaymath=False):
         """:param pos dictionary containing keys depth, height and width
@@ -461,13 +752,13 @@ class HtmlImageFormatter: # ToDo: localisation
         formula"""
         shortened = (formula[:100] + '...'  if len(formula) > 100 else formula)
         img = self.get_html_img(pos, shortened, img_path, displaymath)
-        identifier = gen_id(formula)
         # write formula out to external file
-        if identifier not in self.__cached_formula_pars:
-            self.__cached_formula_pars[identifier] = formula
-        exclusion_filelink = posixpath.join(self.__link_path, self.__exclusion_filepath)
+        exclusion_filepath = posixpath.join(self.__base_path,
+                self.get_exclusion_file_name(formula))
+        identifier = self.__get_exclusion_file(exclusion_filepath).add(formula)
+        exclusion_filelink = posixpath.join(self.__link_path, exclusion_filepath)
         return '<a href="{}#{}">{}</a>'.format(exclusion_filelink,
-                gen_id(formula), img)
+                identifier, img)
 
     def format(self, pos, formula, img_path, displaymath=False):
         """This method formats a formula. If self.__exclude_descriptions is set
@@ -479,12 +770,21 @@ class HtmlImageFormatter: # ToDo: localisation
         :param img_path: path to image
         :param displaymath whether or not formula is in display math (default: no)
         :returns string with formatted HTML image which also links to excluded
-        formula"""
-        formula = self.postprocess_formula(formula)
-        if self.__exclude_descriptions and \
-                len(formula) > self.__inline_maxlength:
-            return self.format_excluded(pos, formula, img_path, displaymath)
-        else:
-            return self.get_html_img(pos, formula, img_path, displaymath)
+        formula
+
+        The result is memoized, so that recurring formulas are formatted only
+        once."""
+        key = (formula, img_path, displaymath, pos['depth'], pos['height'],
+                pos['width'])
+        html = self.__formatted.get(key)
+        if html is None:
+            formula = self.postprocess_formula(formula)
+            if self.__exclude_descriptions and \
+                    len(formula) > self.__inline_maxlength:
+                html = self.format_excluded(pos, formula, img_path, displaymath)
+            else:
+                html = self.get_html_img(pos, formula, img_path, displaymath)
+            self.__formatted[key] = html
+        return html
 
 
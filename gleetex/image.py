@@ -1,12 +1,20 @@
 """
 This module takes care of the actual image creation process.
 """
+import asyncio
+import collections
 import distutils.dir_util
+import errno
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+from . import profiling
 
 def remove_all(*files):
     """Guarded remove of files (rm -f); no exception is thrown if a file
@@ -18,16 +26,131 @@ def remove_all(*files):
         pass
 
 
-def proc_call(cmd, cwd=None):
+def move_atomically(source, destination):
+    """Move `source` to `destination`, so that the destination either doesn't
+    exist or is complete. If both are on different file systems, the file is
+    copied next to the destination first and then renamed."""
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        directory = os.path.dirname(destination)
+        handle, tmp_fn = tempfile.mkstemp(dir=(directory if directory else '.'),
+                prefix='.gladtex-', suffix='.tmp')
+        os.close(handle)
+        try:
+            shutil.copyfile(source, tmp_fn)
+            # mkstemp creates the file with mode 0600
+            shutil.copymode(source, tmp_fn)
+            os.replace(tmp_fn, destination)
+        except OSError:
+            remove_all(tmp_fn)
+            raise
+        remove_all(source)
+
+def get_scratch_base():
+    """Return the directory in which scratch directories for the conversion
+    should be created. A RAM-backed file system (/dev/shm) is preferred, if
+    available; otherwise the default temporary directory is used."""
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
+class SubprocessTimeoutError(subprocess.SubprocessError):
+    """Raised by proc_call if a subprocess didn't finish within the given time
+    out. The time out in seconds is kept in the attribute `timeout`."""
+    def __init__(self, msg, timeout):
+        self.timeout = timeout
+        super().__init__(msg)
+
+
+class TimeoutPolicy:
+    """Determine the time out for one stage of the conversion (e.g. the LaTeX
+    run) and keep track of how long the subprocesses took.
+
+    With a fixed policy, the configured time out is always used. An adaptive
+    policy starts with the configured time out, but as soon as enough run times
+    have been recorded, the time out is derived from a percentile of the
+    observed run times, multiplied by a safety factor and clamped to
+    [minimum, maximum]. The policy is shared by all conversions of a converter,
+    hence it is thread-safe.
+
+    p = TimeoutPolicy(20, adaptive=True)
+    p.record(0.4) # a run took 0.4 s
+    p.get_timeout()
+    p.get_statistics() # runs, time outs, current time out, ...
+    """
+    # minimum number of samples before adaptive time outs are computed
+    MIN_SAMPLES = 10
+    #pylint: disable=too-many-arguments
+    def __init__(self, timeout=20, adaptive=False, percentile=95, factor=5,
+            minimum=2, maximum=300, window=500):
+        if timeout <= 0:
+            raise ValueError("time out must be a positive number of seconds")
+        if not 0 < percentile <= 100:
+            raise ValueError("percentile must be in the range (0, 100]")
+        self.__timeout = timeout
+        self.__adaptive = adaptive
+        self.__percentile = percentile
+        self.__factor = factor
+        self.__minimum = minimum
+        self.__maximum = maximum
+        self.__durations = collections.deque(maxlen=window)
+        self.__runs = 0
+        self.__timeouts = 0
+        self.__lock = threading.Lock()
+
+    def is_adaptive(self):
+        return self.__adaptive
+
+    def get_timeout(self):
+        """Return the time out in seconds to use for the next subprocess."""
+        if not self.__adaptive:
+            return self.__timeout
+        with self.__lock:
+            if len(self.__durations) < TimeoutPolicy.MIN_SAMPLES:
+                return self.__timeout
+            durations = sorted(self.__durations)
+        index = int(round((len(durations) - 1) * self.__percentile / 100))
+        return min(self.__maximum, max(self.__minimum,
+            durations[index] * self.__factor))
+
+    def record(self, duration):
+        """Record the run time of a subprocess which finished in time."""
+        with self.__lock:
+            self.__runs += 1
+            self.__durations.append(duration)
+
+    def record_timeout(self):
+        """Record a subprocess which has been killed after its time out."""
+        with self.__lock:
+            self.__runs += 1
+            self.__timeouts += 1
+
+    def get_statistics(self):
+        """Return a dictionary with the number of runs, the number of time outs,
+        the longest observed run time and the time out currently in use."""
+        with self.__lock:
+            runs, timeouts = self.__runs, self.__timeouts
+            longest = (max(self.__durations) if self.__durations else None)
+        return {'runs': runs, 'timeouts': timeouts, 'longest': longest,
+                'timeout': self.get_timeout(), 'adaptive': self.__adaptive}
+
+
+def proc_call(cmd, cwd=None, timeout=20):
     """Execute cmd (list of arguments) as a subprocess. Returned is a tuple with
     stdout and stderr, decoded if not None. If the return value is not equal 0, a
-    subprocess error is raised. Timeouts will happen after 20 seconds."""
+    subprocess error is raised. Timeouts will happen after `timeout` seconds
+    (20 by default) and are signalled by a SubprocessTimeoutError."""
     with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             bufsize=1, universal_newlines=False, cwd=cwd) as proc:
         data = []
         try:
             data = [d.decode(sys.getdefaultencoding(), errors="surrogateescape")
-                    for d in proc.communicate(timeout=20) if d]
+                    for d in proc.communicate(timeout=timeout) if d]
             if proc.wait():
                 raise subprocess.SubprocessError("Error while executing %s\n%s\n" %
                     (' '.join(cmd), '\n'.join(data)))
@@ -38,10 +161,11 @@ def proc_call(cmd, cwd=None):
             if poll:
                 note += str(poll) + '\n'
             if data:
-                raise subprocess.SubprocessError(str(data + '\n' + note))
+                raise SubprocessTimeoutError('\n'.join(data) + '\n' + note,
+                        timeout)
             else:
-                raise subprocess.SubprocessError('execution timed out after ' +
-                        str(e.args[1]) + ' s: ' + ' '.join(e.args[0]))
+                raise SubprocessTimeoutError('execution timed out after ' +
+                        str(e.args[1]) + ' s: ' + ' '.join(e.args[0]), timeout)
         except KeyboardInterrupt as e:
             sys.stderr.write("\nInterrupted; ")
             import traceback
@@ -52,6 +176,40 @@ def proc_call(cmd, cwd=None):
             return data
 
 
+async def _kill_async(proc):
+    """Kill a subprocess and wait for it, so that no zombie is left behind.
+    The wait is shielded, so that the process is reaped even if the calling
+    task is cancelled (again) meanwhile."""
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass # exited in the meantime
+    await asyncio.shield(proc.wait())
+
+
+async def proc_call_async(cmd, cwd=None, timeout=20):
+    """Asynchronous counterpart of proc_call, using the asyncio subprocess
+    API. The output is returned and errors are raised like proc_call does. If
+    the calling task is cancelled, the subprocess is killed."""
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, cwd=cwd)
+    try:
+        output = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        await _kill_async(proc)
+        raise SubprocessTimeoutError('execution timed out after %s s: %s' % (
+            timeout, ' '.join(cmd)), timeout)
+    except asyncio.CancelledError:
+        await _kill_async(proc)
+        raise
+    data = '\n'.join(d.decode(sys.getdefaultencoding(),
+        errors="surrogateescape") for d in output if d)
+    if proc.returncode:
+        raise subprocess.SubprocessError("Error while executing %s\n%s\n" %
+                (' '.join(cmd), data))
+    return data
+
+
 class Tex2img:
     """
     Convert a TeX document string into a png file.
@@ -59,8 +217,14 @@ class Tex2img:
     the methods throw a SubprocessError with all necessary information to fix
     the issue.
     The background of the PNG files will be transparent by default.
+
+    convert_async() is the asyncio variant of convert(), running the
+    subprocesses with Tex2img.call_async.
     """
     call = proc_call
+    call_async = proc_call_async
+    # base name of the files within a scratch directory
+    SCRATCH_NAME = 'formula'
     DVIPNG_REGEX = re.compile(r"^ depth=(-?\d+) height=(\d+) width=(\d+)")
     def __init__(self, tex_document, output_fn, encoding="UTF-8"):
         """tex_document should be either a full TeX document as a string or a
@@ -73,6 +237,8 @@ class Tex2img:
         self.__background = 'transparent'
         self.__foreground = 'rgb 0 0 0'
         self.__keep_latex_source = False
+        self.__timeouts = {'latex': TimeoutPolicy(), 'dvipng': TimeoutPolicy()}
+        self.__scratch_directory = None
         # create directory for image if that doesn't exist
         base_name = os.path.split(output_fn)[0]
         if base_name and not os.path.exists(base_name):
@@ -117,80 +283,199 @@ class Tex2img:
             raise TypeError("boolean object required, got %s." % repr(flag))
         self.__keep_latex_source = flag
 
+    def set_scratch_directory(self, directory):
+        """Run LaTeX and dvipng within the given (existing) directory instead
+        of the directory of the output image. Only the final image is moved
+        into place. The directory may be reused for subsequent conversions,
+        as long as these are not run concurrently."""
+        self.__scratch_directory = directory
 
-    def create_dvi(self, dvi_fn):
-        """
-        Call LaTeX to produce a dvi file with the given LaTeX document.
-        Temporary files will be removed, even in the case of a LaTeX error.
-        This method raises a SubprocessError with the helpful part of LaTeX's
-        error output."""
+    def set_latex_timeout(self, timeout):
+        """Set the time out for the LaTeX run; either a number of seconds or a
+        TimeoutPolicy (which can be shared across several conversions)."""
+        self.__timeouts['latex'] = self.__to_policy(timeout)
+
+    def set_dvipng_timeout(self, timeout):
+        """Set the time out for the dvipng run; either a number of seconds or a
+        TimeoutPolicy (which can be shared across several conversions)."""
+        self.__timeouts['dvipng'] = self.__to_policy(timeout)
+
+    def __to_policy(self, timeout):
+        if isinstance(timeout, TimeoutPolicy):
+            return timeout
+        if not isinstance(timeout, (int, float)):
+            raise TypeError("time out must be a number or a TimeoutPolicy, "
+                    "got %s" % repr(timeout))
+        return TimeoutPolicy(timeout)
+
+    def _call(self, stage, cmd, cwd=None):
+        """Execute the given command using Tex2img.call with the time out
+        configured for the given stage ('latex' or 'dvipng') and record its
+        run time."""
+        policy = self.__timeouts[stage]
+        start = time.monotonic()
+        try:
+            data = Tex2img.call(cmd, cwd=cwd, timeout=policy.get_timeout())
+        except SubprocessTimeoutError:
+            policy.record_timeout()
+            raise
+        policy.record(time.monotonic() - start)
+        return data
+
+    async def _call_async(self, stage, cmd, cwd=None):
+        """Asynchronous variant of _call, using Tex2img.call_async."""
+        policy = self.__timeouts[stage]
+        start = time.monotonic()
+        try:
+            data = await Tex2img.call_async(cmd, cwd=cwd,
+                    timeout=policy.get_timeout())
+        except SubprocessTimeoutError:
+            policy.record_timeout()
+            raise
+        policy.record(time.monotonic() - start)
+        return data
+
+    def _prepare_latex(self, dvi_fn):
+        """Write the TeX document next to the given dvi file. Returned is the
+        LaTeX command, the directory to run it in and the files to remove
+        afterwards, see _remove_latex_files."""
         path = os.path.dirname(dvi_fn)
         if not path:
             path = os.getcwd()
         new_extension = lambda x: os.path.splitext(dvi_fn)[0] + '.' + x
-
         tex_fn = new_extension('tex')
-        aux_fn = new_extension('aux')
-        log_fn = new_extension('log')
-        cmd = None
         cmd = ['latex', '-halt-on-error', os.path.basename(tex_fn)]
-        encoding = self.__encoding
-        with open(tex_fn, mode='w', encoding=encoding) as tex:
+        with open(tex_fn, mode='w', encoding=self.__encoding) as tex:
             tex.write(str(self.tex_document))
+        return (cmd, path, (tex_fn, new_extension('aux'), new_extension('log')))
+
+    def _latex_error(self, error):
+        """Return a SubprocessError with the helpful part of LaTeX's error
+        output."""
+        msg = ''
+        if error.args:
+            data = self.parse_log(error.args[0])
+            if data:
+                msg += data
+            else:
+                msg += str(error.args[0])
+        return subprocess.SubprocessError(msg)
+
+    def _remove_latex_files(self, tex_fn, aux_fn, log_fn):
+        """Remove the files of a LaTeX run; if requested, the LaTeX source is
+        kept next to the image."""
+        if self.__keep_latex_source:
+            # keep source next to the image, even if run in a scratch dir
+            kept_fn = os.path.splitext(self.output_name)[0] + '.tex'
+            if os.path.abspath(kept_fn) != os.path.abspath(tex_fn):
+                shutil.copyfile(tex_fn, kept_fn)
+                remove_all(tex_fn, aux_fn, log_fn)
+            else:
+                remove_all(aux_fn, log_fn)
+        else:
+            remove_all(tex_fn, aux_fn, log_fn)
+
+    def _missing_program(self, program, package):
+        """Return a SubprocessError suggesting how to install a missing
+        program."""
+        text = "Command `%s` not found." % program
+        if shutil.which('dpkg'):
+            text += ' Install it using `sudo apt install %s`' % package
+        else:
+            text += ' Install a TeX distribution of your choice, e.g. MikTeX or TeXlive.'
+        return subprocess.SubprocessError(text)
+
+
+    def create_dvi(self, dvi_fn):
+        """
+        Call LaTeX to produce a dvi file with the given LaTeX document.
+        Temporary files will be removed, even in the case of a LaTeX error.
+        This method raises a SubprocessError with the helpful part of LaTeX's
+        error output."""
+        cmd, path, files = self._prepare_latex(dvi_fn)
         try:
-            Tex2img.call(cmd, cwd=path)
+            with profiling.measure('latex'):
+                self._call('latex', cmd, cwd=path)
+        except SubprocessTimeoutError:
+            remove_all(dvi_fn)
+            raise
         except subprocess.SubprocessError as e:
             remove_all(dvi_fn)
-            msg = ''
-            if e.args:
-                data = self.parse_log(e.args[0])
-                if data:
-                    msg += data
-                else:
-                    msg += str(e.args[0])
-            raise subprocess.SubprocessError(msg) # propagate subprocess error
+            raise self._latex_error(e) # propagate subprocess error
         except FileNotFoundError:
             # `latex` is missing, give suggestions on how to install it
-            text = "Command `%s` not found." % cmd[0]
-            if shutil.which('dpkg'):
-                text += ' Install it using `sudo apt install texlive-latex-recommended preview-latex-style`'
-            else:
-                text += ' Install a TeX distribution of your choice, e.g. MikTeX or TeXlive.'
-                raise subprocess.SubprocessError(text)
+            raise self._missing_program(cmd[0],
+                    'texlive-latex-recommended preview-latex-style')
         finally:
-            if self.__keep_latex_source:
-                remove_all(aux_fn, log_fn)
-            else:
-                remove_all(tex_fn, aux_fn, log_fn)
+            self._remove_latex_files(*files)
 
-    def create_png(self, dvi_fn):
+    async def create_dvi_async(self, dvi_fn):
+        """Asynchronous variant of create_dvi."""
+        cmd, path, files = self._prepare_latex(dvi_fn)
+        try:
+            with profiling.measure('latex'):
+                await self._call_async('latex', cmd, cwd=path)
+        except (SubprocessTimeoutError, asyncio.CancelledError):
+            remove_all(dvi_fn)
+            raise
+        except subprocess.SubprocessError as e:
+            remove_all(dvi_fn)
+            raise self._latex_error(e)
+        except FileNotFoundError:
+            raise self._missing_program(cmd[0],
+                    'texlive-latex-recommended preview-latex-style')
+        finally:
+            self._remove_latex_files(*files)
+
+    def create_png(self, dvi_fn, png_fn=None):
         """Create a PNG file from a given dvi file. The side effect is the PNG
         file being written to disk.
         :param dvi_fn   Dvi file name
+        :param png_fn   PNG file name, configured output file name by default
         :return dimensions for embedding into an HTML document
         :raises ValueError raised whenever dvipng output coudln't be parsed
         """
-        cmd = ['dvipng', '-q*', '-D', str(self.__dpi),
-                # colors
-                '-bg', self.__background, '-fg', self.__foreground,
-                '--height*', '--depth*', '--width*', # print information for embedding
-                '-o', self.output_name, dvi_fn]
-        data = None
+        png_fn = (png_fn if png_fn else self.output_name)
+        cmd = self._dvipng_command(dvi_fn, png_fn)
         try:
-            data = Tex2img.call(cmd)
+            with profiling.measure('dvipng'):
+                data = self._call('dvipng', cmd)
         except subprocess.SubprocessError:
-            remove_all(self.output_name)
+            remove_all(png_fn)
             raise
         except FileNotFoundError:
             # `dvipng` is missing, give suggestions on how to install it
-            text = "Command `%s` not found." % cmd[0]
-            if shutil.which('dpkg'):
-                text += ' Install it using `sudo apt install dvipng`'
-            else:
-                text += ' Install a TeX distribution of your choice, e.g. MikTeX or TeXlive.'
-            raise subprocess.SubprocessError(text)
+            raise self._missing_program(cmd[0], 'dvipng')
+        finally:
+            remove_all(dvi_fn)
+        return self._parse_dvipng_output(data)
+
+    async def create_png_async(self, dvi_fn, png_fn=None):
+        """Asynchronous variant of create_png."""
+        png_fn = (png_fn if png_fn else self.output_name)
+        cmd = self._dvipng_command(dvi_fn, png_fn)
+        try:
+            with profiling.measure('dvipng'):
+                data = await self._call_async('dvipng', cmd)
+        except (subprocess.SubprocessError, asyncio.CancelledError):
+            remove_all(png_fn)
+            raise
+        except FileNotFoundError:
+            raise self._missing_program(cmd[0], 'dvipng')
         finally:
             remove_all(dvi_fn)
+        return self._parse_dvipng_output(data)
+
+    def _dvipng_command(self, dvi_fn, png_fn):
+        return ['dvipng', '-q*', '-D', str(self.__dpi),
+                # colors
+                '-bg', self.__background, '-fg', self.__foreground,
+                '--height*', '--depth*', '--width*', # print information for embedding
+                '-o', png_fn, dvi_fn]
+
+    def _parse_dvipng_output(self, data):
+        """Return the dimensions of the image from the output of dvipng.
+        :raises ValueError if the output couldn't be parsed"""
         for line in data.split('\n'):
             found = Tex2img.DVIPNG_REGEX.search(line)
             if found:
@@ -200,15 +485,46 @@ class Tex2img:
     def convert(self):
         """Convert the TeX document into an image.
         This calls create_dvi and create_png but will not return anything. Thre
-        result should be retrieved using get_positioning_info()."""
-        dvi = os.path.join(os.path.splitext(self.output_name)[0] + '.dvi')
+        result should be retrieved using get_positioning_info().
+        If a scratch directory is configured, all intermediate files and the
+        image are created in there and the image is moved into place
+        afterwards."""
+        dvi, png = self.__get_work_files()
         try:
             self.create_dvi(dvi)
-            self.__parsed_data = self.create_png(dvi)
+            self.__parsed_data = self.create_png(dvi, png)
+            if png != self.output_name:
+                move_atomically(png, self.output_name)
         except OSError:
+            remove_all(png)
             remove_all(self.output_name)
             raise
 
+    async def convert_async(self):
+        """Asynchronous variant of convert(). If the task is cancelled, the
+        running subprocess is killed and all files are removed."""
+        dvi, png = self.__get_work_files()
+        try:
+            await self.create_dvi_async(dvi)
+            self.__parsed_data = await self.create_png_async(dvi, png)
+            if png != self.output_name:
+                move_atomically(png, self.output_name)
+        except (OSError, asyncio.CancelledError):
+            remove_all(png)
+            remove_all(self.output_name)
+            raise
+
+    def __get_work_files(self):
+        """Return the names of the dvi file and the image to create, either in
+        the scratch directory or next to the output file."""
+        if self.__scratch_directory:
+            base = os.path.join(self.__scratch_directory, Tex2img.SCRATCH_NAME)
+            png = base + '.png'
+        else:
+            base = os.path.splitext(self.output_name)[0]
+            png = self.output_name
+        return (base + '.dvi', png)
+
     def get_positioning_info(self):
         """Return positioning information to position created image in the HTML
         page."""
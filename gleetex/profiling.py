@@ -0,0 +1,160 @@
+"""This module collects timing information about the stages of a GladTeX run,
+e.g. parsing, cache I/O or the LaTeX runs. The hooks in the other modules
+don't do anything until a profiler is installed:
+
+    profiler = profiling.Profiler()
+    profiling.install(profiler)
+    ... # convert a document
+    profiling.uninstall()
+    print(profiler.format_report())
+
+The profiler is thread-safe, the conversion of formulas happens concurrently.
+"""
+
+import heapq
+import threading
+import time
+
+class Profiler:
+    """Collect durations per stage, counters, gauges (like the length of a
+    queue) and the slowest formulas."""
+    def __init__(self, slowest_count=10):
+        self.__stages = {} # stage: [count, total, maximum]
+        self.__counters = {}
+        self.__gauges = {} # name: [samples, maximum, last]
+        self.__slowest = [] # heap of (duration, stage, formula)
+        self.__slowest_count = slowest_count
+        self.__lock = threading.Lock()
+
+    def record(self, stage, duration, formula=None):
+        """Record the duration (in seconds) of a stage. If a formula is given,
+        it is considered for the list of the slowest formulas."""
+        with self.__lock:
+            values = self.__stages.get(stage)
+            if values:
+                values[0] += 1
+                values[1] += duration
+                values[2] = max(values[2], duration)
+            else:
+                self.__stages[stage] = [1, duration, duration]
+            if formula is not None:
+                item = (duration, stage, formula)
+                if len(self.__slowest) < self.__slowest_count:
+                    heapq.heappush(self.__slowest, item)
+                else:
+                    heapq.heappushpop(self.__slowest, item)
+
+    def count(self, name, value=1):
+        """Increase the counter with the given name."""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """Record the current value of a gauge, e.g. a queue depth."""
+        with self.__lock:
+            values = self.__gauges.get(name)
+            if values:
+                values[0] += 1
+                values[1] = max(values[1], value)
+                values[2] = value
+            else:
+                self.__gauges[name] = [1, value, value]
+
+    def get_report(self):
+        """Return all collected information as a dictionary, suitable for
+        serialisation as JSON."""
+        with self.__lock:
+            stages = {stage: {'count': count, 'total': total,
+                    'mean': total / count, 'max': maximum}
+                    for stage, (count, total, maximum) in self.__stages.items()}
+            gauges = {name: {'samples': samples, 'max': maximum, 'last': last}
+                    for name, (samples, maximum, last) in self.__gauges.items()}
+            slowest = [{'duration': duration, 'stage': stage, 'formula': formula}
+                    for duration, stage, formula in sorted(self.__slowest,
+                        reverse=True)]
+            return {'stages': stages, 'counters': dict(self.__counters),
+                    'gauges': gauges, 'slowest': slowest}
+
+    def format_report(self):
+        """Return a human-readable summary of the collected information."""
+        report = self.get_report()
+        lines = ['%-20s %8s %10s %10s %10s' % ('stage', 'count', 'total (s)',
+            'mean (ms)', 'max (ms)')]
+        for stage, data in sorted(report['stages'].items(),
+                key=lambda x: x[1]['total'], reverse=True):
+            lines.append('%-20s %8d %10.3f %10.3f %10.3f' % (stage,
+                data['count'], data['total'], data['mean'] * 1000,
+                data['max'] * 1000))
+        for name, value in sorted(report['counters'].items()):
+            lines.append('%-20s %8d' % (name, value))
+        for name, data in sorted(report['gauges'].items()):
+            lines.append('%-20s max %d' % (name, data['max']))
+        if report['slowest']:
+            lines.append('\nslowest formulas:')
+            for item in report['slowest']:
+                formula = item['formula'].replace('\n', ' ')
+                formula = (formula[:60] + '...' if len(formula) > 60 else formula)
+                lines.append('%10.3f ms  %s' % (item['duration'] * 1000, formula))
+        return '\n'.join(lines)
+
+
+class _Timer:
+    """Context manager measuring the time of its block for a profiler."""
+    def __init__(self, profiler, stage, formula):
+        self.__profiler = profiler
+        self.__stage = stage
+        self.__formula = formula
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_args):
+        self.__profiler.record(self.__stage, time.perf_counter() - self.__start,
+                self.__formula)
+
+
+class _NullTimer:
+    """Context manager doing nothing, used if no profiler is installed."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        pass
+
+_NULL_TIMER = _NullTimer()
+_profiler = None
+
+def install(profiler):
+    """Install the given profiler, so that the hooks record into it."""
+    global _profiler #pylint: disable=global-statement
+    _profiler = profiler
+
+def uninstall():
+    """Remove the installed profiler, if any."""
+    install(None)
+
+def get_profiler():
+    """Return the installed profiler or None."""
+    return _profiler
+
+def measure(stage, formula=None):
+    """Return a context manager which records the duration of its block as the
+    given stage. This is cheap if no profiler is installed."""
+    profiler = _profiler
+    if profiler is None:
+        return _NULL_TIMER
+    return _Timer(profiler, stage, formula)
+
+def count(name, value=1):
+    """Increase a counter of the installed profiler, if any."""
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(name, value)
+
+def gauge(name, value):
+    """Record a gauge value with the installed profiler, if any."""
+    profiler = _profiler
+    if profiler is not None:
+        profiler.gauge(name, value)
@@ -0,0 +1,212 @@
+"""A second cache tier, shared between machines (e.g. CI workers), which stores
+rendered formulas along with their positioning information.
+
+The entries are keyed by a fingerprint of everything which influences the
+image: the complete LaTeX document and the image options (see fingerprint).
+Each entry is stored as a single record: a line with the positioning
+information as JSON, followed by the PNG data.
+
+Two backends are provided: DirectoryBackend stores the records in a (possibly
+network-mounted) directory and HttpBackend talks to a server using a simple
+protocol:
+
+    GET <url>/<key>  returns the record or 404 if unknown
+    PUT <url>/<key>  stores the record given as request body
+
+CacheServer is a minimal implementation of such a server, storing the records
+in a directory:
+
+    server = CacheServer(('localhost', 0), 'records')
+    threading.Thread(target=server.serve_forever).start()
+    backend = HttpBackend(server.get_url())
+"""
+
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import os
+import re
+import urllib.error
+import urllib.request
+
+from . import caching
+
+# version of the record format and the fingerprint; changing it invalidates
+# all remote entries
+FORMAT_VERSION = '1'
+# keys are hexadecimal SHA-256 digests
+KEY = re.compile(r'^[0-9a-f]{64}$')
+
+class RemoteCacheError(OSError):
+    """Raised if the remote cache cannot be reached or returned garbage."""
+    pass
+
+def fingerprint(document, options=()):
+    """Return the key for a formula: a hash of the LaTeX document containing
+    it and the given image options (e.g. resolution and colours)."""
+    digest = hashlib.sha256(FORMAT_VERSION.encode('ascii'))
+    for part in [document] + [str(o) for o in options]:
+        digest.update(b'\0' + part.encode('utf-8'))
+    return digest.hexdigest()
+
+def encode_record(pos, data):
+    """Encode positioning information (dictionary with depth, height and
+    width) and PNG data into a record."""
+    return json.dumps(pos, sort_keys=True).encode('utf-8') + b'\n' + data
+
+#: keys of the positioning information stored along with each image
+POSITIONING_KEYS = ('depth', 'height', 'width')
+
+def decode_record(record):
+    """Split a record into positioning information and PNG data. The
+    positioning information must consist of integer depth, height and width;
+    everything else is rejected, since a shared cache must not be able to
+    inject arbitrary values into the generated HTML.
+    :raises RemoteCacheError if the record is malformed"""
+    header, sep, data = record.partition(b'\n')
+    try:
+        pos = json.loads(header.decode('utf-8'))
+    except ValueError:
+        pos = None
+    if not sep or not isinstance(pos, dict) or not data or not all(
+            type(pos.get(key)) is int for key in POSITIONING_KEYS):
+        raise RemoteCacheError("malformed record in remote cache")
+    return ({key: pos[key] for key in POSITIONING_KEYS}, data)
+
+class DirectoryBackend:
+    """Store records as files in a directory, which might be shared between
+    machines."""
+    def __init__(self, path):
+        self.__path = path
+
+    def get(self, key):
+        """Return the record for the given key or None if unknown."""
+        try:
+            with open(os.path.join(self.__path, key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise RemoteCacheError(str(e))
+
+    def get_many(self, keys):
+        """Return a dictionary mapping the given keys to their records; unknown
+        keys are left out."""
+        records = {}
+        for key in keys:
+            record = self.get(key)
+            if record is not None:
+                records[key] = record
+        return records
+
+    def put(self, key, record):
+        """Store a record. The record is written atomically, so that
+        concurrent readers never see a partial record."""
+        try:
+            if not os.path.exists(self.__path):
+                os.makedirs(self.__path, exist_ok=True)
+            # readable by others, the directory might be shared between users
+            handle, tmp_fn = caching.create_temporary_file(self.__path)
+            with os.fdopen(handle, 'wb') as file:
+                file.write(record)
+            os.replace(tmp_fn, os.path.join(self.__path, key))
+        except OSError as e:
+            raise RemoteCacheError(str(e))
+
+class HttpBackend:
+    """Retrieve and store records via HTTP GET and PUT requests, see the module
+    documentation. Lookups of several keys are issued concurrently."""
+    def __init__(self, url, timeout=10, connections=8):
+        self.__url = url.rstrip('/')
+        self.__timeout = timeout
+        self.__connections = connections
+
+    def __request(self, key, method='GET', data=None):
+        request = urllib.request.Request('%s/%s' % (self.__url, key),
+                data=data, method=method)
+        if data is not None:
+            request.add_header('Content-Type', 'application/octet-stream')
+        try:
+            with urllib.request.urlopen(request, timeout=self.__timeout) as r:
+                return r.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404 and method == 'GET':
+                return None
+            raise RemoteCacheError("%s %s failed: %s" % (method, self.__url,
+                e))
+        except (urllib.error.URLError, OSError) as e:
+            raise RemoteCacheError("%s %s failed: %s" % (method, self.__url,
+                e))
+
+    def get(self, key):
+        """Return the record for the given key or None if unknown."""
+        return self.__request(key)
+
+    def get_many(self, keys):
+        """Return a dictionary mapping the given keys to their records; unknown
+        keys are left out. The first failing request aborts the lookup."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(
+                self.__connections, len(keys))) as executor:
+            records = executor.map(self.get, keys)
+            return {key: record for key, record in zip(keys, records)
+                    if record is not None}
+
+    def put(self, key, record):
+        """Store a record."""
+        self.__request(key, 'PUT', record)
+
+def get_backend(location):
+    """Return a backend for the given location, which is either a HTTP(S) URL
+    or a directory."""
+    if location.startswith(('http://', 'https://')):
+        return HttpBackend(location)
+    return DirectoryBackend(location)
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    def _get_key(self):
+        key = self.path.strip('/')
+        if not KEY.match(key):
+            self.send_error(400, "invalid key")
+            return None
+        return key
+
+    def do_GET(self): #pylint: disable=invalid-name
+        key = self._get_key()
+        if key:
+            record = self.server.backend.get(key)
+            if record is None:
+                self.send_error(404)
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(record)))
+                self.end_headers()
+                self.wfile.write(record)
+
+    def do_PUT(self): #pylint: disable=invalid-name
+        key = self._get_key()
+        if key:
+            length = int(self.headers.get('Content-Length', 0))
+            self.server.backend.put(key, self.rfile.read(length))
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *args): #pylint: disable=arguments-differ
+        pass # don't clutter stderr
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    """A minimal remote cache server, storing the records in a directory. It
+    is meant for testing and small setups."""
+    def __init__(self, address, path):
+        super().__init__(address, _RequestHandler)
+        self.backend = DirectoryBackend(path)
+
+    def get_url(self):
+        """Return the URL under which the server is reachable."""
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
@@ -0,0 +1,263 @@
+"""Transport for running GladTeX as a long-running server. Requests and
+responses are JSON objects, sent via HTTP POST to /<request name>, either over
+a Unix domain socket or a TCP connection to localhost:
+
+    server = RenderServer('/tmp/gladtex.sock', {'echo': lambda data: data})
+    threading.Thread(target=server.serve_forever).start()
+    request('/tmp/gladtex.sock', 'echo', {'some': 'data'})
+
+The server handles each request in a thread of its own. What the requests do
+is up to the handlers, see gladtex.py for the document conversion.
+
+Since the handlers act on behalf of the user running the server, requests are
+authenticated: the server writes a random token to a file only readable by
+its owner (see get_token_path), which request() sends along. Additionally,
+TCP servers only listen on loopback addresses, Unix domain sockets are only
+accessible by their owner and requests from web browsers (with an Origin
+header, a foreign Host header or a content type other than JSON) are
+rejected.
+"""
+
+import hmac
+import http.client
+import http.server
+import ipaddress
+import json
+import os
+import secrets
+import socket
+import socketserver
+
+#: header carrying the token of the server, see get_token_path
+TOKEN_HEADER = 'X-GladTeX-Token'
+
+class ServerUnavailable(OSError):
+    """Raised if no server is listening at the given address."""
+    pass
+
+def parse_address(address):
+    """Parse a server address: a port number or HOST:PORT is a TCP address
+    (the host defaults to localhost), anything else the path to a Unix domain
+    socket. Returned is a tuple with the socket family and the address."""
+    host, sep, port = address.rpartition(':')
+    if port.isdigit() and (sep or not os.path.sep in address):
+        return (socket.AF_INET, (host if host else '127.0.0.1', int(port)))
+    return (socket.AF_UNIX, address)
+
+def check_loopback(host):
+    """Make sure that the given host name refers to a loopback address.
+    :raises OSError otherwise"""
+    try:
+        address = ipaddress.ip_address(socket.gethostbyname(host))
+    except ValueError:
+        address = None
+    if address is None or not address.is_loopback:
+        raise OSError("refusing to listen on %s, only loopback addresses are "
+                "allowed" % host)
+
+def get_token_path(address):
+    """Return the path of the file with the token of the server at the given
+    address: next to a Unix domain socket, in the home directory of the user
+    for a TCP port."""
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+        return address + '.token'
+    return os.path.join(os.path.expanduser('~'),
+            '.gladtex-server-%d.token' % address[1])
+
+def is_loopback_host(host):
+    """Check whether the value of a Host header names the local machine. Host
+    names are not resolved, so that a name pointing to a loopback address
+    (DNS rebinding) isn't accepted."""
+    if host.startswith('['):
+        host = host[1:].partition(']')[0]
+    elif host.count(':') == 1:
+        host = host.partition(':')[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self): #pylint: disable=invalid-name
+        if self.path == '/status':
+            from . import VERSION # the package is initialised by now
+            self.__respond(200, {'gladtex': VERSION, 'pid': os.getpid()})
+        else:
+            self.__respond(404, {'error': 'unknown request'})
+
+    def do_POST(self): #pylint: disable=invalid-name
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.partition(';')[0].strip() != 'application/json':
+            self.__respond(415, {'error': 'requests must be JSON'})
+            return
+        if 'Origin' in self.headers or not is_loopback_host(
+                self.headers.get('Host', '')):
+            self.__respond(403, {'error': 'requests from browsers or other '
+                'machines are not accepted'})
+            return
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''),
+                self.server.token):
+            self.__respond(403, {'error': 'invalid token'})
+            return
+        handler = self.server.handlers.get(self.path.strip('/'))
+        if not handler:
+            self.__respond(404, {'error': 'unknown request'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            self.__respond(400, {'error': 'invalid request: %s' % e})
+            return
+        self.__respond(200, handler(data))
+
+    def __respond(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix domain sockets have no client address
+        return (self.client_address[0] if self.client_address else 'local')
+
+    def log_message(self, *args): #pylint: disable=arguments-differ
+        pass # don't clutter stderr
+
+class _TcpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _address = super().get_request()
+        return (request, ('local', 0))
+
+class RenderServer:
+    """Accept requests at the given address (see parse_address) and pass them
+    to the handler registered for the request name. A handler gets the
+    decoded JSON object and returns the response object.
+    A stale Unix domain socket (no server listening) is replaced.
+    The token for the requests is written to the file given by get_token_path
+    and removed by close().
+    :raises OSError if the address cannot be used, e.g. a TCP address which is
+        not a loopback address (see check_loopback)"""
+    def __init__(self, address, handlers):
+        family, address = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                if is_running(address):
+                    raise OSError("a server is already listening at " + address)
+                os.remove(address)
+            self.__server = _UnixServer(address, _RequestHandler)
+            os.chmod(address, 0o600)
+        else:
+            check_loopback(address[0])
+            self.__server = _TcpServer(address, _RequestHandler)
+        self.__server.handlers = handlers
+        self.__family = family
+        self.__address = address
+        self.__server.token = secrets.token_hex(16)
+        self.__token_path = get_token_path(self.get_address())
+        try:
+            self.__write_token()
+        except OSError:
+            self.__server.server_close()
+            raise
+
+    def __write_token(self):
+        """Write the token to a new file, only readable by the owner."""
+        if os.path.exists(self.__token_path):
+            os.remove(self.__token_path) # left by a crashed server
+        handle = os.open(self.__token_path, os.O_WRONLY | os.O_CREAT |
+                os.O_EXCL, 0o600)
+        with os.fdopen(handle, 'w') as file:
+            file.write(self.__server.token)
+
+    def get_address(self):
+        """Return the address the server listens at, in the format accepted by
+        request()."""
+        if self.__family == socket.AF_UNIX:
+            return self.__address
+        return '%s:%d' % self.__server.server_address[:2]
+
+    def serve_forever(self):
+        self.__server.serve_forever()
+
+    def shutdown(self):
+        """Stop serve_forever (from another thread)."""
+        self.__server.shutdown()
+
+    def close(self):
+        """Close the socket; a Unix domain socket and the token are
+        removed."""
+        self.__server.server_close()
+        if os.path.exists(self.__token_path):
+            os.remove(self.__token_path)
+        if self.__family == socket.AF_UNIX and os.path.exists(self.__address):
+            os.remove(self.__address)
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.__path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.__path)
+
+def _connect(address, timeout=None):
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+        return _UnixConnection(address, timeout=timeout)
+    return http.client.HTTPConnection(*address, timeout=timeout)
+
+def request(address, name, data, timeout=None):
+    """Send a request to the server at the given address and return the
+    decoded response. The token of the server is read from the file given by
+    get_token_path.
+    :raises ServerUnavailable if no server is listening
+    :raises OSError for other communication errors"""
+    try:
+        with open(get_token_path(address), encoding='utf-8') as file:
+            token = file.read().strip()
+    except FileNotFoundError:
+        token = '' # rejected by the server, if it's running
+    connection = _connect(address, timeout)
+    try:
+        body = json.dumps(data).encode('utf-8')
+        try:
+            connection.request('POST', '/' + name, body,
+                    {'Content-Type': 'application/json', TOKEN_HEADER: token})
+        except (ConnectionRefusedError, FileNotFoundError) as e:
+            raise ServerUnavailable(str(e))
+        response = connection.getresponse()
+        try:
+            result = json.loads(response.read().decode('utf-8'))
+        except ValueError as e:
+            raise OSError("invalid response from server: %s" % e)
+        if response.status != 200:
+            raise OSError("server error: %s" % result.get('error'))
+        return result
+    except http.client.HTTPException as e:
+        raise OSError("communication with server failed: %s" % e)
+    finally:
+        connection.close()
+
+def is_running(address):
+    """Check whether a server is listening at the given address."""
+    family, address = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(address)
+        except OSError:
+            return False
+    return True
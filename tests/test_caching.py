@@ -1,9 +1,12 @@
 #pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import gzip
+import json
 import os
 import shutil
 import tempfile
+import time
 import unittest
-from gleetex import caching
+from gleetex import caching, profiling
 
 def write(path, content):
     with open(path, 'w', encoding='utf-8') as f:
@@ -147,3 +150,252 @@ class test_caching(unittest.TestCase):
             c.get_data_for('foo.png', 'False')
 
 
+
+    def test_that_hits_and_misses_are_counted(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png', False)
+        c.contains('\\tau', False)
+        c.contains('\\tau', True)
+        c.contains('\\gamma', False)
+        stats = c.get_statistics()
+        self.assertEqual(stats['hits'], {'inline': 1, 'displaymath': 0})
+        self.assertEqual(stats['misses'], {'inline': 1, 'displaymath': 1})
+
+    def test_that_hits_and_misses_are_reported_to_profiler(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png', False)
+        p = profiling.Profiler()
+        profiling.install(p)
+        try:
+            c.contains('\\tau', False)
+            c.contains('\\gamma', False)
+            c.contains('\\gamma', True)
+            c.get_data_for('\\tau', False, count=False)
+        finally:
+            profiling.uninstall()
+        counters = p.get_report()['counters']
+        self.assertEqual(counters, {'cache_hits': 1, 'cache_misses': 2})
+
+    def test_that_stale_entries_and_written_bytes_are_counted(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png', False)
+        c.write()
+        self.assertEqual(c.get_statistics()['bytes_written'],
+                os.path.getsize('gladtex.cache'))
+        os.remove('foo.png')
+        c.set_strict(True)
+        self.assertFalse(c.contains('\\tau', False))
+        self.assertEqual(c.get_statistics()['stale'], 1)
+
+    def test_that_missing_images_are_detected_when_reading_cache(self):
+        write('foo.png', 'dummy')
+        write('bar.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png', False)
+        c.add_formula('\\tau', self.pos, 'bar.png', True)
+        c.write()
+        os.remove('bar.png')
+        c = caching.ImageCache('gladtex.cache')
+        self.assertTrue(c.contains('\\tau', False))
+        self.assertFalse(c.contains('\\tau', True))
+        self.assertEqual(c.get_statistics()['stale'], 1)
+
+    def test_that_lookups_dont_check_file_system_unless_strict(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png', False)
+        os.remove('foo.png')
+        self.assertTrue(c.contains('\\tau', False))
+        c.set_strict(True)
+        self.assertFalse(c.contains('\\tau', False))
+
+    def test_that_orphaned_images_are_collected(self):
+        old = time.time() - caching.ORPHAN_MIN_AGE - 1
+        for name in ['eqn000.png', 'eqn001.png', 'eqn002.tex']:
+            write(name, 'dummy')
+            os.utime(name, (old, old))
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'eqn000.png', False)
+        removed = c.collect_garbage()
+        self.assertEqual(removed['files'], 1)
+        self.assertEqual(removed['entries'], 0)
+        self.assertTrue(os.path.exists('eqn000.png'))
+        self.assertFalse(os.path.exists('eqn001.png'))
+        self.assertTrue(os.path.exists('eqn002.tex'))
+
+    def test_that_images_of_running_conversions_are_kept(self):
+        old = time.time() - caching.ORPHAN_MIN_AGE - 1
+        write('eqn000.png', 'dummy')
+        os.utime('eqn000.png', (old, old))
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'eqn000.png', False)
+        c.write()
+        # another process claims a name, renders an image and caches it
+        _number, claimed = caching.claim_file_name('eqn%03d.png')
+        os.utime(claimed, (old, old))
+        write('eqn002.png', 'dummy') # rendered, but not cached yet
+        write('eqn003.png', 'dummy')
+        os.utime('eqn003.png', (old, old))
+        other = caching.ImageCache('gladtex.cache')
+        other.add_formula('\\gamma', self.pos, 'eqn003.png', False)
+        other.write()
+        removed = c.collect_garbage()
+        self.assertEqual(removed['files'], 0)
+        for name in [claimed, 'eqn002.png', 'eqn003.png']:
+            self.assertTrue(os.path.exists(name), name)
+
+    def test_that_least_recently_used_entries_are_evicted(self):
+        c = caching.ImageCache('gladtex.cache')
+        for index, formula in enumerate(['a', 'b', 'c']):
+            write('eqn%03d.png' % index, 'x' * 10)
+            c.add_formula(formula, self.pos, 'eqn%03d.png' % index)
+        c._ImageCache__cache['a'][False]['used'] = 1
+        c._ImageCache__cache['b'][False]['used'] = 3
+        c._ImageCache__cache['c'][False]['used'] = 2
+        removed = c.collect_garbage(max_entries=1)
+        self.assertEqual(removed['entries'], 2)
+        self.assertTrue(c.contains('b', False))
+        self.assertFalse(os.path.exists('eqn000.png'))
+        self.assertFalse(os.path.exists('eqn002.png'))
+
+    def test_that_eviction_respects_byte_budget(self):
+        c = caching.ImageCache('gladtex.cache')
+        for index, formula in enumerate(['a', 'b', 'c']):
+            write('eqn%03d.png' % index, 'x' * 10)
+            c.add_formula(formula, self.pos, 'eqn%03d.png' % index)
+        removed = c.collect_garbage(max_bytes=25)
+        self.assertEqual(removed['entries'], 1)
+        self.assertEqual(removed['bytes'], 10)
+        self.assertEqual(len(c), 2)
+
+    def test_that_lookups_update_usage(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png', False)
+        c.get_data_for('\\tau', False)
+        data = c.get_data_for('\\tau', False)
+        self.assertEqual(data['uses'], 2)
+        self.assertTrue(data['used'] > 0)
+
+    def test_that_cache_is_written_compressed_and_columnar(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', {'height': '8', 'depth': '-2', 'width': '6'},
+                'foo.png', True)
+        c.write()
+        with gzip.open('gladtex.cache', 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        self.assertEqual(data['version'], caching.CACHE_VERSION)
+        self.assertEqual(data['formulas'], ['\\tau'])
+        self.assertEqual(data['displaymath'], [1])
+        self.assertEqual(data['depth'], [-2])
+        c = caching.ImageCache('gladtex.cache')
+        self.assertEqual(c.get_data_for('\\tau', True)['pos'],
+                {'height': 8, 'depth': -2, 'width': 6})
+
+    def test_that_uncompressed_caches_can_be_read(self):
+        write('foo.png', 'dummy')
+        write('gladtex.cache', json.dumps({
+            caching.ImageCache.VERSION_STR: caching.LEGACY_CACHE_VERSION,
+            '\\tau': {'false': {'pos': self.pos, 'path': 'foo.png'}}}))
+        c = caching.ImageCache('gladtex.cache')
+        self.assertEqual(c.get_data_for('\\tau', False)['path'], 'foo.png')
+        c.write()
+        c = caching.ImageCache('gladtex.cache')
+        self.assertTrue(c.contains('\\tau', False))
+
+    def test_that_legacy_version_mismatch_names_legacy_version(self):
+        write('gladtex.cache', json.dumps({
+            caching.ImageCache.VERSION_STR: '1.0'}))
+        with self.assertRaises(caching.JsonParserException) as context:
+            caching.ImageCache('gladtex.cache')
+        self.assertTrue('expected %s' % caching.LEGACY_CACHE_VERSION in
+                str(context.exception))
+
+    def test_that_truncated_caches_are_detected(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png')
+        c.write()
+        with open('gladtex.cache', 'rb') as f:
+            data = f.read()
+        with open('gladtex.cache', 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertRaises(caching.JsonParserException, caching.ImageCache,
+                'gladtex.cache')
+
+    def test_that_concurrent_writers_are_merged(self):
+        write('foo.png', 'dummy')
+        write('bar.png', 'dummy')
+        first = caching.ImageCache('gladtex.cache')
+        second = caching.ImageCache('gladtex.cache')
+        first.add_formula('\\tau', self.pos, 'foo.png')
+        first.write()
+        second.add_formula('\\gamma', self.pos, 'bar.png')
+        second.write()
+        c = caching.ImageCache('gladtex.cache')
+        self.assertTrue(c.contains('\\tau', False))
+        self.assertTrue(c.contains('\\gamma', False))
+
+    def test_that_removed_entries_are_not_merged_back(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png')
+        c.write()
+        other = caching.ImageCache('gladtex.cache')
+        other.remove_formula('\\tau', False)
+        write('bar.png', 'dummy')
+        other.add_formula('\\gamma', self.pos, 'bar.png')
+        c.write() # cache changed on disk in the meantime
+        other.write()
+        self.assertFalse(caching.ImageCache('gladtex.cache').contains('\\tau',
+            False))
+
+    def test_that_file_names_are_claimed_atomically(self):
+        write('eqn000.png', 'dummy')
+        self.assertEqual(caching.claim_file_name('eqn%03d.png'),
+                (1, 'eqn001.png'))
+        self.assertTrue(os.path.exists('eqn001.png'))
+        self.assertEqual(caching.claim_file_name('eqn%03d.png')[0], 2)
+
+    def test_that_files_get_the_mode_given_by_umask(self):
+        umask = os.umask(0o027)
+        try:
+            write('foo.png', 'dummy')
+            c = caching.ImageCache('gladtex.cache')
+            c.add_formula('\\tau', self.pos, 'foo.png')
+            c.write()
+            _number, path = caching.claim_file_name('eqn%03d.png')
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat('gladtex.cache').st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+
+    def test_that_unchanged_cache_is_not_written(self):
+        c = caching.ImageCache('gladtex.cache')
+        c.write()
+        self.assertFalse(os.path.exists('gladtex.cache'))
+        write('foo.png', 'dummy')
+        c.add_formula('\\tau', self.pos, 'foo.png')
+        c.write()
+        stat = os.stat('gladtex.cache')
+        c = caching.ImageCache('gladtex.cache')
+        self.assertTrue(c.get_data_for('\\tau', False))
+        c.write() # usage is recent, not worth a write
+        self.assertEqual(os.stat('gladtex.cache').st_ino, stat.st_ino)
+
+    def test_that_outdated_usage_information_is_written(self):
+        write('foo.png', 'dummy')
+        c = caching.ImageCache('gladtex.cache')
+        c.add_formula('\\tau', self.pos, 'foo.png')
+        c.get_data_for('\\tau', False)['used'] -= \
+                caching.USAGE_WRITE_INTERVAL + 1
+        c.write()
+        c = caching.ImageCache('gladtex.cache')
+        c.get_data_for('\\tau', False)
+        c.write()
+        entry = caching.ImageCache('gladtex.cache').get_data_for('\\tau', False)
+        self.assertTrue(entry['used'] > time.time() - 60)
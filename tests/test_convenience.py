@@ -1,10 +1,14 @@
 #pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import asyncio
+import concurrent.futures
 import distutils
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
-from gleetex import convenience, image
+from gleetex import convenience, image, profiling, remotecache
 from gleetex.convenience import ConversionException
 from gleetex.caching import JsonParserException
 
@@ -61,6 +65,21 @@ class Tex2imgMock():
         return {}
 
 
+class AsyncTex2imgMock(Tex2imgMock):
+    """Count the conversions and take a while, so that requests overlap."""
+    conversions = []
+    async def convert_async(self):
+        AsyncTex2imgMock.conversions.append(self.output_name)
+        await asyncio.sleep(0.05)
+        if 'fail' in self.tex_document:
+            raise image.subprocess.SubprocessError('LaTeX failed')
+        self.convert()
+
+    def __init__(self, tex_document, output_fn, _encoding="UTF-8"):
+        super().__init__(tex_document, output_fn)
+        self.tex_document = tex_document
+
+
 class TestCachedConverter(unittest.TestCase):
     #pylint: disable=protected-access
     def setUp(self):
@@ -108,8 +127,8 @@ class TestCachedConverter(unittest.TestCase):
         c = convenience.CachedConverter('', keep_old_cache=False)
         c._convert_concurrently(formulas)
         # cache got overridden
-        with open('gladtex.cache') as f:
-            self.assertFalse('invalid' in f.read())
+        with open('gladtex.cache', 'rb') as f:
+            self.assertFalse(b'invalid' in f.read())
 
     def test_that_converted_formulas_are_cached(self):
         formulas = [mk_eqn('tau')]
@@ -129,6 +148,16 @@ class TestCachedConverter(unittest.TestCase):
         self.assertTrue(len(to_convert), 1)
         self.assertEqual(to_convert[0][2], 'eqn002.png')
 
+    def test_that_concurrent_converters_pick_different_file_names(self):
+        formulas = turn_into_orig_formulas([mk_eqn('\\tau')])
+        first = convenience.CachedConverter('')
+        second = convenience.CachedConverter('')
+        planned = first._get_formulas_to_convert('', formulas) + \
+                second._get_formulas_to_convert('', formulas)
+        self.assertEqual([p[2] for p in planned], ['eqn000.png', 'eqn001.png'])
+        convenience.release_file_names(p[2] for p in planned)
+        self.assertEqual(get_number_of_files('.'), 0)
+
     def test_that_all_converted_formulas_are_in_cache_and_meta_info_correct(self):
         formulas = [mk_eqn('a_{%d}' % i, pos=(i,i), count=i) for i in range(100)]
         c = convenience.CachedConverter('')
@@ -149,3 +178,257 @@ class TestCachedConverter(unittest.TestCase):
         # expect all formulas and a gladtex cache to exist
         self.assertEqual(get_number_of_files('.'), len(formulas)+1)
 
+
+    def test_that_timeouts_can_be_configured_and_are_reported(self):
+        c = convenience.CachedConverter('')
+        c.set_option('latex_timeout', 5)
+        c.set_option('dvipng_timeout', image.TimeoutPolicy(7, adaptive=True))
+        stats = c.get_timeout_statistics()
+        self.assertEqual(stats['latex']['timeout'], 5)
+        self.assertEqual(stats['latex']['timeouts'], 0)
+        self.assertTrue(stats['dvipng']['adaptive'])
+
+    def test_that_scratch_directories_are_reused_and_removed(self):
+        c = convenience.CachedConverter('')
+        c.set_scratch_base(self.tmpdir)
+        first = c._get_scratch_directory()
+        self.assertEqual(first, c._get_scratch_directory())
+        c.remove_scratch_directories()
+        self.assertFalse(os.path.exists(first))
+
+    def test_that_convert_all_only_removes_its_own_scratch_directories(self):
+        class ScratchMock(Tex2imgMock):
+            def set_scratch_directory(self, path):
+                self.scratch = path
+            def convert(self):
+                if not os.path.isdir(self.scratch):
+                    raise OSError('scratch directory missing')
+                super().convert()
+        convenience.CachedConverter._converter = ScratchMock
+        os.mkdir('scratch')
+        c = convenience.CachedConverter('')
+        c.set_scratch_base('scratch')
+        other = c._get_scratch_directory() # e.g. of a concurrent convert_all
+        c.convert_all('', [((1, 1), False, 'a'), ((2, 1), False, 'b')])
+        self.assertEqual(os.listdir('scratch'), [os.path.basename(other)])
+        c.remove_scratch_directories()
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_that_scratch_directories_can_be_disabled(self):
+        c = convenience.CachedConverter('')
+        c.set_scratch_base(None)
+        self.assertEqual(c._get_scratch_directory(), None)
+
+    def test_that_malformed_formulas_are_reported_before_conversion(self):
+        formulas = [((0, 4), False, '\\frac{a}{b'), ((1, 0), False, 'x'),
+                ((2, 7), False, '\\left( x')]
+        c = convenience.CachedConverter('')
+        with self.assertRaises(convenience.FormulaValidationException) as ctx:
+            c.convert_all('', formulas)
+        errors = ctx.exception.errors
+        self.assertEqual(len(errors), 2)
+        self.assertEqual((errors[0].src_line_number, errors[0].src_pos_on_line),
+                (1, 5))
+        self.assertEqual(errors[1].formula_count, 3)
+        # nothing has been converted
+        self.assertFalse(any(f.endswith('.png') for f in os.listdir('.')))
+
+    def test_that_validation_can_be_disabled(self):
+        c = convenience.CachedConverter('')
+        c.set_validate_formulas(False)
+        c.convert_all('', [((0, 4), False, '\\frac{a}{b')])
+        self.assertTrue(c.get_data_for('\\frac{a}{b', False))
+
+    def test_that_conversion_statistics_are_collected(self):
+        formulas = [((1, 1), False, 'a'), ((2, 1), False, 'a'),
+                ((3, 1), True, 'a')]
+        c = convenience.CachedConverter('')
+        c.convert_all('', formulas)
+        stats = c.get_statistics()
+        self.assertEqual(stats['planned'], 3)
+        self.assertEqual(stats['duplicates'], 1)
+        self.assertEqual(stats['to_convert'], {'inline': 1, 'displaymath': 1})
+        self.assertEqual(stats['converted'], 2)
+        self.assertTrue(stats['cache']['bytes_written'] > 0)
+        c.convert_all('', formulas)
+        self.assertEqual(c.get_statistics()['converted'], 2)
+
+    def test_that_only_planning_lookups_are_counted(self):
+        formulas = [((1, 1), False, 'a'), ((2, 1), False, 'b'),
+                ((3, 1), True, 'a')]
+        c = convenience.CachedConverter('')
+        c.convert_all('', formulas)
+        for _pos, dsp, formula in formulas: # as done for the output
+            c.get_data_for(formula, dsp)
+        cache = c.get_statistics()['cache']
+        self.assertEqual(cache['hits'], {'inline': 0, 'displaymath': 0})
+        self.assertEqual(cache['misses'], {'inline': 2, 'displaymath': 1})
+        c.convert_all('', formulas)
+        for _pos, dsp, formula in formulas:
+            c.get_data_for(formula, dsp)
+        cache = c.get_statistics()['cache']
+        self.assertEqual(cache['hits'], {'inline': 2, 'displaymath': 1})
+        self.assertEqual(cache['misses'], {'inline': 2, 'displaymath': 1})
+
+    def test_that_formulas_are_shared_through_remote_cache(self):
+        formulas = [((1, 1), False, 'a'), ((2, 1), True, 'b')]
+        remote = remotecache.DirectoryBackend('remote')
+        first = convenience.CachedConverter('first')
+        first.set_remote_cache(remote)
+        first.convert_all('first', formulas)
+        self.assertEqual(first.get_statistics()['remote'], {'hits': 0,
+            'misses': 2, 'uploads': 2, 'errors': 0})
+        second = convenience.CachedConverter('second')
+        second.set_remote_cache(remote)
+        second.convert_all('second', formulas)
+        stats = second.get_statistics()
+        self.assertEqual(stats['converted'], 0)
+        self.assertEqual(stats['remote']['hits'], 2)
+        data = second.get_data_for('b', True)
+        self.assertEqual(data['pos'], {'depth': 9, 'height': 8, 'width': 7})
+        with open(data['path']) as f:
+            self.assertEqual(f.read(), 'dummy')
+
+    def test_that_malformed_remote_records_fall_back_to_rendering(self):
+        remote = remotecache.DirectoryBackend('remote')
+        c = convenience.CachedConverter('')
+        c.set_remote_cache(remote)
+        remote.put(c._get_fingerprint('a', False), b'{}\nPNG')
+        remote.put(c._get_fingerprint('b', False), b'{"depth": 1, "height": '
+                b'"1\\" onload=\\"x", "width": 1}\nPNG')
+        c.convert_all('', [((1, 1), False, 'a'), ((2, 1), False, 'b')])
+        stats = c.get_statistics()
+        self.assertEqual(stats['converted'], 2)
+        self.assertEqual(stats['remote']['hits'], 0)
+        self.assertEqual(c.get_data_for('b', False)['pos'], {'depth': 9,
+            'height': 8, 'width': 7})
+
+    def test_that_unreachable_remote_cache_falls_back_to_rendering(self):
+        c = convenience.CachedConverter('')
+        c.set_remote_cache(remotecache.HttpBackend('http://127.0.0.1:9',
+            timeout=1))
+        c.convert_all('', [((1, 1), False, 'a')])
+        stats = c.get_statistics()
+        self.assertEqual(stats['converted'], 1)
+        # the unreachable cache isn't asked again for the upload
+        self.assertEqual(stats['remote']['errors'], 1)
+
+
+    def test_that_concurrent_conversions_of_a_formula_are_coalesced(self):
+        conversions = []
+        class SlowMock(Tex2imgMock):
+            def convert(self):
+                conversions.append(self.output_name)
+                time.sleep(0.1)
+                super().convert()
+        convenience.CachedConverter._converter = SlowMock
+        c = convenience.CachedConverter('')
+        p = profiling.Profiler()
+        profiling.install(p)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda i: c.convert('a',
+                    'eqn%03d.png' % i), range(4)))
+        finally:
+            profiling.uninstall()
+        self.assertEqual(conversions, ['eqn000.png'])
+        self.assertEqual([r['path'] for r in results], ['eqn000.png'] * 4)
+        self.assertEqual(c.get_statistics()['coalesced'], 3)
+        self.assertEqual(p.get_report()['counters']['coalesced'], 3)
+
+    def test_that_finished_conversions_are_not_reused(self):
+        c = convenience.CachedConverter('')
+        self.assertEqual(c.convert('a', 'eqn000.png')['path'], 'eqn000.png')
+        # not added to the cache, so it's converted again
+        self.assertEqual(c.convert('a', 'eqn001.png')['path'], 'eqn001.png')
+        self.assertEqual(c.get_statistics()['coalesced'], 0)
+
+    def test_that_failed_conversions_are_retried(self):
+        class FailingMock(Tex2imgMock):
+            def convert(self):
+                raise image.subprocess.SubprocessError('failed')
+        convenience.CachedConverter._converter = FailingMock
+        c = convenience.CachedConverter('')
+        self.assertRaises(image.subprocess.SubprocessError, c.convert, 'a',
+                'eqn000.png')
+        convenience.CachedConverter._converter = Tex2imgMock
+        self.assertEqual(c.convert('a', 'eqn000.png')['path'], 'eqn000.png')
+
+    def test_that_conversions_are_landed_after_unexpected_errors(self):
+        class BrokenMock(Tex2imgMock):
+            def convert(self):
+                if self.output_name == 'eqn001.png':
+                    raise OSError('disk full')
+                time.sleep(0.2) # finishes after the error propagated
+                super().convert()
+        convenience.CachedConverter._converter = BrokenMock
+        c = convenience.CachedConverter('')
+        formulas = [mk_eqn('a', count=0), mk_eqn('b', count=1)]
+        self.assertRaises(OSError, c._convert_concurrently, formulas)
+        # 'a' isn't in the cache, so it must be converted again
+        self.assertEqual(c.convert('a', 'eqn002.png')['path'], 'eqn002.png')
+        self.assertEqual(c.get_statistics()['coalesced'], 0)
+
+
+class TestAsyncCachedConverter(unittest.TestCase):
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        convenience.CachedConverter._converter = AsyncTex2imgMock
+        AsyncTex2imgMock.conversions = []
+
+    def tearDown(self):
+        convenience.CachedConverter._converter = image.Tex2img
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_that_concurrent_requests_are_coalesced(self):
+        c = convenience.AsyncCachedConverter('', concurrency=2)
+        async def run():
+            return await asyncio.gather(c.convert_formula('a'),
+                    c.convert_formula('a '), c.convert_formula('b'),
+                    c.convert_formula('a', displaymath=True))
+        results = asyncio.run(run())
+        c.close()
+        self.assertEqual(len(AsyncTex2imgMock.conversions), 3)
+        self.assertEqual(results[0]['path'], results[1]['path'])
+        self.assertEqual(len(set(r['path'] for r in results)), 3)
+        self.assertTrue(c.get_data_for('b', False))
+
+    def test_that_cached_formulas_are_not_converted_again(self):
+        c = convenience.AsyncCachedConverter('')
+        asyncio.run(c.convert_all_async([((1, 1), False, 'a')]))
+        asyncio.run(c.convert_all_async([((1, 1), False, 'a')]))
+        self.assertEqual(len(AsyncTex2imgMock.conversions), 1)
+
+    def test_that_cache_is_written_outside_of_event_loop(self):
+        c = convenience.AsyncCachedConverter('', concurrency=4)
+        writers = []
+        write_cache = c.write_cache
+        def record_write():
+            writers.append(threading.current_thread())
+            write_cache()
+        c.write_cache = record_write
+        asyncio.run(c.convert_all_async([((1, 1), False, f) for f in 'abcd']))
+        self.assertTrue(writers)
+        self.assertFalse(threading.current_thread() in writers)
+        # formulas converted during a write are written at once afterwards
+        self.assertTrue(len(writers) < 4)
+        cached = convenience.CachedConverter('')
+        for formula in 'abcd':
+            self.assertTrue(cached.get_data_for(formula, False))
+
+    def test_that_timed_out_requests_cancel_the_conversion(self):
+        c = convenience.AsyncCachedConverter('')
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(c.convert_formula('a', timeout=0.01))
+        self.assertFalse(c.get_statistics()['converted'])
+        # the claimed file name was released
+        self.assertFalse(any(f.endswith('.png') for f in os.listdir('.')))
+
+    def test_that_failures_raise_conversion_exception(self):
+        c = convenience.AsyncCachedConverter('')
+        with self.assertRaises(ConversionException):
+            asyncio.run(c.convert_formula('\\fail'))
+        self.assertFalse(any(f.endswith('.png') for f in os.listdir('.')))
@@ -41,6 +41,62 @@ class test_document(unittest.TestCase):
         self.assertTrue(r'\begin{flalign*}' in str(doc))
         self.assertTrue(r'\end{flalign*}' in str(doc))
 
+
+class test_find_structural_errors(unittest.TestCase):
+    def test_that_correct_formulas_have_no_errors(self):
+        for formula in ['\\frac{a}{b}', '\\left\\{ x \\right.', '50\\%',
+                '\\begin{pmatrix} 1 \\end{pmatrix}', '\\leftarrow x',
+                'x % {comment']:
+            self.assertEqual(document.find_structural_errors(formula), [])
+
+    def test_that_unbalanced_braces_are_found(self):
+        self.assertEqual(document.find_structural_errors('\\frac{a{b}')[0][0], 5)
+        self.assertEqual(document.find_structural_errors('a}b')[0][0], 1)
+
+    def test_that_unmatched_left_and_right_are_found(self):
+        self.assertEqual(len(document.find_structural_errors('\\left( x')), 1)
+        self.assertEqual(len(document.find_structural_errors('x \\right)')), 1)
+
+    def test_that_mismatched_environments_are_found(self):
+        errors = document.find_structural_errors('\\begin{a} x \\end{b}')
+        self.assertEqual(errors[0][0], 12)
+        self.assertEqual(len(document.find_structural_errors('\\begin{a} x')), 1)
+
+    def test_that_all_errors_are_reported(self):
+        self.assertEqual(len(document.find_structural_errors('{ \\left( }}')), 2)
+
+
+class test_template(unittest.TestCase):
+    def test_that_template_output_equals_document_output(self):
+        for displaymath in (True, False):
+            doc = LaTeXDocument('E = m \\cdot c^2')
+            doc.set_displaymath(displaymath)
+            doc.set_preamble_string('\\usepackage{eurosym} % 100%')
+            doc.set_encoding('utf-8')
+            template = document.LaTeXTemplate(encoding='utf-8',
+                    preamble='\\usepackage{eurosym} % 100%')
+            self.assertEqual(template.format('E = m \\cdot c^2', displaymath),
+                    str(doc))
+
+    def test_that_latex_maths_env_is_used(self):
+        template = document.LaTeXTemplate(maths_env='flalign*')
+        tex = template.format('f00', True)
+        self.assertTrue(r'\begin{flalign*}f00\end{flalign*}' in tex)
+
+    def test_that_percent_signs_in_formula_are_kept(self):
+        template = document.LaTeXTemplate()
+        self.assertTrue('50\\%' in template.format('50\\%'))
+
+    def test_that_non_ascii_formula_without_encoding_raises_error(self):
+        template = document.LaTeXTemplate()
+        self.assertRaises(ValueError, template.format, 'ö')
+        template = document.LaTeXTemplate(replace_nonascii=True)
+        self.assertFalse('ö' in template.format('ö'))
+
+    def test_that_unsupported_encoding_raises_error(self):
+        with self.assertRaises(ValueError):
+            document.LaTeXTemplate(encoding='utf66')
+
 ################################################################################
 
 
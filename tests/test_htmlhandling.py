@@ -1,6 +1,6 @@
 #pylint: disable=too-many-public-methods
 from functools import reduce
-import os, re, shutil, tempfile
+import hashlib, mmap, os, re, shutil, tempfile
 import unittest
 from gleetex import htmlhandling
 
@@ -118,6 +118,28 @@ class HtmlparserTest(unittest.TestCase):
         self.assertEqual(formula[-1], "a>b")
         
 
+    def test_that_different_entities_are_unescaped_each(self):
+        self.p.feed('<eq>a&lt;b&gt;c&amp;d&#92;e &lt;</eq>')
+        self.assertEqual(self.p.get_data()[0][-1], 'a<b>c&d\\e <')
+
+    def test_that_entities_are_unescaped_only_once(self):
+        self.p.feed('<eq>a&amp;lt;b</eq>')
+        self.assertEqual(self.p.get_data()[0][-1], 'a&lt;b')
+
+    def test_that_unknown_entities_are_kept(self):
+        self.p.feed('<eq>a&foo;b&gt;c</eq>')
+        self.assertEqual(self.p.get_data()[0][-1], 'a&foo;b>c')
+
+    def test_that_formulas_are_returned_as_chunks(self):
+        self.p.feed('a<eq>x^2</eq>b<eq env="displaymath">x^%d</eq>' % 2)
+        data = self.p.get_data()
+        self.assertEqual(data[0], 'a')
+        self.assertEqual(data[1], htmlhandling.FormulaChunk((0, 1), False,
+            'x^2'))
+        self.assertTrue(data[3].displaymath)
+        self.assertTrue(data[1].formula is data[3].formula)
+        self.assertFalse(hasattr(data[1], '__dict__'))
+
     def test_displaymath_is_recognized(self):
         self.p.feed('<eq env="displaymath">\\sum\limits_{n=1}^{e^i} a^nl^n</eq>')
         self.assertEqual(self.p.get_data()[0][1], True) # displaymath flag set
@@ -130,6 +152,55 @@ class HtmlparserTest(unittest.TestCase):
         # no exception - everything is working as expected
         self.p.feed(HTML_SKELETON.format('utf-8', 'æø'))
 
+    def test_that_bytes_are_decoded_chunk_wise(self):
+        document = HTML_SKELETON.format('iso-8859-15',
+                'ö\n<eq>\\alpha ä</eq>ü<!-- ß -->\n')
+        self.p.feed(document.encode('iso-8859-15'))
+        data = self.p.get_data()
+        self.assertEqual(''.join(c if isinstance(c, str) else '<eq>%s</eq>' %
+            c.formula for c in data), document)
+        self.assertEqual(data[1], htmlhandling.FormulaChunk((2, 1), False,
+            '\\alpha ä'))
+
+    def test_that_memory_mapped_files_can_be_parsed(self):
+        document = HTML_SKELETON.format('utf-8', 'ö<eq>ä</eq>\n')
+        with tempfile.TemporaryFile() as f:
+            f.write(document.encode('utf-8'))
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.p.feed(data)
+        self.assertEqual(self.p.get_data()[1].formula, 'ä')
+        self.assertEqual(self.p.get_data()[2], '\n</body>')
+
+    def test_that_documents_in_other_encodings_are_decoded_first(self):
+        self.assertFalse(htmlhandling.is_ascii_transparent('utf-16'))
+        self.assertTrue(htmlhandling.is_ascii_transparent('shift_jis'))
+        self.assertFalse(htmlhandling.is_ascii_transparent('iso-2022-jp'))
+        self.p.feed(HTML_SKELETON.format('iso-2022-jp', '日<eq>本</eq>').encode(
+            'iso-2022-jp'))
+        self.assertEqual(self.p.get_data()[1].formula, '本')
+
+    def test_that_last_character_after_formula_is_kept(self):
+        self.p.feed('<eq>a</eq>\n')
+        self.assertEqual(self.p.get_data()[-1], '\n')
+
+    def test_that_text_is_returned_as_spans_if_requested(self):
+        document = 'ä<!-- c --> b<eq>x</eq><eq>y</eq>ö\n'.encode('utf-8')
+        parser = htmlhandling.EqnParser(text_spans=True)
+        parser.feed(document)
+        data = parser.get_data()
+        # text and comments are merged into one span
+        self.assertEqual([(c.start, c.end) for c in data
+                if isinstance(c, htmlhandling.TextSpan)], [(0, 14), (34, 37)])
+        self.assertEqual([c.formula for c in data
+                if isinstance(c, htmlhandling.FormulaChunk)], ['x', 'y'])
+        self.assertEqual(document[34:37].decode('utf-8'), 'ö\n')
+
+    def test_that_strings_are_not_split_into_spans(self):
+        parser = htmlhandling.EqnParser(text_spans=True)
+        parser.feed('a<eq>x</eq>b')
+        self.assertEqual(parser.get_data()[0], 'a')
+
 class GetPositionTest(unittest.TestCase):
     def test_that_line_number_is_correct(self):
         self.assertEqual(htmlhandling.get_position('jojo', 0)[0], 0)
@@ -176,6 +247,16 @@ class HtmlImageTest(unittest.TestCase):
         # make sure encoding is specified
         self.assertTrue('<meta' in data and 'charset=' in data)
 
+    def test_that_formatted_images_are_reused_until_options_change(self):
+        img = htmlhandling.HtmlImageFormatter()
+        first = img.format(self.pos, '\\tau', 'foo.png')
+        self.assertTrue(first is img.format(self.pos, '\\tau', 'foo.png'))
+        self.assertNotEqual(first, img.format(self.pos, '\\tau', 'foo.png',
+            True))
+        img.set_inline_math_css_class('maths')
+        self.assertTrue('class="maths"' in img.format(self.pos, '\\tau',
+            'foo.png'))
+
     def test_id_contains_no_special_characters(self):
         data = htmlhandling.gen_id('\\tau!\'{}][~^')
         for character in {'!', "'", '\\', '{', '}'}:
@@ -184,14 +265,14 @@ class HtmlImageTest(unittest.TestCase):
     def test_formula_can_consist_only_of_numbers_and_id_is_generated(self):
         data = htmlhandling.gen_id('9*8*7=504')
         self.assertTrue(data.startswith('form'))
-        self.assertTrue(data.endswith('504'))
+        self.assertTrue('504-' in data)
 
     def test_that_empty_ids_raise_exception(self):
         self.assertRaises(ValueError, htmlhandling.gen_id, '')
 
     def test_that_same_characters_are_not_repeated(self):
         id = htmlhandling.gen_id("jo{{{{{{{{ha")
-        self.assertEqual(id, "jo_ha")
+        self.assertTrue(id.startswith("jo_ha-"))
 
     def test_that_ids_are_max_150_characters_wide(self):
         id = htmlhandling.gen_id('\\alpha\\cdot\\gamma + ' * 999)
@@ -201,6 +282,22 @@ class HtmlImageTest(unittest.TestCase):
         id = htmlhandling.gen_id('{}\\[]ÖÖÖö9343...·tau')
         self.assertTrue(id[0].isalpha())
 
+    def test_that_ids_are_stable(self):
+        self.assertEqual(htmlhandling.gen_id('a+b'), 'ab-' + hashlib.blake2b(
+            b'a+b', digest_size=6).hexdigest()[:12])
+        self.assertEqual(htmlhandling.gen_id('a+b'), htmlhandling.gen_id('a+b'))
+
+    def test_that_long_formulas_with_same_start_get_different_ids(self):
+        start = '\\alpha\\cdot\\gamma + ' * 20
+        self.assertNotEqual(htmlhandling.gen_id(start + 'x'),
+                htmlhandling.gen_id(start + 'y'))
+        # the readable part is the same, only the hash differs
+        self.assertNotEqual(htmlhandling.gen_id('a+b'),
+                htmlhandling.gen_id('a-b'))
+
+    def test_that_formulas_without_id_characters_get_an_id(self):
+        self.assertTrue(htmlhandling.gen_id('!=').startswith('form_-'))
+
     def test_that_link_to_external_image_points_to_file_and_formula(self):
         with htmlhandling.HtmlImageFormatter() as img:
             formatted_img = img.format_excluded(self.pos, '\\tau\\tau', 'foo.png')
@@ -250,6 +347,133 @@ class HtmlImageTest(unittest.TestCase):
         self.assertTrue('\\tau' in data)
         self.assertTrue('\\pi' in data)
 
+    def test_that_files_with_old_ids_are_not_duplicated(self):
+        with open(excl_filename, 'w', encoding='utf-8') as f:
+            f.write(htmlhandling.HtmlImageFormatter.HTML_TEMPLATE_HEAD +
+                    '<p id="tau"><pre>\\tau\\tau</pre></p>\n</body>\n</html>\n')
+        with htmlhandling.HtmlImageFormatter() as img:
+            link = img.format_excluded(self.pos, '\\tau\\tau', 'foo.png')
+            new_link = img.format_excluded(self.pos, '\\pi', 'foo.png')
+        data = read(excl_filename)
+        self.assertEqual(data.count('<p id='), 2)
+        # old anchors still resolve, new formulas get the current ids
+        self.assertTrue('<p id="tau">' in data)
+        self.assertTrue('#tau"' in link)
+        self.assertTrue('#%s"' % htmlhandling.gen_id('\\pi') in new_link)
+        self.assertTrue('<p id="%s">' % htmlhandling.gen_id('\\pi') in data)
+        with htmlhandling.HtmlImageFormatter() as img: # read from the sidecar
+            self.assertEqual(img.format_excluded(self.pos, '\\tau\\tau',
+                'foo.png'), link)
+
+    def test_that_unchanged_exclusion_file_is_not_written(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        stat = os.stat(excl_filename)
+        index = htmlhandling.HtmlImageFormatter.EXCLUSION_INDEX_FILE_NAME
+        index_stat = os.stat(index)
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        self.assertEqual(os.stat(excl_filename).st_mtime_ns, stat.st_mtime_ns)
+        self.assertEqual(os.stat(index).st_mtime_ns, index_stat.st_mtime_ns)
+
+    def test_that_appended_formulas_result_in_same_file(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\pi', 'foo.png')
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        appended = read(excl_filename)
+        os.mkdir('once')
+        with htmlhandling.HtmlImageFormatter('once') as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+            img.format_excluded(self.pos, '\\pi', 'foo.png')
+        self.assertEqual(appended, read(os.path.join('once', excl_filename)))
+
+    def test_that_modified_exclusion_file_is_parsed_again(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        data = read(excl_filename).replace('</body>', '<hr />\n<p id="%s">'
+                '<pre>\\pi</pre></p>\n</body>' % htmlhandling.gen_id('\\pi'))
+        with open(excl_filename, 'w', encoding='utf-8') as f:
+            f.write(data)
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\pi', 'foo.png')
+        self.assertEqual(read(excl_filename), data)
+
+    def test_that_sidecar_is_used_instead_of_parsing(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        parser = htmlhandling.OutsourcedFormulaParser
+        def fail():
+            raise AssertionError("exclusion file was parsed")
+        htmlhandling.OutsourcedFormulaParser = fail
+        try:
+            with htmlhandling.HtmlImageFormatter() as img:
+                img.format_excluded(self.pos, '\\tau', 'foo.png')
+                img.format_excluded(self.pos, '\\pi', 'foo.png')
+        finally:
+            htmlhandling.OutsourcedFormulaParser = parser
+        data = read(excl_filename)
+        self.assertEqual(data.count('<p id='), 2)
+
+    def test_that_missing_exclusion_file_is_regenerated_from_sidecar(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+            img.format_excluded(self.pos, '\\pi', 'foo.png')
+        data = read(excl_filename)
+        os.remove(excl_filename)
+        with htmlhandling.HtmlImageFormatter() as img:
+            pass
+        self.assertEqual(read(excl_filename), data)
+
+    def test_that_legacy_exclusion_file_without_sidecar_is_read(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+        os.remove(htmlhandling.HtmlImageFormatter.EXCLUSION_INDEX_FILE_NAME)
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.format_excluded(self.pos, '\\tau', 'foo.png')
+            img.format_excluded(self.pos, '\\pi', 'foo.png')
+        self.assertEqual(read(excl_filename).count('<p id='), 2)
+        sidecar = read(htmlhandling.HtmlImageFormatter.EXCLUSION_INDEX_FILE_NAME)
+        self.assertEqual(len(sidecar.splitlines()), 4)
+        self.assertTrue('\\\\pi' in sidecar)
+
+    def get_link(self, formatted):
+        return re.search('href="(.*?)#(.*?)"', formatted).groups()
+
+    def test_that_formulas_are_sharded_by_document(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_shard_by_document('some/chapter 1.htex')
+            path, id = self.get_link(img.format_excluded(self.pos, '\\tau',
+                'foo.png'))
+        self.assertEqual(path, 'outsourced-descriptions-chapter_1.html')
+        self.assertTrue('id="%s"' % id in read(path))
+        self.assertFalse(os.path.exists(excl_filename))
+
+    def test_that_formulas_are_sharded_by_hash(self):
+        formulas = ['\\tau^%d' % i for i in range(20)]
+        os.mkdir('basepath')
+        with htmlhandling.HtmlImageFormatter('basepath') as img:
+            img.set_shard_count(4)
+            links = [self.get_link(img.format_excluded(self.pos, formula,
+                'foo.png')) for formula in formulas]
+        self.assertEqual(len(set(path for path, _ in links)), 4)
+        for path, id in links:
+            self.assertTrue(re.match(r'^basepath/outsourced-descriptions-\d\.html$',
+                path))
+            self.assertTrue('id="%s"' % id in read(path))
+        # formulas stay in their shard
+        with htmlhandling.HtmlImageFormatter('basepath') as img:
+            img.set_shard_count(4)
+            self.assertEqual(self.get_link(img.format_excluded(self.pos,
+                formulas[0], 'foo.png')), links[0])
+        self.assertEqual(read(links[0][0]).count('<p id='),
+                sum(1 for path, _ in links if path == links[0][0]))
+
+    def test_that_shard_count_must_be_positive(self):
+        img = htmlhandling.HtmlImageFormatter()
+        self.assertRaises(ValueError, img.set_shard_count, 0)
+
     def test_too_long_formulas_are_not_outsourced_if_not_configured(self):
         with htmlhandling.HtmlImageFormatter('foo.html') as img:
             img.format(self.pos, '\\tau' * 999, 'foo.png')
@@ -332,6 +556,15 @@ class HtmlImageTest(unittest.TestCase):
             self.assertTrue('\{' in data and 'foo' in data and '\}' in data)
          
 
+    def test_that_longer_and_escaped_commands_are_kept(self):
+        img = htmlhandling.HtmlImageFormatter()
+        self.assertEqual(img.postprocess_formula(r'\bigl( x \bigr)'),
+                r'\bigl( x \bigr)')
+        self.assertEqual(img.postprocess_formula(r'a \\, b'), r'a \\, b')
+        self.assertEqual(img.postprocess_formula(r'a\,\,\, b' * 3),
+                'a b' * 3)
+
+
 def htmleqn(formula, hr=True):
     """Format a formula to appear as if it would have been outsourced into an
     external file."""
@@ -1,6 +1,9 @@
 #pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import asyncio
+import errno
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 from subprocess import SubprocessError
@@ -28,7 +31,7 @@ Transcript written on bla.log.
 """
 
 
-def call_dummy(_lklklklklk, cwd=None):
+def call_dummy(_lklklklklk, cwd=None, timeout=None):
     """Dummy to prohibit subprocess execution."""
     return str(cwd)
 
@@ -37,12 +40,12 @@ def call_dummy(_lklklklklk, cwd=None):
 
 
 #pylint: disable=unused-argument
-def latex_error_mock(_cmd, cwd=None):
+def latex_error_mock(_cmd, cwd=None, timeout=None):
     """Mock an error case."""
     raise SubprocessError(LATEX_ERROR_OUTPUT)
 
 #pylint: disable=unused-argument
-def dvipng_mock(cmd, cwd=None):
+def dvipng_mock(cmd, cwd=None, timeout=None):
     """Mock an error case."""
     fn = None
     try:
@@ -149,7 +152,7 @@ class test_imagecreation(unittest.TestCase):
         i = image.Tex2img(doc("\\sum\\limits_{i=0}^{\\infty} i^ie^i"), 'foo.png')
         i.create_dvi('foo.dvi')
         # set dvi output call
-        image.Tex2img.call = lambda x, y=9: \
+        image.Tex2img.call = lambda x, cwd=None, timeout=None: \
                 'This is dvipng 1.14 Copyright 2002-2010 Jan-Ake Larsson\n depth=3 height=9 width=22'
         posdata = i.create_png('foo.dvi')
         self.assertTrue('height' in posdata)
@@ -163,9 +166,175 @@ class test_imagecreation(unittest.TestCase):
         self.assertFalse(os.path.exists("farce.log"))
         self.assertTrue(os.path.exists("bilder/farce.png"))
 
+    def test_that_configured_timeouts_are_passed_to_call(self):
+        timeouts = []
+        def call_mock(cmd, cwd=None, timeout=None):
+            timeouts.append(timeout)
+            return dvipng_mock(cmd, cwd)
+        image.Tex2img.call = call_mock
+        i = image.Tex2img(doc('\\hat{x}'), 'foo.png')
+        i.set_latex_timeout(3)
+        i.set_dvipng_timeout(image.TimeoutPolicy(7))
+        i.convert()
+        self.assertEqual(timeouts, [3, 7])
+
+    def test_that_timeouts_are_recorded_and_propagated(self):
+        def timeout_mock(cmd, cwd=None, timeout=None):
+            raise image.SubprocessTimeoutError('timed out', timeout)
+        image.Tex2img.call = timeout_mock
+        policy = image.TimeoutPolicy(5)
+        i = image.Tex2img(doc('\\hat{x}'), 'foo.png')
+        i.set_latex_timeout(policy)
+        self.assertRaises(image.SubprocessTimeoutError, i.create_dvi, 'foo.dvi')
+        self.assertEqual(policy.get_statistics()['timeouts'], 1)
+        self.assertFalse(os.path.exists('foo.tex'))
+
+    def test_that_scratch_directory_is_used_and_only_image_is_moved(self):
+        os.mkdir('scratch')
+        image.Tex2img.call = dvipng_mock
+        i = image.Tex2img(doc('\\hat{x}'), 'bilder/foo.png')
+        i.set_scratch_directory('scratch')
+        i.convert()
+        self.assertEqual(os.listdir('bilder'), ['foo.png'])
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_that_latex_source_is_kept_next_to_image_with_scratch_directory(self):
+        os.mkdir('scratch')
+        image.Tex2img.call = dvipng_mock
+        i = image.Tex2img(doc('\\hat{x}'), 'foo.png')
+        i.set_scratch_directory('scratch')
+        i.set_keep_latex_source(True)
+        i.convert()
+        self.assertTrue(os.path.exists('foo.tex'))
+        self.assertTrue(os.path.exists('foo.png'))
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_that_move_atomically_moves_file(self):
+        with open('a.png', 'w') as f:
+            f.write('data')
+        image.move_atomically('a.png', 'b.png')
+        self.assertFalse(os.path.exists('a.png'))
+        self.assertTrue(os.path.exists('b.png'))
+
+    def test_that_copied_files_keep_their_mode(self):
+        with open('a.png', 'w') as f:
+            f.write('data')
+        os.chmod('a.png', 0o644)
+        replace = os.replace
+        def cross_device_replace(source, destination):
+            if source == 'a.png': # as if on another file system
+                raise OSError(errno.EXDEV, 'cross-device link')
+            replace(source, destination)
+        os.replace = cross_device_replace
+        try:
+            image.move_atomically('a.png', 'b.png')
+        finally:
+            os.replace = replace
+        self.assertFalse(os.path.exists('a.png'))
+        self.assertEqual(os.stat('b.png').st_mode & 0o777, 0o644)
+
+
+class TestTimeoutPolicy(unittest.TestCase):
+    def test_that_fixed_policy_ignores_run_times(self):
+        policy = image.TimeoutPolicy(20)
+        for _ in range(50):
+            policy.record(0.1)
+        self.assertEqual(policy.get_timeout(), 20)
+        self.assertEqual(policy.get_statistics()['runs'], 50)
+
+    def test_that_adaptive_policy_uses_initial_timeout_without_samples(self):
+        policy = image.TimeoutPolicy(20, adaptive=True)
+        policy.record(0.1)
+        self.assertEqual(policy.get_timeout(), 20)
+
+    def test_that_adaptive_policy_is_derived_from_run_times(self):
+        policy = image.TimeoutPolicy(20, adaptive=True, factor=5, minimum=0.1)
+        for _ in range(image.TimeoutPolicy.MIN_SAMPLES):
+            policy.record(0.5)
+        self.assertAlmostEqual(policy.get_timeout(), 2.5)
+
+    def test_that_adaptive_timeout_is_clamped(self):
+        policy = image.TimeoutPolicy(20, adaptive=True, minimum=2, maximum=60)
+        for _ in range(image.TimeoutPolicy.MIN_SAMPLES):
+            policy.record(0.01)
+        self.assertEqual(policy.get_timeout(), 2)
+        for _ in range(100):
+            policy.record(100)
+        self.assertEqual(policy.get_timeout(), 60)
+
+    def test_that_invalid_timeouts_are_rejected(self):
+        self.assertRaises(ValueError, image.TimeoutPolicy, 0)
+        self.assertRaises(ValueError, image.TimeoutPolicy, 5, percentile=0)
+
 
 class TestImageResolutionCorrectlyCalculated(unittest.TestCase):
     def test_sizes_are_correctly_calculated(self):
         self.assertEqual(int(image.fontsize2dpi(12)), 115)
         self.assertEqual(int(image.fontsize2dpi(10)), 96)
 
+
+
+class TestAsyncConversion(unittest.TestCase):
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        image.Tex2img.call_async = image.proc_call_async
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_that_subprocess_output_is_returned(self):
+        output = asyncio.run(image.proc_call_async([sys.executable, '-c',
+            'print("hello")']))
+        self.assertEqual(output.strip(), 'hello')
+
+    def test_that_failing_subprocess_raises_error(self):
+        with self.assertRaises(SubprocessError):
+            asyncio.run(image.proc_call_async([sys.executable, '-c',
+                'import sys; sys.exit(3)']))
+
+    def test_that_subprocess_is_killed_after_timeout(self):
+        with self.assertRaises(image.SubprocessTimeoutError):
+            asyncio.run(image.proc_call_async([sys.executable, '-c',
+                'import time; time.sleep(10)'], timeout=0.2))
+
+    def test_that_cancelled_subprocess_is_reaped(self):
+        async def run():
+            task = asyncio.ensure_future(image.proc_call_async([
+                sys.executable, '-c', 'import os, time; '
+                'open("pid", "w").write(str(os.getpid())); time.sleep(10)']))
+            while not os.path.exists('pid') or not open('pid').read():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(run())
+        with open('pid') as f:
+            pid = int(f.read())
+        # a zombie would still exist
+        self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+
+    def test_that_conversion_works_asynchronously(self):
+        async def call_mock(cmd, cwd=None, timeout=None):
+            return dvipng_mock(cmd, cwd, timeout)
+        image.Tex2img.call_async = call_mock
+        os.mkdir('scratch')
+        i = image.Tex2img(doc('\\hat{x}'), 'bilder/foo.png')
+        i.set_scratch_directory('scratch')
+        asyncio.run(i.convert_async())
+        self.assertEqual(i.get_positioning_info(),
+                {'depth': '3', 'height': '9', 'width': '22'})
+        self.assertEqual(os.listdir('bilder'), ['foo.png'])
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_that_latex_errors_are_parsed_asynchronously(self):
+        async def call_mock(cmd, cwd=None, timeout=None):
+            return latex_error_mock(cmd, cwd, timeout)
+        image.Tex2img.call_async = call_mock
+        i = image.Tex2img(doc('\\foo'), 'foo.png')
+        with self.assertRaises(SubprocessError) as ctx:
+            asyncio.run(i.convert_async())
+        self.assertEqual(ctx.exception.args[0], 'Undefined control sequence.')
+        self.assertFalse(os.path.exists('foo.tex'))
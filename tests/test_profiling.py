@@ -0,0 +1,48 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import unittest
+from gleetex import htmlhandling, profiling
+
+class test_profiling(unittest.TestCase):
+    def tearDown(self):
+        profiling.uninstall()
+
+    def test_that_nothing_is_recorded_without_profiler(self):
+        with profiling.measure('parse'):
+            pass
+        profiling.count('foo')
+        self.assertEqual(profiling.get_profiler(), None)
+
+    def test_that_durations_are_summed_up_per_stage(self):
+        p = profiling.Profiler()
+        p.record('latex', 0.5)
+        p.record('latex', 1.5)
+        stage = p.get_report()['stages']['latex']
+        self.assertEqual(stage['count'], 2)
+        self.assertEqual(stage['total'], 2.0)
+        self.assertEqual(stage['max'], 1.5)
+
+    def test_that_only_slowest_formulas_are_kept(self):
+        p = profiling.Profiler(slowest_count=2)
+        for index in range(10):
+            p.record('render', index, formula='f%d' % index)
+        slowest = p.get_report()['slowest']
+        self.assertEqual([s['formula'] for s in slowest], ['f9', 'f8'])
+
+    def test_that_counters_and_gauges_are_recorded(self):
+        p = profiling.Profiler()
+        profiling.install(p)
+        profiling.count('hits')
+        profiling.count('hits', 2)
+        profiling.gauge('queue', 5)
+        profiling.gauge('queue', 3)
+        report = p.get_report()
+        self.assertEqual(report['counters']['hits'], 3)
+        self.assertEqual(report['gauges']['queue']['max'], 5)
+        self.assertEqual(report['gauges']['queue']['last'], 3)
+
+    def test_that_installed_profiler_records_hooks(self):
+        p = profiling.Profiler()
+        profiling.install(p)
+        htmlhandling.EqnParser().feed('<p><eq>x</eq></p>')
+        self.assertEqual(p.get_report()['stages']['parse']['count'], 1)
+        self.assertTrue('parse' in p.format_report())
@@ -0,0 +1,92 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from gleetex import remotecache
+
+POS = {'depth': 3, 'height': 9, 'width': 22}
+
+class test_records(unittest.TestCase):
+    def test_that_fingerprint_depends_on_document_and_options(self):
+        key = remotecache.fingerprint('doc', [100, None])
+        self.assertTrue(remotecache.KEY.match(key))
+        self.assertEqual(key, remotecache.fingerprint('doc', [100, None]))
+        self.assertNotEqual(key, remotecache.fingerprint('doc', [200, None]))
+        self.assertNotEqual(key, remotecache.fingerprint('doc2', [100, None]))
+
+    def test_that_records_can_be_decoded(self):
+        record = remotecache.encode_record(POS, b'\x89PNG\n\x00data')
+        self.assertEqual(remotecache.decode_record(record),
+                (POS, b'\x89PNG\n\x00data'))
+
+    def test_that_unknown_positioning_keys_are_dropped(self):
+        record = remotecache.encode_record(dict(POS, style='x'), b'png')
+        self.assertEqual(remotecache.decode_record(record), (POS, b'png'))
+
+    def test_that_malformed_records_are_detected(self):
+        for record in [b'', b'{"depth": 1}', b'no json\ndata', b'{}\nPNG',
+                b'{"depth": 1, "height": 2}\nPNG',
+                b'{"depth": 1, "height": 2, "width": "2\\"><script>"}\nPNG',
+                b'{"depth": 1, "height": 2.5, "width": 2}\nPNG',
+                b'{"depth": true, "height": 2, "width": 2}\nPNG']:
+            self.assertRaises(remotecache.RemoteCacheError,
+                    remotecache.decode_record, record)
+
+class test_backends(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.key = remotecache.fingerprint('doc')
+        self.record = remotecache.encode_record(POS, b'png')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def check_backend(self, backend):
+        self.assertEqual(backend.get(self.key), None)
+        backend.put(self.key, self.record)
+        self.assertEqual(backend.get(self.key), self.record)
+        other = remotecache.fingerprint('other')
+        self.assertEqual(backend.get_many([self.key, other]),
+                {self.key: self.record})
+
+    def test_directory_backend(self):
+        path = os.path.join(self.tmpdir, 'records')
+        self.check_backend(remotecache.DirectoryBackend(path))
+        self.assertEqual(os.listdir(path), [self.key])
+
+    def test_that_directory_backend_records_are_readable_by_others(self):
+        backend = remotecache.DirectoryBackend(self.tmpdir)
+        umask = os.umask(0o022)
+        try:
+            backend.put(self.key, self.record)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(os.path.join(self.tmpdir, self.key)).st_mode
+                & 0o777, 0o644)
+
+    def test_http_backend(self):
+        server = remotecache.CacheServer(('127.0.0.1', 0), self.tmpdir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.check_backend(remotecache.HttpBackend(server.get_url()))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_that_unreachable_servers_raise_error(self):
+        server = remotecache.CacheServer(('127.0.0.1', 0), self.tmpdir)
+        url = server.get_url()
+        server.server_close() # nobody listens anymore
+        backend = remotecache.HttpBackend(url, timeout=1)
+        self.assertRaises(remotecache.RemoteCacheError, backend.get_many,
+                [self.key])
+
+    def test_that_backend_is_chosen_by_location(self):
+        self.assertTrue(isinstance(remotecache.get_backend(
+            'https://example.com/cache'), remotecache.HttpBackend))
+        self.assertTrue(isinstance(remotecache.get_backend(self.tmpdir),
+            remotecache.DirectoryBackend))
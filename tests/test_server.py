@@ -0,0 +1,261 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import http.client
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from gleetex import convenience, image, server
+import gladtex
+
+class Tex2imgMock:
+    """Write a dummy image instead of running LaTeX."""
+    def __init__(self, _tex_document, output_fn, _encoding='UTF-8'):
+        self.output_fn = output_fn
+
+    def __getattr__(self, name): # set_dpi & co
+        return lambda *_args: None
+
+    def convert(self):
+        with open(self.output_fn, 'w') as f:
+            f.write('dummy')
+
+    def get_positioning_info(self):
+        return {'depth': 2, 'height': 9, 'width': 7}
+
+class test_server(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, 'gladtex.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def start(self, address, handlers):
+        srv = server.RenderServer(address, handlers)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        def stop():
+            srv.shutdown()
+            srv.close()
+            thread.join()
+        self.addCleanup(stop)
+        return srv
+
+    def test_that_addresses_are_parsed(self):
+        self.assertEqual(server.parse_address('8080'),
+                (socket.AF_INET, ('127.0.0.1', 8080)))
+        self.assertEqual(server.parse_address('localhost:80'),
+                (socket.AF_INET, ('localhost', 80)))
+        self.assertEqual(server.parse_address('/tmp/gladtex.sock'),
+                (socket.AF_UNIX, '/tmp/gladtex.sock'))
+
+    def test_requests_over_unix_socket(self):
+        self.start(self.address, {'echo': lambda data: {'got': data}})
+        self.assertTrue(server.is_running(self.address))
+        self.assertEqual(server.request(self.address, 'echo', [1, 'ä']),
+                {'got': [1, 'ä']})
+
+    def test_requests_over_tcp(self):
+        srv = self.start('127.0.0.1:0', {'echo': lambda data: data})
+        self.assertEqual(server.request(srv.get_address(), 'echo', {'a': 1}),
+                {'a': 1})
+
+    def test_that_unknown_requests_are_rejected(self):
+        self.start(self.address, {})
+        self.assertRaises(OSError, server.request, self.address, 'foo', {})
+
+    def test_that_missing_server_is_detected(self):
+        self.assertFalse(server.is_running(self.address))
+        self.assertRaises(server.ServerUnavailable, server.request,
+                self.address, 'echo', {})
+
+    def test_that_stale_socket_is_replaced(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.address) # nobody listens
+        self.start(self.address, {'echo': lambda data: data})
+        self.assertEqual(server.request(self.address, 'echo', 1), 1)
+
+    def test_that_only_loopback_addresses_are_accepted(self):
+        self.assertRaises(OSError, server.RenderServer, '0.0.0.0:0', {})
+        srv = self.start('localhost:0', {'echo': lambda data: data})
+        self.assertEqual(server.request(srv.get_address(), 'echo', 1), 1)
+
+    def test_that_unix_socket_is_only_accessible_by_owner(self):
+        self.start(self.address, {})
+        self.assertEqual(os.stat(self.address).st_mode & 0o777, 0o600)
+
+    def test_that_requests_are_authenticated(self):
+        srv = self.start('127.0.0.1:0', {'echo': lambda data: data})
+        address = srv.get_address()
+        token_path = server.get_token_path(address)
+        self.assertEqual(os.stat(token_path).st_mode & 0o777, 0o600)
+        with open(token_path) as f:
+            token = f.read()
+        valid = {'Content-Type': 'application/json', 'Host': address,
+                server.TOKEN_HEADER: token}
+        for headers, status in [(valid, 200),
+                (dict(valid, **{server.TOKEN_HEADER: 'x'}), 403),
+                ({k: v for k, v in valid.items() if k != server.TOKEN_HEADER},
+                    403),
+                (dict(valid, **{'Content-Type': 'text/plain'}), 415),
+                (dict(valid, Origin='http://evil.example'), 403),
+                (dict(valid, Host='evil.example'), 403)]:
+            connection = http.client.HTTPConnection(*address.split(':'))
+            try:
+                connection.request('POST', '/echo', b'1', headers)
+                self.assertEqual(connection.getresponse().status, status,
+                        headers)
+            finally:
+                connection.close()
+        srv.shutdown()
+        srv.close()
+        self.assertFalse(os.path.exists(token_path))
+
+    def test_that_loopback_hosts_are_recognized(self):
+        for host in ['localhost', 'localhost:80', '127.0.0.1:8080', '[::1]:80',
+                '::1']:
+            self.assertTrue(server.is_loopback_host(host), host)
+        for host in ['', 'evil.example', 'evil.example:80', '10.0.0.1',
+                'localhost.evil.example']:
+            self.assertFalse(server.is_loopback_host(host), host)
+
+class test_handlers(unittest.TestCase):
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.address = os.path.join(self.tmpdir, 'gladtex.sock')
+        convenience.CachedConverter._converter = Tex2imgMock #pylint: disable=protected-access
+        self.pool = gladtex.ConverterPool()
+        srv = gladtex.Main().create_server(self.address, self.pool)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        def stop():
+            srv.shutdown()
+            srv.close()
+            thread.join()
+            self.pool.clear()
+        self.addCleanup(stop)
+
+    def tearDown(self):
+        convenience.CachedConverter._converter = image.Tex2img #pylint: disable=protected-access
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def request(self, name, data):
+        data['cwd'] = self.tmpdir
+        return server.request(self.address, name, data)
+
+    def test_that_formulas_are_converted(self):
+        response = self.request('formulas', {'args': ['-d', 'img'],
+            'formulas': [['a^2', False], ['b', True]]})
+        self.assertEqual(response['status'], 0, response['stderr'])
+        entries = response['entries']
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['pos'], {'depth': 2, 'height': 9,
+            'width': 7})
+        for entry in entries:
+            self.assertTrue(os.path.exists(entry['path']))
+
+    def test_that_validation_can_be_disabled(self):
+        # \\lp might be defined as \\left( in the preamble
+        formulas = [['\\lp a \\right)', False]]
+        response = self.request('formulas', {'args': ['-d', 'img'],
+            'formulas': formulas})
+        self.assertNotEqual(response['status'], 0)
+        response = self.request('formulas', {'args': ['-d', 'img',
+            '--no-validation'], 'formulas': formulas})
+        self.assertEqual(response['status'], 0, response['stderr'])
+
+    def test_that_time_outs_must_be_positive(self):
+        for timeout in ['0', '0.0', 'auto:0', 'auto:', '-1', 'never']:
+            response = self.request('formulas', {'args': ['-d', 'img',
+                '--latex-timeout', timeout], 'formulas': [['a', False]]})
+            self.assertEqual(response['status'], 14, timeout)
+            self.assertTrue('positive' in response['stdout'])
+        for timeout in ['0.5', '20', 'auto', 'auto:2.5']:
+            response = self.request('formulas', {'args': ['-d', 'img',
+                '--dvipng-timeout', timeout], 'formulas': [['a', False]]})
+            self.assertEqual(response['status'], 0, response['stderr'])
+
+    def test_that_documents_are_converted(self):
+        with open('doc.htex', 'w', encoding='utf-8') as f:
+            f.write('<p><eq>a^2</eq></p>\n')
+        response = self.request('document', {'args': ['-d', 'img',
+            'doc.htex']})
+        self.assertEqual(response['status'], 0, response['stderr'])
+        with open('doc.html', encoding='utf-8') as f:
+            self.assertTrue('alt="a^2"' in f.read())
+        # the converter is kept for the next document
+        response = self.request('document', {'args': ['-d', 'img', '-o', '-',
+            'doc.htex']})
+        self.assertTrue('alt="a^2"' in response['stdout'])
+
+    def test_that_errors_are_reported_as_status(self):
+        response = self.request('document', {'args': ['missing.htex']})
+        self.assertEqual(response['status'], 20)
+        self.assertTrue('missing.htex' in response['stderr'])
+
+    def test_that_local_options_are_rejected(self):
+        for args in (['--gc'], ['--serve', 'other.sock'],
+                ['--server', self.address, '-']):
+            response = self.request('document', {'args': args, 'input': ''})
+            self.assertEqual(response['status'], 23, args)
+        response = self.request('formulas', {'args': ['--gc'],
+            'formulas': [['a', False]]})
+        self.assertEqual(response['status'], 23)
+
+    def test_that_server_option_is_not_forwarded(self):
+        with open('doc.htex', 'w', encoding='utf-8') as f:
+            f.write('<p><eq>a^2</eq></p>\n')
+        gladtex.Main().run(['gladtex', '--server', self.address, '-d', 'img',
+            'doc.htex'])
+        gladtex.Main().run(['gladtex', '--server=' + self.address, '-d', 'img',
+            '-o', 'other.html', 'doc.htex'])
+        for name in ['doc.html', 'other.html']:
+            with open(name, encoding='utf-8') as f:
+                self.assertTrue('alt="a^2"' in f.read())
+
+    def test_that_output_file_is_restricted(self):
+        with open('doc.htex', 'w', encoding='utf-8') as f:
+            f.write('<p><eq>a^2</eq></p>\n')
+        for output in ['other.html', '.bashrc', '/tmp/doc.html']:
+            response = self.request('document', {'args': ['-o', output,
+                'doc.htex']})
+            self.assertEqual(response['status'], 23, output)
+        self.assertFalse(os.path.exists('other.html'))
+        response = self.request('document', {'args': ['-o', 'doc.html',
+            'doc.htex']})
+        self.assertEqual(response['status'], 0, response['stderr'])
+
+    def test_that_unwritable_directories_are_rejected(self):
+        response = server.request(self.address, 'document', {'cwd':
+            os.path.join(self.tmpdir, 'missing'), 'args': ['-'], 'input': ''})
+        self.assertEqual(response['status'], 23)
+
+class test_converter_pool(unittest.TestCase):
+    class Converter:
+        removed = False
+        def remove_scratch_directories(self):
+            self.removed = True
+
+    def test_that_least_recently_used_converters_are_dropped(self):
+        pool = gladtex.ConverterPool(size=2)
+        first, second, third = [self.Converter() for _ in range(3)]
+        pool.add('a', first)
+        pool.add('b', second)
+        self.assertTrue(pool.get('a') is first) # a is used more recently now
+        pool.add('c', third)
+        self.assertEqual(pool.get('b'), None)
+        self.assertTrue(second.removed)
+        self.assertTrue(pool.get('a') is first and pool.get('c') is third)
+
+    def test_that_clear_removes_scratch_directories(self):
+        pool = gladtex.ConverterPool()
+        conv = self.Converter()
+        pool.add('a', conv)
+        pool.clear()
+        self.assertTrue(conv.removed)
+        self.assertEqual(pool.get('a'), None)